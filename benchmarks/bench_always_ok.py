@@ -0,0 +1,73 @@
+"""Compares the route classifier of devpiserver_authcheck_always_ok with the
+previous implementation, which checked the route name and URL with string
+operations on every call.
+
+Run with ``python benchmarks/bench_always_ok.py``.
+"""
+from devpi_lockdown.main import AlwaysOkClassifier
+from devpi_lockdown.main import default_always_ok_patterns
+import timeit
+
+
+route_names = [
+    "/+status", "/+api", "/{user}/+api", "/{user}/{index}/+api",
+    "/+authcheck", "/+login", "login", "logout",
+    "/{user}/{index}/+e/{relpath:.*}", "/{user}/{index}/+f/{relpath:.*}",
+    "/{user}/{index}/+simple", "/{user}/{index}/+simple/",
+    "/{user}/{index}/+simple/{project}", "/{user}/{index}/+simple/{project}/",
+    "/{user}/{index}/{project}/{version}", "/{user}/{index}/{project}",
+    "/{user}/{index}/", "/{user}/{index}", "/{user}/", "/{user}", "/",
+    "__+static-5.1.1/", "__+theme-static-5.1.1/"]
+
+
+requests = [
+    ("/{user}/{index}/+simple/{project}/", "http://localhost/root/pypi/+simple/pkg/"),
+    ("/{user}/{index}/+f/{relpath:.*}", "http://localhost/root/pypi/+f/abc/pkg-1.0.tar.gz"),
+    ("/+api", "http://localhost/+api"),
+    ("login", "http://localhost/+login"),
+    ("__+static-5.1.1/", "http://localhost/+static-5.1.1/style.css")]
+
+
+class Route:
+    def __init__(self, name):
+        self.name = name
+
+
+class Request:
+    def __init__(self, route_name, url):
+        self.matched_route = Route(route_name)
+        self.url = url
+
+
+def legacy_always_ok(request):
+    route = request.matched_route
+    if route and route.name.endswith('/+api'):
+        return True
+    if route and route.name in ('/+login', 'login', 'logout'):
+        return True
+    if route and '+static' in route.name and '/+static' in request.url:
+        return True
+    if route and '+theme-static' in route.name and '/+theme-static' in request.url:
+        return True
+
+
+def main():
+    classifier = AlwaysOkClassifier()
+    for (pattern, url_marker, location) in default_always_ok_patterns:
+        classifier.add_pattern(pattern, url_marker)
+    classifier.route_markers = classifier.build_route_markers(route_names)
+    reqs = [Request(*x) for x in requests]
+    for req in reqs:
+        assert bool(legacy_always_ok(req)) == classifier.is_always_ok(req)
+    number = 200000
+    for (name, func) in (
+            ("legacy", legacy_always_ok),
+            ("classifier", classifier.is_always_ok)):
+        duration = min(timeit.repeat(
+            lambda: [func(req) for req in reqs], number=number, repeat=5))
+        print("%-10s %8.1f ns per request" % (
+            name, duration / (number * len(reqs)) * 1e9))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+from pathlib import Path
+from time import perf_counter
+import json
+import pytest
+
+
+pytest_plugins = ["pytest_devpi_server", "test_devpi_server.plugin"]
+
+
+thresholds_path = Path(__file__).parent / "thresholds.json"
+
+
+def pytest_addoption(parser):
+    parser.addoption(
+        "--bench-update-thresholds", action="store_true",
+        help="don't check the thresholds, print the measured results only")
+
+
+@pytest.fixture(scope="session")
+def thresholds():
+    with thresholds_path.open() as f:
+        return json.load(f)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+@pytest.fixture
+def bench(request, thresholds):
+    """Calls a function repeatedly and checks the throughput and latency
+    against the thresholds stored for the given name."""
+    def bench(name, func, number, warmup=5):
+        for i in range(warmup):
+            func()
+        latencies = []
+        start = perf_counter()
+        for i in range(number):
+            call_start = perf_counter()
+            func()
+            latencies.append(perf_counter() - call_start)
+        duration = perf_counter() - start
+        result = dict(
+            rps=number / duration,
+            p50_ms=percentile(latencies, 0.5) * 1000,
+            p99_ms=percentile(latencies, 0.99) * 1000)
+        print(
+            "\n%-30s %10.1f req/s  p50 %8.3f ms  p99 %8.3f ms" % (
+                name, result['rps'], result['p50_ms'], result['p99_ms']))
+        if request.config.getoption("--bench-update-thresholds"):
+            return result
+        threshold = thresholds[name]
+        assert result['rps'] >= threshold['min_rps'], (
+            "%s: throughput %.1f req/s below threshold of %s req/s" % (
+                name, result['rps'], threshold['min_rps']))
+        assert result['p99_ms'] <= threshold['max_p99_ms'], (
+            "%s: p99 latency %.3f ms above threshold of %s ms" % (
+                name, result['p99_ms'], threshold['max_p99_ms']))
+        return result
+    return bench
+
+
+@pytest.fixture
+def xom(request, makexom):
+    import devpi_lockdown.main
+    import devpi_web.main
+    xom = makexom(plugins=[
+        (devpi_web.main, None),
+        (devpi_lockdown.main, None)])
+    from devpi_server.main import set_default_indexes
+    with xom.keyfs.write_transaction():
+        set_default_indexes(xom.model)
+    return xom
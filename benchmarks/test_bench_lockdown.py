@@ -0,0 +1,71 @@
+"""Throughput and latency of the lockdown views.
+
+Run with ``tox -e bench`` or ``pytest -s -o addopts="" benchmarks``.
+The thresholds are stored in ``thresholds.json``, use
+``--bench-update-thresholds`` to only print the results.
+"""
+from pyramid.authentication import b64encode
+from webob.headers import ResponseHeaders
+import pytest
+
+
+pytestmark = [pytest.mark.notransaction]
+
+
+simple_uri = 'http://localhost/root/pypi/+simple/pkg/'
+
+
+@pytest.fixture
+def user1(mapp):
+    mapp.create_user("user1", "1")
+    return ("user1", "1")
+
+
+def authcheck(testapp, code, headers):
+    def authcheck():
+        testapp.xget(code, 'http://localhost/+authcheck', headers=headers)
+    return authcheck
+
+
+def test_authcheck_anonymous(bench, testapp):
+    headers = ResponseHeaders({'X-Original-URI': simple_uri})
+    bench(
+        "authcheck_anonymous",
+        authcheck(testapp, 401, headers), number=500)
+
+
+def test_authcheck_always_ok(bench, testapp):
+    headers = ResponseHeaders({'X-Original-URI': 'http://localhost/+api'})
+    bench(
+        "authcheck_always_ok",
+        authcheck(testapp, 200, headers), number=500)
+
+
+def test_authcheck_cookie(bench, testapp, user1):
+    testapp.post(
+        'http://localhost/+login',
+        dict(username=user1[0], password=user1[1], submit=""),
+        code=302)
+    headers = ResponseHeaders({'X-Original-URI': simple_uri})
+    bench(
+        "authcheck_cookie",
+        authcheck(testapp, 200, headers), number=500)
+
+
+def test_authcheck_basic(bench, testapp, user1):
+    basic_auth = b64encode('%s:%s' % user1).decode('ascii')
+    headers = ResponseHeaders({
+        'Authorization': 'Basic %s' % basic_auth,
+        'X-Original-URI': simple_uri})
+    bench(
+        "authcheck_basic",
+        authcheck(testapp, 200, headers), number=20)
+
+
+def test_login(bench, testapp, user1):
+    def login():
+        testapp.post(
+            'http://localhost/+login',
+            dict(username=user1[0], password=user1[1], submit=""),
+            code=302)
+    bench("login", login, number=20)
@@ -0,0 +1,141 @@
+import threading
+
+
+# principals which every identity has, anonymous requests are rejected
+# before the read restrictions are checked
+unrestricted = frozenset((':ANONYMOUS:', ':AUTHENTICATED:'))
+
+
+def get_indexes(username, userconfig):
+    """Returns a dictionary of the indexes of a user with the principals
+    allowed to read them, or None if unrestricted, and the bases."""
+    indexes = {}
+    for (index, ixconfig) in (userconfig or {}).get('indexes', {}).items():
+        allowed = ixconfig.get('lockdown_acl_read')
+        if allowed is not None and not unrestricted.intersection(allowed):
+            # the owner and root can always read the index
+            allowed = frozenset(allowed).union((username, 'root'))
+        else:
+            allowed = None
+        indexes[index] = (allowed, tuple(ixconfig.get('bases', ())))
+    return indexes
+
+
+class ReadACLTable:
+    """Maps indexes to the principals which may read them.
+
+    The entries are derived from the ``lockdown_acl_read`` option of the
+    index configuration. They are loaded once per user and afterwards
+    updated from the change events of the user configuration, which
+    contains the configuration of its indexes. The restrictions of an
+    index including those of its bases are computed once and kept until
+    the configuration of the index or one of its bases changes.
+
+    Without change events, like with ``--requests-only``, ``cached`` has
+    to be false and the configuration is read on each lookup.
+    """
+
+    def __init__(self, cached=True):
+        self.cached = cached
+        # maps a username to the serial of the loaded configuration and
+        # the result of get_indexes
+        self.users = {}
+        # maps (username, index) to the restrictions and the indexes they
+        # were computed from
+        self.restrictions = {}
+        self._lock = threading.Lock()
+
+    def update_user(self, username, userconfig, serial):
+        indexes = get_indexes(username, userconfig)
+        with self._lock:
+            current = self.users.get(username)
+            if current is not None and current[0] > serial:
+                # a newer configuration was already loaded
+                return
+            self.users[username] = (serial, indexes)
+            previous = {} if current is None else current[1]
+            changed = set(
+                (username, x) for x in set(previous).union(indexes)
+                if previous.get(x) != indexes.get(x))
+            if not changed:
+                return
+            # readers without the lock keep using the previous dictionary
+            self.restrictions = {
+                key: entry for (key, entry) in self.restrictions.items()
+                if entry[1].isdisjoint(changed)}
+
+    def on_userchange(self, ev):
+        self.update_user(ev.typedkey.params['user'], ev.value, ev.at_serial)
+
+    def _get_index(self, keyfs, username, index):
+        entry = self.users.get(username)
+        if entry is None:
+            userconfig = keyfs.USER(user=username).get()
+            if not userconfig:
+                # unknown users aren't remembered, as anyone can ask for them
+                return None
+            if not self.cached:
+                return get_indexes(username, userconfig).get(index)
+            self.update_user(username, userconfig, keyfs.tx.at_serial)
+            entry = self.users[username]
+        return entry[1].get(index)
+
+    def get_restrictions(self, keyfs, username, index):
+        """Returns the sets of principals of which the identity needs to
+        have at least one in each to read the index.
+
+        Must be called inside a keyfs transaction.
+        """
+        key = (username, index)
+        restrictions = self.restrictions
+        entry = restrictions.get(key)
+        if entry is not None:
+            return entry[0]
+        if self._get_index(keyfs, username, index) is None:
+            return ()
+        result = []
+        pending = [key]
+        seen = set(pending)
+        while pending:
+            (username, index) = pending.pop()
+            info = self._get_index(keyfs, username, index)
+            if info is None:
+                continue
+            (allowed, bases) = info
+            if allowed is not None:
+                result.append(allowed)
+            for base in bases:
+                base = tuple(base.split('/', 1))
+                if len(base) == 2 and base not in seen:
+                    seen.add(base)
+                    pending.append(base)
+        result = tuple(result)
+        if self.cached:
+            restrictions[key] = (result, frozenset(seen))
+        return result
+
+    def get_cached_restrictions(self, username, index):
+        """Returns the restrictions like ``get_restrictions`` if they are
+        already computed, otherwise None. No transaction is needed."""
+        entry = self.restrictions.get((username, index))
+        if entry is not None:
+            return entry[0]
+
+    def permits(self, keyfs, identity, username, index):
+        """Returns whether the identity may read the index.
+
+        Must be called inside a keyfs transaction.
+        """
+        return restrictions_permit(
+            self.get_restrictions(keyfs, username, index), identity)
+
+
+def restrictions_permit(restrictions, identity):
+    """Returns whether the identity satisfies the restrictions of an
+    index returned by ``ReadACLTable.get_restrictions``."""
+    if not restrictions:
+        return True
+    principals = set(":%s" % x for x in identity.groups)
+    principals.add(identity.username)
+    return not any(
+        allowed.isdisjoint(principals) for allowed in restrictions)
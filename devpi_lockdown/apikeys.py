@@ -0,0 +1,129 @@
+from collections import namedtuple
+from devpi_lockdown.cookie import b64decode
+from devpi_lockdown.cookie import b64encode
+from devpi_server.view_auth import CredentialsIdentity
+import binascii
+import hashlib
+import secrets
+import threading
+
+
+ApiKey = namedtuple('ApiKey', 'keyid groups indexes')
+
+
+# prefix of API keys, which distinguishes them from passwords
+api_key_prefix = 'k1'
+
+# the key of the API keys in the user configuration
+userconfig_key = 'lockdown_api_keys'
+
+
+class ApiKeyIdentity(CredentialsIdentity):
+    """The identity of a request authenticated with an API key."""
+
+    def __init__(self, username, groups, keyid, indexes):
+        CredentialsIdentity.__init__(self, username, groups)
+        self.keyid = keyid
+        self.indexes = indexes
+
+
+def in_scope(identity, stagename):
+    """Returns whether the identity may use the index with the given name,
+    only API keys can be restricted to indexes."""
+    indexes = getattr(identity, 'indexes', None)
+    return indexes is None or stagename in indexes
+
+
+def is_api_key(value):
+    return value.startswith(api_key_prefix + '.')
+
+
+def new_api_key(username):
+    """Returns a new random API key for the user and its id."""
+    keyid = secrets.token_hex(4)
+    return (keyid, '.'.join((
+        api_key_prefix,
+        b64encode(username.encode('utf-8')),
+        secrets.token_urlsafe(32))))
+
+
+def get_username(value):
+    """Returns the username contained in an API key or None."""
+    if not is_api_key(value):
+        return None
+    try:
+        (prefix, username, secret) = value.split('.')
+        return b64decode(username).decode('utf-8')
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+
+
+def get_digest(value):
+    # the keys are random with enough entropy that a slow hash isn't needed
+    return hashlib.sha256(value.encode('utf-8')).hexdigest()
+
+
+def get_api_keys(userconfig):
+    """Returns a dictionary of the digests of the API keys of a user."""
+    keys = {}
+    for (keyid, info) in (userconfig or {}).get(userconfig_key, {}).items():
+        indexes = info.get('indexes')
+        keys[info['digest']] = ApiKey(
+            keyid,
+            list(info.get('groups', ())),
+            None if indexes is None else frozenset(indexes))
+    return keys
+
+
+class ApiKeyTable:
+    """Maps the digests of API keys to the user, groups and indexes.
+
+    The keys are stored in the user configuration. Like ``ReadACLTable``
+    they are loaded once per user and afterwards updated from the change
+    events of the user configuration, so a lookup is a dictionary access.
+
+    Without change events, like with ``--requests-only``, ``cached`` has
+    to be false and the configuration is read on each lookup.
+    """
+
+    def __init__(self, cached=True):
+        self.cached = cached
+        # maps a username to the serial of the loaded configuration and
+        # the result of get_api_keys
+        self.users = {}
+        self._lock = threading.Lock()
+
+    def update_user(self, username, userconfig, serial):
+        keys = get_api_keys(userconfig)
+        with self._lock:
+            current = self.users.get(username)
+            if current is not None and current[0] > serial:
+                # a newer configuration was already loaded
+                return
+            self.users[username] = (serial, keys)
+
+    def on_userchange(self, ev):
+        self.update_user(ev.typedkey.params['user'], ev.value, ev.at_serial)
+
+    def is_loaded(self, username):
+        """Returns whether ``get`` for the user needs no transaction."""
+        return self.cached and username in self.users
+
+    def get(self, keyfs, username, value):
+        """Returns the ``ApiKey`` of a key of the user or None.
+
+        Must be called inside a keyfs transaction.
+        """
+        if get_username(value) != username:
+            return None
+        entry = self.users.get(username)
+        if entry is None:
+            userconfig = keyfs.USER(user=username).get()
+            if not userconfig:
+                # unknown users aren't remembered, as anyone can ask for them
+                return None
+            if not self.cached:
+                return get_api_keys(userconfig).get(get_digest(value))
+            self.update_user(username, userconfig, keyfs.tx.at_serial)
+            entry = self.users[username]
+        return entry[1].get(get_digest(value))
@@ -0,0 +1,93 @@
+import json
+import os
+import queue
+import threading
+import time
+
+
+class AuditLog:
+    """Writes audit records as JSON lines in a background thread.
+
+    Recording a decision only puts a tuple into a bounded queue, when it
+    is full the record is dropped and counted instead of blocking the
+    request. The writer thread takes the records from the queue in batches
+    and appends them to the file, which is rotated when it grows beyond
+    ``max_bytes`` with up to ``backups`` older files kept.
+
+    The writer is run by the thread pool of devpi-server with
+    ``thread_run``.
+    """
+
+    def __init__(self, path, max_bytes, backups, size=10000, batch=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.batch = batch
+        self.queue = queue.Queue(size)
+        self.dropped = 0
+        self.written = 0
+        self._file = None
+        self._lock = threading.Lock()
+
+    def record(self, event, **fields):
+        try:
+            self.queue.put_nowait((time.time(), event, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def _open(self):
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backups <= 0:
+            os.remove(self.path)
+            return
+        for index in range(self.backups - 1, 0, -1):
+            name = "%s.%s" % (self.path, index)
+            if os.path.exists(name):
+                os.replace(name, "%s.%s" % (self.path, index + 1))
+        os.replace(self.path, "%s.1" % self.path)
+
+    def flush(self, timeout=0):
+        """Writes the queued records, waiting up to ``timeout`` seconds for
+        the first one. Returns the number of written records."""
+        records = []
+        try:
+            records.append(self.queue.get(timeout=timeout))
+            while len(records) < self.batch:
+                records.append(self.queue.get_nowait())
+        except queue.Empty:
+            pass
+        if not records:
+            return 0
+        lines = []
+        for (ts, event, fields) in records:
+            record = dict(ts=round(ts, 3), event=event)
+            record.update(fields)
+            lines.append(json.dumps(record, separators=(',', ':')))
+        lines.append('')
+        with self._lock:
+            f = self._open()
+            f.write('\n'.join(lines))
+            f.flush()
+            self.written += len(records)
+            if f.tell() >= self.max_bytes:
+                self._rotate()
+        return len(records)
+
+    def thread_run(self):
+        while 1:
+            self.flush(timeout=1)
+            self.thread.exit_if_shutdown()
+
+    def thread_shutdown(self):
+        while self.flush(timeout=0):
+            pass
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
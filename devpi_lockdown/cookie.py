@@ -0,0 +1,197 @@
+from base64 import urlsafe_b64decode
+from base64 import urlsafe_b64encode
+from collections import namedtuple
+import binascii
+import hashlib
+import hmac
+import os
+import re
+import time
+
+
+Claim = namedtuple('Claim', 'username groups expires keyid')
+
+
+class InvalidKeys(ValueError):
+    """ Raised when the keys for signing cookies can't be used. """
+
+
+def b64encode(value):
+    return urlsafe_b64encode(value).rstrip(b'=').decode('ascii')
+
+
+def b64decode(value):
+    return urlsafe_b64decode(value + '=' * (-len(value) % 4))
+
+
+def read_keys(path):
+    """Reads signing keys from a file.
+
+    Each non empty line which doesn't start with ``#`` contains a key id
+    and the secret separated by whitespace.
+    """
+    keys = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise InvalidKeys(
+                    "The line %r in %s has no secret." % (parts[0], path))
+            keys.append(parts)
+    return keys
+
+
+class CookieSigner:
+    """Signs and verifies cookie values holding a claim.
+
+    The claim consists of the username, the groups, the expiration time and
+    the id of the key used for signing. Verifying a claim only needs a HMAC
+    and a clock comparison, so no user lookup is necessary. A random nonce
+    makes each signed value unique, so revoking one never revokes another
+    issued for the same user in the same second.
+
+    The first key is used for signing, all keys are accepted when verifying,
+    which allows key rotation.
+    """
+
+    prefix = 's1'
+
+    def __init__(self, keys):
+        if not keys:
+            raise InvalidKeys("No keys for signing cookies.")
+        self.keys = {}
+        for (keyid, secret) in keys:
+            if not re.fullmatch('[A-Za-z0-9_-]+', keyid):
+                raise InvalidKeys(
+                    "The key id %r may only contain letters, digits, "
+                    "'_' and '-'." % keyid)
+            if keyid in self.keys:
+                raise InvalidKeys("The key id %r is used twice." % keyid)
+            if isinstance(secret, str):
+                secret = secret.encode('utf-8')
+            self.keys[keyid] = secret
+        self.signing_keyid = keys[0][0]
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(read_keys(path))
+
+    def _signature(self, secret, payload):
+        return b64encode(hmac.new(
+            secret, payload.encode('utf-8'), hashlib.sha256).digest())
+
+    def sign(self, username, groups, expires):
+        payload = '.'.join((
+            self.prefix,
+            self.signing_keyid,
+            b64encode(username.encode('utf-8')),
+            b64encode(','.join(groups).encode('utf-8')),
+            str(int(expires)),
+            b64encode(os.urandom(6))))
+        return '%s.%s' % (
+            payload,
+            self._signature(self.keys[self.signing_keyid], payload))
+
+    def verify(self, value, now=None):
+        """Returns the claim of a signed value.
+
+        Returns None if the value isn't signed, was signed with an unknown
+        key, the signature doesn't match or the claim expired.
+        """
+        if not value.startswith(self.prefix + '.'):
+            return None
+        try:
+            (payload, signature) = value.rsplit('.', 1)
+            (prefix, keyid, username, groups, expires, nonce) = (
+                payload.split('.'))
+        except ValueError:  # not enough values to unpack
+            return None
+        secret = self.keys.get(keyid)
+        if secret is None:
+            return None
+        if not hmac.compare_digest(
+                signature, self._signature(secret, payload)):
+            return None
+        try:
+            expires = int(expires)
+            username = b64decode(username).decode('utf-8')
+            groups = b64decode(groups).decode('utf-8')
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            return None
+        if expires <= (time.time() if now is None else now):
+            return None
+        return Claim(
+            username, groups.split(',') if groups else [], expires, keyid)
+
+
+# prefix of the compact encoding of login tokens
+compact_prefix = 'c1'
+
+
+def encode_compact(username, token, serializer):
+    """Returns a compact cookie value for a login token of devpi-server.
+
+    The token consists of the JSON payload with the username, groups and
+    whether the user exists, the timestamp and the signature. These are
+    packed into bytes, the payload is restored with the ``serializer`` of
+    devpi-server on decoding. Returns None if the token can't be restored
+    exactly, so the regular format has to be used.
+    """
+    try:
+        (payload, timestamp, signature) = token.rsplit('.', 2)
+        (token_username, groups, from_user_object) = serializer.load_payload(
+            payload.encode('utf-8'))
+        timestamp = b64decode(timestamp)
+        signature = b64decode(signature)
+    except Exception:  # itsdangerous raises different errors for payloads
+        return None
+    if token_username != username or len(timestamp) != 4:
+        return None
+    data = bytearray((1 if from_user_object else 0,))
+    try:
+        for value in [username, len(groups)] + groups:
+            if isinstance(value, str):
+                value = value.encode('utf-8')
+                data.append(len(value))
+                data.extend(value)
+            else:
+                data.append(value)
+    except (AttributeError, TypeError, ValueError):  # bad types or too long
+        return None
+    data.extend(timestamp)
+    data.extend(signature)
+    value = '%s.%s' % (compact_prefix, b64encode(bytes(data)))
+    if decode_compact(value, serializer) != (username, token):
+        return None
+    return value
+
+
+def decode_compact(value, serializer):
+    """Returns the username and login token of a compact cookie value.
+
+    Returns None if the value can't be decoded.
+    """
+    try:
+        data = b64decode(value[len(compact_prefix) + 1:])
+        size = data[1]
+        username = data[2:2 + size].decode('utf-8')
+        pos = 2 + size
+        count = data[pos]
+        pos += 1
+        groups = []
+        for _ in range(count):
+            size = data[pos]
+            groups.append(data[pos + 1:pos + 1 + size].decode('utf-8'))
+            pos += 1 + size
+    except (binascii.Error, IndexError, UnicodeDecodeError, ValueError):
+        return None
+    timestamp = data[pos:pos + 4]
+    signature = data[pos + 4:]
+    if len(timestamp) != 4 or not signature:
+        return None
+    payload = serializer.dump_payload([username, groups, bool(data[0])])
+    return (username, '%s.%s.%s' % (
+        payload.decode('utf-8'), b64encode(timestamp), b64encode(signature)))
@@ -0,0 +1,49 @@
+from repoze.lru import ExpiringLRUCache
+import hashlib
+import hmac
+import os
+
+
+class CredentialCache:
+    """Remembers successful credential verifications.
+
+    The cache key is a HMAC of the credentials with a per process secret,
+    so the credentials are never stored. Each user has a generation which
+    is increased when the user changes, entries of older generations are
+    invalid, which covers password changes.
+    """
+
+    def __init__(self, size, expiry):
+        self.secret = os.urandom(32)
+        self.cache = ExpiringLRUCache(size, default_timeout=expiry)
+        self.generations = {}
+
+    def get_key(self, username, password):
+        return hmac.new(
+            self.secret,
+            b'\0'.join((username.encode('utf-8'), password.encode('utf-8'))),
+            hashlib.sha256).digest()
+
+    def get_generation(self, username):
+        return self.generations.get(username, 0)
+
+    def get(self, key, username):
+        """Returns the groups of successfully verified credentials or None."""
+        entry = self.cache.get(key)
+        if entry is None:
+            return None
+        (groups, generation) = entry
+        if generation != self.get_generation(username):
+            self.cache.invalidate(key)
+            return None
+        return groups
+
+    def put(self, key, username, groups, generation):
+        if generation != self.get_generation(username):
+            # the user changed during verification
+            return
+        self.cache.put(key, (list(groups), generation))
+
+    def on_userchange(self, ev):
+        username = ev.typedkey.params['user']
+        self.generations[username] = self.get_generation(username) + 1
@@ -0,0 +1,83 @@
+from devpi_lockdown.apikeys import ApiKeyIdentity
+from devpi_lockdown.cookie import b64decode
+from devpi_lockdown.cookie import b64encode
+from devpi_server.view_auth import CredentialsIdentity
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+import binascii
+import hashlib
+import hmac
+import json
+import time
+
+
+# the header with the identity verified by /+authcheck
+identity_header = 'X-Devpi-Lockdown-Identity'
+
+
+def get_uri_path(uri):
+    """Returns the decoded path of an URI or of a path with query."""
+    return unquote(urlsplit(uri).path)
+
+
+class IdentitySigner:
+    """Signs and verifies the identity verified by /+authcheck.
+
+    nginx passes the signed identity on to the proxied request, so
+    devpi-server can use it instead of verifying the credentials again.
+    The value holds the username, groups, the id and indexes of an API key,
+    the path of the original request and the expiration time. It is only
+    valid for ``expiry`` seconds and for the same path, so it is useless
+    for other requests.
+    """
+
+    prefix = 'i1'
+
+    def __init__(self, secret, expiry):
+        self.secret = secret
+        self.expiry = expiry
+
+    def _signature(self, payload):
+        return b64encode(hmac.new(
+            self.secret, payload.encode('utf-8'), hashlib.sha256).digest())
+
+    def sign(self, identity, path, now=None):
+        indexes = getattr(identity, 'indexes', None)
+        expires = int((time.time() if now is None else now) + self.expiry)
+        payload = '%s.%s' % (self.prefix, b64encode(json.dumps([
+            identity.username,
+            list(identity.groups),
+            getattr(identity, 'keyid', None),
+            None if indexes is None else sorted(indexes),
+            path,
+            expires], separators=(',', ':')).encode('utf-8')))
+        return '%s.%s' % (payload, self._signature(payload))
+
+    def verify(self, value, path, now=None):
+        """Returns the identity of a signed value.
+
+        Returns None if the value isn't signed, the signature doesn't
+        match, it was signed for another path or it expired.
+        """
+        if not value.startswith(self.prefix + '.'):
+            return None
+        try:
+            (payload, signature) = value.rsplit('.', 1)
+        except ValueError:  # not enough values to unpack
+            return None
+        if not hmac.compare_digest(signature, self._signature(payload)):
+            return None
+        try:
+            (username, groups, keyid, indexes, signed_path, expires) = (
+                json.loads(b64decode(payload[len(self.prefix) + 1:])))
+        except (binascii.Error, TypeError, ValueError):
+            return None
+        if signed_path != path:
+            return None
+        if expires <= (time.time() if now is None else now):
+            return None
+        if keyid is not None:
+            return ApiKeyIdentity(
+                username, groups, keyid,
+                None if indexes is None else frozenset(indexes))
+        return CredentialsIdentity(username, groups)
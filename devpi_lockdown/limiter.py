@@ -0,0 +1,39 @@
+import threading
+
+
+class Saturated(Exception):
+    """ Raised when all slots are taken and the queue is full. """
+
+
+class VerificationLimiter:
+    """Limits the number of concurrent password hash checks.
+
+    At most ``size`` verifications run at the same time and up to ``queue``
+    more wait for a free slot. Further verifications are rejected right
+    away, so the threads of the server aren't all blocked by hashing.
+
+    The verification has to run on the thread of the request, because the
+    user data is read in its keyfs transaction, so the limit applies to the
+    threads of the server instead of using a separate pool.
+    """
+
+    def __init__(self, size, queue):
+        self.size = size
+        self.queue = queue
+        self.pending = 0
+        self.rejected = 0
+        self._slots = threading.Semaphore(size)
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.pending >= self.size + self.queue:
+                self.rejected += 1
+                raise Saturated()
+            self.pending += 1
+        self._slots.acquire()
+
+    def release(self):
+        self._slots.release()
+        with self._lock:
+            self.pending -= 1
@@ -1,8 +1,50 @@
 from devpi_common.url import URL
+from devpi_lockdown.acl import ReadACLTable
+from devpi_lockdown.acl import restrictions_permit
+from devpi_lockdown.audit import AuditLog
+from devpi_lockdown.apikeys import ApiKeyIdentity
+from devpi_lockdown.apikeys import ApiKeyTable
+from devpi_lockdown.apikeys import get_digest as get_api_key_digest
+from devpi_lockdown.apikeys import get_username as get_api_key_username
+from devpi_lockdown.apikeys import in_scope
+from devpi_lockdown.apikeys import is_api_key
+from devpi_lockdown.apikeys import new_api_key
+from devpi_lockdown.apikeys import userconfig_key as api_keys_userconfig_key
+from devpi_lockdown.cookie import CookieSigner
+from devpi_lockdown.cookie import InvalidKeys
+from devpi_lockdown.cookie import compact_prefix
+from devpi_lockdown.cookie import decode_compact
+from devpi_lockdown.cookie import encode_compact
+from devpi_lockdown.credentials import CredentialCache
+from devpi_lockdown.identity import IdentitySigner
+from devpi_lockdown.identity import get_uri_path
+from devpi_lockdown.identity import identity_header
+from devpi_lockdown.limiter import Saturated
+from devpi_lockdown.limiter import VerificationLimiter
+from devpi_lockdown.metrics import Metrics
+from devpi_lockdown.metrics import MetricsPlugin
+from devpi_lockdown.profiler import SlowRequestProfiler
+from devpi_lockdown.profiler import null_profiler
+from devpi_lockdown.revocation import RevocationTable
+from devpi_lockdown.revocation import revoke_all
+from devpi_lockdown.revocation import revoke_token
+from devpi_lockdown.throttle import FailureThrottle
+from devpi_lockdown.throttle import RateLimiter
+from devpi_lockdown.throttle import get_remote_ip
+from devpi_lockdown.tracing import JsonLinesExporter
+from devpi_lockdown.tracing import Tracer
+from devpi_lockdown.verdicts import SharedVerdictCache
 from devpi_server import __version__ as devpiserver_version
+from devpi_server.log import threadlog
+from devpi_server.model import ACLList
+from devpi_server.view_auth import CredentialsIdentity
 from pluggy import HookimplMarker
 from pkg_resources import parse_version
 from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.httpexceptions import HTTPTooManyRequests
+from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.httpexceptions import status_map
 try:
     from pyramid.interfaces import IAuthenticationPolicy
 except ImportError:
@@ -15,11 +57,29 @@ try:
     from pyramid.util import SimpleSerializer
 except ImportError:
     from pyramid.authentication import _SimpleSerializer as SimpleSerializer
+from pyramid.interfaces import IRequestExtensions
+from pyramid.interfaces import IRootFactory
+from pyramid.interfaces import IRoutesMapper
+from pyramid.interfaces import PHASE3_CONFIG
+from pyramid.request import Request
+from pyramid.request import apply_request_extensions
+from pyramid.response import Response
+from pyramid.threadlocal import RequestContext
+from pyramid.traversal import DefaultRootFactory
 from pyramid.view import view_config
+from repoze.lru import ExpiringLRUCache
 from urllib.parse import quote as url_quote
 from urllib.parse import unquote as url_unquote
+from urllib.parse import urlsplit
 from webob.cookies import CookieProfile
+import hashlib
+import itsdangerous
+import math
 import re
+import sys
+import threading
+import time
+import types
 
 
 devpiserver_hookimpl = HookimplMarker("devpiserver")
@@ -40,9 +100,580 @@ def includeme(config):
         "logout",
         "/+logout",
         accept="text/html")
+    config.add_route(
+        "lockdown-authcheck-batch",
+        "/+authcheck/batch")
+    config.add_route(
+        "lockdown-metrics",
+        "/+lockdown/metrics")
+    config.add_route(
+        "lockdown-revoke",
+        "/+lockdown/revoke/{user}")
+    config.add_route(
+        "lockdown-api-keys",
+        "/+api-keys")
+    config.add_route(
+        "lockdown-api-key",
+        "/+api-keys/{keyid}")
+    classifier = AlwaysOkClassifier()
+    for (pattern, url_marker, location) in default_always_ok_patterns:
+        classifier.add_pattern(pattern, url_marker)
+    config.registry['lockdown_always_ok'] = classifier
+    config.add_directive(
+        'add_lockdown_always_ok', add_lockdown_always_ok)
+    config.add_directive(
+        'set_lockdown_trace_exporter', set_lockdown_trace_exporter)
+    # build the lookup table after all routes are registered
+    config.action(
+        None, classifier.build, args=(config.registry,),
+        order=PHASE3_CONFIG + 1)
+    config.add_tween(
+        "devpi_lockdown.main.tween_authcheck",
+        under="devpi_server.views.tween_request_logging",
+        over="devpi_server.views.tween_keyfs_transaction")
     config.scan()
 
 
+# route name patterns which /+authcheck always allows, with an optional
+# marker which has to be contained in the URL as well, and a regular
+# expression for the paths of these routes used outside of devpi-server,
+# like in the nginx configuration
+default_always_ok_patterns = (
+    (r'.*/\+api', None, r'^(/[^/+][^/]*){0,2}/\+api$'),
+    (r'/\+login|login|logout', None, r'^/\+log(in|out)$'),
+    (r'.*\+static.*', '/+static', r'^/\+static-[^/]+/'),
+    (r'.*\+theme-static.*', '/+theme-static', r'^/\+theme-static-[^/]+/'))
+
+
+class AlwaysOkClassifier:
+    """Decides whether /+authcheck always allows a route.
+
+    The route name patterns are matched once against all registered
+    routes, afterwards classifying a request is a dictionary lookup.
+    """
+
+    def __init__(self):
+        self.patterns = []
+        self.route_markers = None
+
+    def add_pattern(self, pattern, url_marker=None):
+        self.patterns.append((re.compile(pattern), url_marker))
+        self.route_markers = None
+
+    def build_route_markers(self, route_names):
+        # maps the name of an always ok route to the markers of which one
+        # has to be in the URL, an empty tuple means no marker is needed
+        route_markers = {}
+        for name in route_names:
+            markers = set(
+                url_marker
+                for (regexp, url_marker) in self.patterns
+                if regexp.fullmatch(name))
+            if None in markers:
+                route_markers[name] = ()
+            elif markers:
+                route_markers[name] = tuple(markers)
+        return route_markers
+
+    def build(self, registry):
+        routes_mapper = registry.queryUtility(IRoutesMapper)
+        self.route_markers = self.build_route_markers(
+            route.name for route in routes_mapper.get_routes())
+
+    def is_always_ok(self, request):
+        route = request.matched_route
+        if route is None:
+            return False
+        route_markers = self.route_markers
+        if route_markers is None:
+            # routes added after the configuration was committed
+            self.build(request.registry)
+            route_markers = self.route_markers
+        markers = route_markers.get(route.name)
+        if markers is None:
+            return False
+        if not markers:
+            return True
+        url = request.url
+        return any(marker in url for marker in markers)
+
+
+def add_lockdown_always_ok(config, pattern, url_marker=None):
+    """Pyramid directive to let /+authcheck always allow routes.
+
+    The ``pattern`` is a regular expression which has to match the whole
+    route name. If ``url_marker`` is given, it also has to be contained
+    in the requested URL.
+    """
+    classifier = config.registry['lockdown_always_ok']
+    config.action(None, classifier.add_pattern, args=(pattern, url_marker))
+
+
+def set_lockdown_trace_exporter(config, exporter):
+    """Pyramid directive to record the spans of the authentication stages.
+
+    The ``export`` method of the ``exporter`` is called with each finished
+    ``devpi_lockdown.tracing.Span``.
+    """
+    tracer = config.registry['lockdown_tracer']
+    config.action(
+        'lockdown_trace_exporter', setattr,
+        args=(tracer, 'exporter', exporter))
+
+
+def get_tracer(registry):
+    tracer = registry.get('lockdown_tracer')
+    if tracer is None:
+        # like in the standalone authcheck server
+        return null_tracer
+    return tracer
+
+
+null_tracer = Tracer()
+
+
+# the headers and cookies from which devpi and its plugins read credentials
+credential_headers = ('Authorization', 'X-Devpi-Auth', 'X-Devpi-Replica-UUID')
+credential_cookies = ('auth_tkt',)
+
+
+def get_authcheck_cache_key(request, routes_mapper):
+    """Returns the key for the verdict of an authcheck request.
+
+    The key combines a digest of the presented credentials with the
+    route class of the original URI, which is the matched route name and
+    the user and index it refers to.
+    """
+    url = request.headers.get('x-original-uri', request.url)
+    orig_request = Request.blank(url, headers=request.headers)
+    info = routes_mapper(orig_request)
+    digest = hashlib.sha256()
+    for name in credential_headers:
+        digest.update(request.headers.get(name, '').encode('utf-8'))
+        digest.update(b'\0')
+    for name in credential_cookies:
+        digest.update(request.cookies.get(name, '').encode('utf-8'))
+        digest.update(b'\0')
+    # devpi-client gets a 403 instead of a 401
+    is_devpi_client = 'devpi-client' in (request.user_agent or '')
+    return (
+        digest.digest(),
+        is_devpi_client,
+        get_route_class(info['route'], info['match']))
+
+
+def get_route_class(route, matchdict):
+    """Returns the matched route name and the user and index it refers to.
+
+    The verdict of /+authcheck is the same for all URIs of a route class.
+    """
+    if route is None:
+        return None
+    matchdict = matchdict or {}
+    return (route.name, matchdict.get('user'), matchdict.get('index'))
+
+
+def make_orig_request(request, url, routes_mapper):
+    """Creates a request for the URL with the headers of the given request
+    and matches its route, like devpi-server does for /+authcheck."""
+    headers = {
+        k: v for (k, v) in request.headers.items()
+        if k.lower() not in ('content-length', 'content-type')}
+    orig_request = Request.blank(url, headers=headers)
+    orig_request.log = request.log
+    orig_request.registry = request.registry
+    request_extensions = request.registry.queryUtility(IRequestExtensions)
+    if request_extensions:
+        apply_request_extensions(orig_request, extensions=request_extensions)
+    info = routes_mapper(orig_request)
+    (orig_request.matchdict, orig_request.matched_route) = (
+        info['match'], info['route'])
+    return orig_request
+
+
+def get_authcheck_status(orig_request):
+    """Returns the status code of /+authcheck for a request created with
+    ``make_orig_request``, like the view of devpi-server does."""
+    if orig_request.matched_route is None:
+        return 403
+    registry = orig_request.registry
+    root_factory = orig_request.matched_route.factory or registry.queryUtility(
+        IRootFactory, default=DefaultRootFactory)
+    orig_request.context = root_factory(orig_request)
+    hook = registry['xom'].config.hook
+    with RequestContext(orig_request):
+        result = hook.devpiserver_authcheck_always_ok(request=orig_request)
+        if result and all(result):
+            return 200
+        if hook.devpiserver_authcheck_forbidden(request=orig_request):
+            return 403
+        if not hook.devpiserver_authcheck_unauthorized(request=orig_request):
+            return 200
+    if 'devpi-client' in (orig_request.user_agent or ''):
+        # devpi-client needs to know for proper error messages
+        return 403
+    return 401
+
+
+# the packages whose authcheck and identity hooks the fast path reproduces
+fast_path_packages = ('devpi_server', 'devpi_web', 'devpi_lockdown')
+
+# the routes for which devpi-server checks the pkg_read permission
+pkg_read_routes = (
+    '/{user}/{index}/+e/{relpath:.*}',
+    '/{user}/{index}/+f/{relpath:.*}')
+
+
+def get_plugin_package(plugin):
+    if isinstance(plugin, types.ModuleType):
+        return plugin.__name__.split('.')[0]
+    return type(plugin).__module__.split('.')[0]
+
+
+def can_use_fast_path(hook):
+    """Returns whether all implementations of the hooks used by
+    /+authcheck are known to the fast path."""
+    hookcallers = (
+        hook.devpiserver_get_credentials,
+        hook.devpiserver_get_identity,
+        hook.devpiserver_authcheck_always_ok,
+        hook.devpiserver_authcheck_forbidden,
+        hook.devpiserver_authcheck_unauthorized)
+    return all(
+        get_plugin_package(impl.plugin) in fast_path_packages
+        for hookcaller in hookcallers
+        for impl in hookcaller.get_hookimpls())
+
+
+def get_known_identity(request, credentials):
+    """Returns the identity for credentials which can be verified from
+    memory, like ``devpiserver_get_identity`` does, otherwise None."""
+    (username, password) = credentials
+    registry = request.registry
+    revocations = registry.get('lockdown_revocations')
+    if revocations is not None:
+        if not revocations.is_loaded():
+            return None
+        if revocations.is_revoked(
+                None, username, password,
+                lambda: get_token_times(request, password)[0]):
+            return None
+    signer = registry.get('lockdown_cookie_signer')
+    if signer is not None and password.startswith(signer.prefix + '.'):
+        claim = signer.verify(password)
+        if claim is None or claim.username != username:
+            return None
+        return CredentialsIdentity(claim.username, claim.groups)
+    api_keys = registry.get('lockdown_api_keys')
+    if api_keys is not None and is_api_key(password):
+        if not api_keys.is_loaded(username):
+            return None
+        api_key = api_keys.get(None, username, password)
+        if api_key is None:
+            return None
+        return ApiKeyIdentity(
+            username, api_key.groups, api_key.keyid, api_key.indexes)
+    credential_cache = registry.get('lockdown_credential_cache')
+    if credential_cache is not None:
+        key = credential_cache.get_key(username, password)
+        groups = credential_cache.get(key, username)
+        if groups is not None:
+            return CredentialsIdentity(username, groups)
+    return None
+
+
+def get_fast_authcheck_outcome(orig_request):
+    """Returns the outcome of /+authcheck for a request created with
+    ``make_orig_request`` if it can be decided without a keyfs
+    transaction, otherwise None, together with the verified identity.
+
+    That is the case for always allowed routes, requests without
+    credentials and credentials which are in the credential cache, are
+    a signed cookie or an API key, as long as no index configuration
+    has to be read.
+    """
+    route = orig_request.matched_route
+    if route is None:
+        return ('403', None)
+    registry = orig_request.registry
+    if registry['lockdown_always_ok'].is_always_ok(orig_request):
+        return ('always_ok', None)
+    if route.name in pkg_read_routes:
+        # needs the index configuration for the pkg_read permission
+        return (None, None)
+    hook = registry['xom'].config.hook
+    credentials = hook.devpiserver_get_credentials(request=orig_request)
+    if credentials is None:
+        if any(name in orig_request.headers for name in credential_headers):
+            # identity hooks can work without credentials, like the one
+            # for replicas in devpi-server
+            return (None, None)
+        if 'devpi-client' in (orig_request.user_agent or ''):
+            # devpi-client needs to know for proper error messages
+            return ('403', None)
+        return ('401', None)
+    identity = get_known_identity(orig_request, credentials)
+    if identity is None:
+        return (None, None)
+    matchdict = orig_request.matchdict or {}
+    (user, index) = (matchdict.get('user'), matchdict.get('index'))
+    if user and index:
+        index = index.rstrip('/')
+        if not in_scope(identity, "%s/%s" % (user, index)):
+            return ('403', identity)
+        restrictions = registry['lockdown_read_acls'].get_cached_restrictions(
+            user, index)
+        if restrictions is None:
+            return (None, None)
+        if not restrictions_permit(restrictions, identity):
+            return ('403', identity)
+    return ('200', identity)
+
+
+def get_cached_identity(orig_request):
+    """Returns the identity for the credentials of a request created with
+    ``make_orig_request`` if they can be verified from memory."""
+    hook = orig_request.registry['xom'].config.hook
+    credentials = hook.devpiserver_get_credentials(request=orig_request)
+    if credentials is None:
+        return None
+    return get_known_identity(orig_request, credentials)
+
+
+def is_cached_verdict_revoked(request):
+    """Returns whether the credentials of a reused /+authcheck verdict may
+    have been revoked since it was cached.
+
+    Cached verdicts aren't invalidated on revocation, instead the
+    revocations in memory are checked for each reused verdict. Until they
+    are loaded, the verdict isn't reused. Without change events, like with
+    ``--requests-only``, they are read in a keyfs transaction.
+    """
+    revocations = request.registry.get('lockdown_revocations')
+    if revocations is None:
+        return False
+    xom = request.registry['xom']
+    credentials = xom.config.hook.devpiserver_get_credentials(request=request)
+    if credentials is None:
+        return False
+    (username, password) = credentials
+
+    def get_issued():
+        return get_token_times(request, password)[0]
+
+    if revocations.is_loaded():
+        return revocations.is_revoked(None, username, password, get_issued)
+    if revocations.cached:
+        return True
+    with xom.keyfs.read_transaction():
+        return revocations.is_revoked(
+            xom.keyfs, username, password, get_issued)
+
+
+# the identity devpi-server loaded in this thread, which is how the
+# tween gets the identity verified by the view of /+authcheck
+loaded_identity = threading.local()
+
+
+# the outcomes of /+authcheck which can be reused and their status codes
+cacheable_outcomes = {
+    'always_ok': 200,
+    '200': 200,
+    '401': 401,
+    '403': 403}
+
+
+def tween_authcheck(handler, registry):
+    cache = registry['lockdown_authcheck_cache']
+    max_age = registry['lockdown_nginx_cache_expiry']
+    metrics = registry['lockdown_metrics']
+    metrics_plugin = registry['lockdown_metrics_plugin']
+    renewal = registry['lockdown_cookie_renewal']
+    audit = registry['lockdown_audit']
+    identity_signer = registry['lockdown_identity_signer']
+    tracer = registry['lockdown_tracer']
+    profiler = registry['lockdown_profiler']
+    routes_mapper = registry.queryUtility(IRoutesMapper)
+    # decided on the first request, when all plugins are registered
+    fast_path = []
+
+    def authcheck_handler(request):
+        if request.path != '/+authcheck':
+            return handler(request)
+        url = request.headers.get('x-original-uri', request.url)
+        with profiler.profile('authcheck'), \
+                tracer.span('authcheck', uri=url) as span:
+            (outcome, identity) = (None, None)
+            if cache is not None:
+                with tracer.span('authcheck.cache'):
+                    key = get_authcheck_cache_key(request, routes_mapper)
+                    outcome = cache.get(key)
+                    if outcome == '200' and is_cached_verdict_revoked(request):
+                        outcome = None
+            if not fast_path:
+                fast_path.append(can_use_fast_path(registry['xom'].config.hook))
+            if outcome is None:
+                if fast_path[0]:
+                    with tracer.span('authcheck.fast_path'):
+                        (outcome, identity) = get_fast_authcheck_outcome(
+                            make_orig_request(request, url, routes_mapper))
+                if outcome is not None:
+                    metrics.inc('devpi_lockdown_authcheck_fast_path_total')
+                    if cache is not None:
+                        cache.put(key, outcome)
+            if outcome is None:
+                metrics_plugin.reset_always_ok()
+                loaded_identity.value = None
+                with tracer.span('authcheck.view'):
+                    response = handler(request)
+                identity = loaded_identity.value
+                outcome = str(response.status_code)
+                if outcome == '200' and metrics_plugin.is_always_ok():
+                    outcome = 'always_ok'
+                if cache is not None and outcome in cacheable_outcomes:
+                    cache.put(key, outcome)
+            else:
+                response = status_map[cacheable_outcomes[outcome]]()
+            delay = get_rate_limit_delay(request, outcome)
+            if delay:
+                outcome = '429'
+                response = HTTPTooManyRequests(
+                    headers={'Retry-After': str(math.ceil(delay))})
+            metrics.inc(
+                'devpi_lockdown_authcheck_requests_total',
+                (('outcome', outcome),))
+            if audit is not None:
+                audit.record(
+                    'authcheck',
+                    user=get_claimed_username(request),
+                    ip=get_remote_ip(request),
+                    uri=request.headers.get('x-original-uri'),
+                    outcome=outcome)
+            if max_age and outcome in cacheable_outcomes:
+                # allows nginx to reuse the verdict with proxy_cache
+                response.cache_control.max_age = max_age
+            if identity_signer is not None and outcome == '200':
+                if identity is None and fast_path[0]:
+                    # the verdict was cached
+                    identity = get_cached_identity(
+                        make_orig_request(request, url, routes_mapper))
+                if identity is not None:
+                    # nginx passes the header on with auth_request_set and
+                    # proxy_set_header
+                    response.headers[identity_header] = identity_signer.sign(
+                        identity, get_uri_path(url))
+            if renewal and outcome == '200' and 'auth_tkt' in request.cookies:
+                # nginx passes the header on with auth_request_set and add_header
+                response.headerlist.extend(
+                    get_renewed_cookie_headers(request, renewal))
+            span.set_attribute('outcome', outcome)
+        return response
+    return authcheck_handler
+
+
+def get_rate_limit_delay(request, outcome):
+    """Returns the seconds until the rate limit allows the request, or 0.
+
+    Requests with verified credentials are limited per user, all others
+    per client IP.
+    """
+    registry = request.registry
+    if outcome == '200':
+        limiter = registry.get('lockdown_user_rate_limiter')
+        if limiter is None:
+            return 0
+        # identities without credentials, like replicas, are limited
+        # per client IP
+        key = get_claimed_username(request) or get_remote_ip(request)
+        return limiter.acquire(key)
+    limiter = registry.get('lockdown_anonymous_rate_limiter')
+    if limiter is None:
+        return 0
+    return limiter.acquire(get_remote_ip(request))
+
+
+def get_claimed_username(request):
+    """Returns the username of the credentials of the request without
+    verifying them, for example for the audit log."""
+    hook = request.registry['xom'].config.hook
+    credentials = hook.devpiserver_get_credentials(request=request)
+    if credentials is None:
+        return None
+    return credentials[0]
+
+
+def renew_cookie(request, window):
+    """Returns a new value for the login cookie if it expires within
+    ``window`` seconds, otherwise None.
+
+    The new value has the same user and groups with a new expiration time.
+    Must be called outside of a keyfs transaction, as one is opened to
+    check that the user still exists before a cookie is renewed.
+    """
+    credentials = devpiserver_get_credentials(request)
+    if credentials is None:
+        return None
+    (username, password) = credentials
+    auth = get_security_policy(request.registry).auth
+    signer = request.registry.get('lockdown_cookie_signer')
+    now = time.time()
+    if signer is not None and password.startswith(signer.prefix + '.'):
+        claim = signer.verify(password, now=now)
+        if claim is None or claim.expires - now > window:
+            return None
+        if not user_exists(request.registry['xom'], username):
+            return None
+        return signer.sign(
+            username, claim.groups, now + auth.LOGIN_EXPIRATION)
+    try:
+        # a token which is still valid after the window isn't renewed yet
+        auth.serializer.loads(
+            password, max_age=max(auth.LOGIN_EXPIRATION - window, 0))
+    except itsdangerous.SignatureExpired:
+        pass
+    except itsdangerous.BadData:
+        return None
+    else:
+        return None
+    try:
+        (token_username, groups, from_user_object) = auth.serializer.loads(
+            password, max_age=auth.LOGIN_EXPIRATION)
+    except (itsdangerous.BadData, TypeError, ValueError):
+        return None
+    if token_username != username:
+        return None
+    if from_user_object and not user_exists(request.registry['xom'], username):
+        return None
+    token = auth.serializer.dumps([username, groups, from_user_object])
+    value = encode_compact(username, token, auth.serializer)
+    if value is None:
+        value = url_quote("%s:%s" % (username, token))
+    return value
+
+
+def user_exists(xom, username):
+    with xom.keyfs.read_transaction():
+        return bool(xom.keyfs.USER(user=username).get())
+
+
+def get_renewed_cookie_headers(request, window):
+    """Returns the Set-Cookie headers for a renewed login cookie."""
+    value = renew_cookie(request, window)
+    if value is None:
+        return []
+    auth = get_security_policy(request.registry).auth
+    profile = get_cookie_profile(request, auth.LOGIN_EXPIRATION)
+    return profile.get_headers(value)
+
+
+def find_http_injection_index(nginx_lines):
+    # find the server block
+    for index, line in enumerate(nginx_lines):
+        if line.startswith("server"):
+            return index
+    return 0
+
+
 def find_injection_index(nginx_lines):
     # find first location block
     for index, line in enumerate(nginx_lines):
@@ -57,16 +688,98 @@ def find_injection_index(nginx_lines):
         return index + 1
 
 
+nginx_http_cache_template = """
+# adjust the path for your system and the size (in keys_zone) to your liking,
+# the life time of verdicts is set by devpi-lockdown with Cache-Control
+proxy_cache_path /var/cache/nginx/devpi-lockdown levels=1:2 keys_zone=devpi_lockdown_authcheck:10m inactive={expiry}s use_temp_path=off;
+
+# devpi-client gets a 403 instead of a 401, so it needs its own cache entries
+map $http_user_agent $devpi_lockdown_client {{
+        default         0;
+        ~*devpi-client  1;
+}}
+
+""".lstrip()
+
+
+nginx_cache_template = """
+
+        # reuse verdicts for the same credentials and URI
+        proxy_cache devpi_lockdown_authcheck;
+        proxy_cache_key "$request_uri|$http_accept|$devpi_lockdown_client|$http_authorization|$http_x_devpi_auth|$http_x_devpi_replica_uuid|$cookie_auth_tkt";
+        proxy_cache_valid 200 401 403 {expiry}s;"""
+
+
+nginx_upstream_template = """
+# keep connections to {description} open
+upstream {name} {{
+        server {address};
+        keepalive {keepalive};
+}}
+
+""".lstrip()
+
+
+nginx_always_ok_template = """
+
+    # the locations which /+authcheck always allows, without a subrequest"""
+
+
+nginx_always_ok_location_template = """
+    location ~ "{regexp}" {{
+        auth_request off;
+{body}
+    }}
+"""
+
+
+nginx_cookie_renewal_template = """
+
+    # pass on login cookies renewed by /+authcheck
+    auth_request_set $devpi_lockdown_cookie $upstream_http_set_cookie;
+    add_header Set-Cookie $devpi_lockdown_cookie;"""
+
+
+nginx_too_many_requests_template = """
+
+    # nginx turns other status codes than 401 and 403 of /+authcheck into
+    # a 500, this passes on the 429 of rate limits and throttling and the
+    # 503 of the verification limit
+    auth_request_set $devpi_lockdown_status $upstream_status;
+    auth_request_set $devpi_lockdown_retry_after $upstream_http_retry_after;
+    error_page 500 = @error500;
+    location @error500 {
+        if ($devpi_lockdown_status = 429) {
+            add_header Retry-After $devpi_lockdown_retry_after always;
+            return 429;
+        }
+        if ($devpi_lockdown_status = 503) {
+            return 503;
+        }
+        return 500;
+    }"""
+
+
+nginx_identity_template = """
+
+    # pass on the identity verified by /+authcheck to devpi-server
+    auth_request_set $devpi_lockdown_identity $upstream_http_x_devpi_lockdown_identity;"""
+
+
+nginx_identity_header_line = (
+    "proxy_set_header X-Devpi-Lockdown-Identity $devpi_lockdown_identity;")
+
+
 nginx_template = """
     # this redirects to the login view when not logged in
     recursive_error_pages on;
     error_page 401 = @error401;
     location @error401 {{
         return 302 /+login?goto_url=$request_uri;
-    }}
+    }}{too_many_requests}
 
     # lock down everything by default
-    auth_request /+authcheck;
+    auth_request /+authcheck;{cookie_renewal}{identity}
 
     # the location to check whether the provided infos authenticate the user
     location = /+authcheck {{
@@ -77,12 +790,87 @@ nginx_template = """
         proxy_set_header X-Original-URI $request_uri;
         {x_outside_url}
         {x_real_ip}
-        {proxy_pass}
+        {proxy_pass}{proxy_cache}
     }}
     """.rstrip()
 
 
-def _inject_lockdown_config(nginx_lines):
+def find_location_body(nginx_lines, name):
+    """Returns the directives of a location block without comments."""
+    regexp = re.compile(r'\s*location\s+%s\s*{' % re.escape(name))
+    for (index, line) in enumerate(nginx_lines):
+        if regexp.match(line):
+            break
+    else:
+        return None
+    body = []
+    depth = 1
+    for line in nginx_lines[index + 1:]:
+        line = line.strip()
+        depth += line.count('{') - line.count('}')
+        if depth <= 0:
+            break
+        if line and not line.startswith('#'):
+            body.append(line)
+    return body
+
+
+def _use_upstream(nginx_lines, url, name, description, keepalive):
+    """Replaces proxy_pass of the URL with a keepalive upstream and returns
+    the http level lines of the upstream block."""
+    parts = urlsplit(url)
+    if not parts.netloc or parts.path not in ('', '/'):
+        # an upstream can't be used with a path
+        return []
+    regexp = re.compile(
+        r'^(\s*)proxy_pass\s+%s/?;(.*)$' % re.escape(url.rstrip('/')))
+    new_lines = []
+    for line in nginx_lines:
+        match = regexp.match(line)
+        if match is None:
+            new_lines.append(line)
+            continue
+        (indent, rest) = match.groups()
+        new_lines.extend([
+            "%sproxy_pass %s://%s;%s" % (indent, parts.scheme, name, rest),
+            "%sproxy_http_version 1.1;" % indent,
+            '%sproxy_set_header Connection "";' % indent])
+    nginx_lines[:] = new_lines
+    return nginx_upstream_template.format(
+        address=parts.netloc,
+        description=description,
+        keepalive=keepalive,
+        name=name).splitlines()
+
+
+def is_too_many_requests_possible(args):
+    return any(x > 0 for x in (
+        args.lockdown_rate_limit,
+        args.lockdown_anonymous_rate_limit,
+        args.lockdown_throttle_failures,
+        args.lockdown_verification_limit))
+
+
+def _forward_identity_header(nginx_lines):
+    """Adds the identity header to the requests proxied to devpi-server.
+
+    Without a verified identity the variable is empty and nginx drops
+    the header, also when a client sent one.
+    """
+    regexp = re.compile(r'^(\s*)location\s+@proxy_to_app\s*{')
+    for (index, line) in enumerate(nginx_lines):
+        match = regexp.match(line)
+        if match is not None:
+            indent = match.group(1) + "    "
+            nginx_lines.insert(
+                index + 1, "%s%s" % (indent, nginx_identity_header_line))
+            return
+
+
+def _inject_lockdown_config(nginx_lines, args):
+    if args.lockdown_identity_header_expiry > 0:
+        # before the directives are copied to the always allowed locations
+        _forward_identity_header(nginx_lines)
     # inject our parts before the first location block
     index = find_injection_index(nginx_lines)
 
@@ -93,10 +881,61 @@ def _inject_lockdown_config(nginx_lines):
                 return "%s # same as in @proxy_to_app below" % line.strip()
         return "couldn't find %r" % content
 
-    nginx_lines[index:index] = nginx_template.format(
+    http_lines = []
+    app_url = None
+    for line in nginx_lines:
+        match = re.search(r'proxy_pass\s+([^;\s]+);', line)
+        if match is not None:
+            app_url = match.group(1)
+            break
+    proxy_cache = ""
+    if args.lockdown_nginx_cache_expiry > 0:
+        expiry = args.lockdown_nginx_cache_expiry
+        http_lines.extend(
+            nginx_http_cache_template.format(expiry=expiry).splitlines())
+        proxy_cache = nginx_cache_template.format(expiry=expiry)
+    if args.lockdown_authcheck_url:
+        # the standalone devpi-lockdown-authcheck server
+        proxy_pass = "proxy_pass %s;" % args.lockdown_authcheck_url.rstrip('/')
+    else:
+        proxy_pass = find_line("proxy_pass")
+    lockdown_config = [nginx_template.format(
         x_outside_url=find_line("proxy_set_header.+x-outside-url"),
         x_real_ip=find_line("proxy_set_header.+x-real-ip"),
-        proxy_pass=find_line("proxy_pass")).splitlines()
+        proxy_pass=proxy_pass,
+        proxy_cache=proxy_cache,
+        cookie_renewal=(
+            nginx_cookie_renewal_template
+            if args.lockdown_cookie_renewal > 0 else ""),
+        too_many_requests=(
+            nginx_too_many_requests_template
+            if is_too_many_requests_possible(args) else ""),
+        identity=(
+            nginx_identity_template
+            if args.lockdown_identity_header_expiry > 0 else ""))]
+    app_body = find_location_body(nginx_lines, '@proxy_to_app')
+    if app_body:
+        # proxy the always allowed locations directly
+        lockdown_config.append(nginx_always_ok_template)
+        for (pattern, url_marker, location) in default_always_ok_patterns:
+            lockdown_config.append(nginx_always_ok_location_template.format(
+                regexp=location,
+                body="\n".join("        %s" % x for x in app_body)))
+    nginx_lines[index:index] = "".join(lockdown_config).splitlines()
+    if args.lockdown_nginx_keepalive > 0:
+        if app_url is not None:
+            http_lines.extend(_use_upstream(
+                nginx_lines, app_url, 'devpi_lockdown_app', 'devpi-server',
+                args.lockdown_nginx_keepalive))
+        if args.lockdown_authcheck_url:
+            http_lines.extend(_use_upstream(
+                nginx_lines, args.lockdown_authcheck_url,
+                'devpi_lockdown_authcheck', 'devpi-lockdown-authcheck',
+                args.lockdown_nginx_keepalive))
+    if http_lines:
+        # inject the http level parts before the server block
+        index = find_http_injection_index(nginx_lines)
+        nginx_lines[index:index] = http_lines
 
 
 @devpiserver_hookimpl(optionalhook=True)
@@ -110,30 +949,387 @@ def devpiserver_genconfig(tw, config, argv, writer):
         nginx_lines.extend(content.splitlines())
 
     gen_nginx(tw, config, argv, my_writer)
-    _inject_lockdown_config(nginx_lines)
+    _inject_lockdown_config(nginx_lines, config.args)
 
     # and write it out
     nginxconf = "\n".join(nginx_lines)
     writer("nginx-devpi-lockdown.conf", nginxconf)
 
 
+@devpiserver_hookimpl
+def devpiserver_add_parser_options(parser):
+    lockdown = parser.addgroup("devpi-lockdown options")
+    lockdown.addoption(
+        "--lockdown-authcheck-cache-expiry", type=int, metavar="SECONDS",
+        default=0,
+        help="reuse the verdict of /+authcheck for the same credentials "
+             "and route for SECONDS. Revocations of cookies and tokens are "
+             "checked before a verdict is reused. "
+             "By default verdicts are not cached.")
+    lockdown.addoption(
+        "--lockdown-authcheck-cache-size", type=int, metavar="NUM",
+        default=10000,
+        help="maximum number of cached /+authcheck verdicts.")
+    lockdown.addoption(
+        "--lockdown-authcheck-cache-path", type=str, metavar="PATH",
+        help="file to share cached /+authcheck verdicts between all "
+             "devpi-server processes using the same file. "
+             "By default each process has its own cache.")
+    lockdown.addoption(
+        "--lockdown-credential-cache-expiry", type=int, metavar="SECONDS",
+        default=0,
+        help="remember successfully verified credentials like those of "
+             "HTTP Basic auth for SECONDS, to skip the expensive password "
+             "hash check. Changing a user invalidates its entries. "
+             "By default credentials are always verified.")
+    lockdown.addoption(
+        "--lockdown-credential-cache-size", type=int, metavar="NUM",
+        default=1000,
+        help="maximum number of remembered credential verifications.")
+    lockdown.addoption(
+        "--lockdown-throttle-failures", type=int, metavar="NUM",
+        default=0,
+        help="number of failed logins or credential verifications "
+             "allowed in a row per username and per client IP, further "
+             "attempts are rejected with 429 without checking the "
+             "password. One more attempt is allowed after each "
+             "--lockdown-throttle-interval. "
+             "By default failed attempts are not throttled.")
+    lockdown.addoption(
+        "--lockdown-throttle-interval", type=int, metavar="SECONDS",
+        default=60,
+        help="time after which another failed attempt is allowed.")
+    lockdown.addoption(
+        "--lockdown-verification-limit", type=int, metavar="NUM",
+        default=0,
+        help="maximum number of password hash checks for logins and "
+             "credential verifications at the same time. "
+             "By default there is no limit.")
+    lockdown.addoption(
+        "--lockdown-verification-queue", type=int, metavar="NUM",
+        default=10,
+        help="number of password hash checks which wait for one of "
+             "--lockdown-verification-limit, further ones are rejected "
+             "with 503.")
+    lockdown.addoption(
+        "--lockdown-rate-limit", type=float, metavar="NUM",
+        default=0,
+        help="maximum number of requests per second of each authenticated "
+             "user, enforced by /+authcheck. Further requests are "
+             "rejected with 429. By default requests are not limited.")
+    lockdown.addoption(
+        "--lockdown-anonymous-rate-limit", type=float, metavar="NUM",
+        default=0,
+        help="maximum number of requests per second of each client IP "
+             "for requests without valid credentials, enforced by "
+             "/+authcheck. By default requests are not limited.")
+    lockdown.addoption(
+        "--lockdown-rate-limit-burst", type=int, metavar="NUM",
+        default=100,
+        help="number of requests a user or client IP can make at once "
+             "before --lockdown-rate-limit or "
+             "--lockdown-anonymous-rate-limit applies.")
+    lockdown.addoption(
+        "--lockdown-cookie-keys", type=str, metavar="PATH",
+        help="file with keys to sign the login cookie, one key id and "
+             "secret separated by whitespace per line. "
+             "The signed cookie holds the user and expiration time, so "
+             "/+authcheck can verify it without looking up the user. "
+             "The first key signs new cookies, the others are still "
+             "accepted to allow key rotation.")
+    lockdown.addoption(
+        "--lockdown-cookie-renewal", type=int, metavar="SECONDS",
+        default=0,
+        help="let /+authcheck send a renewed login cookie when the "
+             "current one expires within SECONDS, so active users stay "
+             "logged in. The generated nginx configuration passes the "
+             "cookie on. By default cookies are not renewed.")
+    lockdown.addoption(
+        "--lockdown-identity-header-expiry", type=int, metavar="SECONDS",
+        default=0,
+        help="let /+authcheck return the verified identity in a signed "
+             "header valid for SECONDS, which the generated nginx "
+             "configuration passes on to devpi-server, so the credentials "
+             "aren't verified again. The key is derived from the secret "
+             "of devpi-server. By default no identity header is used.")
+    lockdown.addoption(
+        "--lockdown-audit-log", type=str, metavar="PATH",
+        help="file to which /+authcheck verdicts, logins and logouts are "
+             "written as JSON lines by a background thread. "
+             "By default there is no audit log.")
+    lockdown.addoption(
+        "--lockdown-audit-log-size", type=int, metavar="BYTES",
+        default=10 * 1024 * 1024,
+        help="size at which the audit log is rotated.")
+    lockdown.addoption(
+        "--lockdown-audit-log-backups", type=int, metavar="NUM",
+        default=5,
+        help="number of rotated audit logs which are kept.")
+    lockdown.addoption(
+        "--lockdown-audit-queue", type=int, metavar="NUM",
+        default=10000,
+        help="maximum number of audit records waiting to be written, "
+             "further records are dropped and counted in the metrics.")
+    lockdown.addoption(
+        "--lockdown-trace-file", type=str, metavar="PATH",
+        help="file to which the timings of the authentication stages of "
+             "/+authcheck and /+login are written as JSON lines by a "
+             "background thread, rotated like the audit log. "
+             "By default nothing is traced.")
+    lockdown.addoption(
+        "--lockdown-profile-dir", type=str, metavar="PATH",
+        help="directory to which cProfile statistics of slow /+authcheck "
+             "and /+login requests are written as .prof files. "
+             "By default no requests are profiled.")
+    lockdown.addoption(
+        "--lockdown-profile-fraction", type=float, metavar="NUM",
+        default=0.01,
+        help="fraction of the requests which are profiled, "
+             "between 0 and 1. Only one request is profiled at a time.")
+    lockdown.addoption(
+        "--lockdown-profile-threshold", type=float, metavar="SECONDS",
+        default=0.1,
+        help="minimum duration of a profiled request for its statistics "
+             "to be kept.")
+    lockdown.addoption(
+        "--lockdown-profile-keep", type=int, metavar="NUM",
+        default=100,
+        help="number of profiles which are kept, older ones are removed.")
+    lockdown.addoption(
+        "--lockdown-authcheck-url", type=str, metavar="URL",
+        help="URL of a devpi-lockdown-authcheck server, which the "
+             "generated nginx configuration uses for /+authcheck instead "
+             "of devpi-server, for example http://localhost:3142.")
+    lockdown.addoption(
+        "--lockdown-nginx-keepalive", type=int, metavar="NUM",
+        default=16,
+        help="number of idle connections each nginx worker process keeps "
+             "open to devpi-server and devpi-lockdown-authcheck in the "
+             "generated nginx configuration. "
+             "Use 0 to open a new connection per request.")
+    lockdown.addoption(
+        "--lockdown-nginx-cache-expiry", type=int, metavar="SECONDS",
+        default=0,
+        help="let nginx reuse the verdict of /+authcheck for SECONDS. "
+             "The generated nginx configuration then contains a "
+             "proxy_cache zone for /+authcheck and devpi-server sends "
+             "a matching Cache-Control header. Revoked cookies and tokens "
+             "are accepted by nginx until the verdict expired. "
+             "By default nginx doesn't cache verdicts.")
+
+
 @devpiserver_hookimpl
 def devpiserver_pyramid_configure(config, pyramid_config):
+    cache = None
+    if config.args.lockdown_authcheck_cache_expiry > 0:
+        if config.args.lockdown_authcheck_cache_path:
+            cache = SharedVerdictCache(
+                config.args.lockdown_authcheck_cache_path,
+                config.args.lockdown_authcheck_cache_size,
+                default_timeout=config.args.lockdown_authcheck_cache_expiry)
+        else:
+            cache = ExpiringLRUCache(
+                config.args.lockdown_authcheck_cache_size,
+                default_timeout=config.args.lockdown_authcheck_cache_expiry)
+    pyramid_config.registry['lockdown_authcheck_cache'] = cache
+    pyramid_config.registry['lockdown_nginx_cache_expiry'] = (
+        config.args.lockdown_nginx_cache_expiry)
+    credential_cache = None
+    if config.args.lockdown_credential_cache_expiry > 0:
+        credential_cache = CredentialCache(
+            config.args.lockdown_credential_cache_size,
+            config.args.lockdown_credential_cache_expiry)
+        if config.requests_only:
+            threadlog.warn(
+                "Without the event processing of --requests-only changes "
+                "to users only take effect once remembered credentials "
+                "expired.")
+    pyramid_config.registry['lockdown_credential_cache'] = credential_cache
+    pyramid_config.registry['lockdown_throttle'] = make_throttle(config)
+    pyramid_config.registry['lockdown_verification_limiter'] = (
+        make_verification_limiter(config))
+    (user_rate_limiter, anonymous_rate_limiter) = make_rate_limiters(config)
+    pyramid_config.registry['lockdown_user_rate_limiter'] = user_rate_limiter
+    pyramid_config.registry['lockdown_anonymous_rate_limiter'] = (
+        anonymous_rate_limiter)
+    read_acls = ReadACLTable(cached=not config.requests_only)
+    pyramid_config.registry['lockdown_read_acls'] = read_acls
+    api_keys = ApiKeyTable(cached=not config.requests_only)
+    pyramid_config.registry['lockdown_api_keys'] = api_keys
+    revocations = RevocationTable(cached=not config.requests_only)
+    pyramid_config.registry['lockdown_revocations'] = revocations
+    if not config.requests_only:
+        # the tables are all derived from the user configuration, so one
+        # handler updates them, revoked tokens first
+        user_tables = [
+            x for x in (revocations, credential_cache, api_keys, read_acls)
+            if x is not None]
+
+        def on_userchange(ev):
+            for table in user_tables:
+                table.on_userchange(ev)
+
+        xom = pyramid_config.registry['xom']
+        xom.keyfs.USER.on_key_change(on_userchange)
+    signer = None
+    if config.args.lockdown_cookie_keys:
+        try:
+            signer = CookieSigner.from_file(config.args.lockdown_cookie_keys)
+        except (InvalidKeys, OSError) as e:
+            threadlog.error(
+                "The cookie keys in '%s' can't be used: %s" % (
+                    config.args.lockdown_cookie_keys, e))
+            sys.exit(1)
+    pyramid_config.registry['lockdown_cookie_signer'] = signer
+    pyramid_config.registry['lockdown_cookie_renewal'] = (
+        config.args.lockdown_cookie_renewal)
+    pyramid_config.registry['lockdown_identity_signer'] = (
+        make_identity_signer(config))
+    pyramid_config.registry['lockdown_audit'] = make_audit_log(
+        config, pyramid_config.registry['xom'])
+    metrics = Metrics()
+    metrics.describe(
+        'devpi_lockdown_authcheck_requests_total', 'counter',
+        "Number of /+authcheck requests by outcome.")
+    metrics.describe(
+        'devpi_lockdown_authcheck_fast_path_total', 'counter',
+        "Number of /+authcheck requests decided without a keyfs "
+        "transaction.")
+    metrics.describe(
+        'devpi_lockdown_credentials_extraction_seconds', 'histogram',
+        "Time to extract credentials from a request.")
+    metrics.describe(
+        'devpi_lockdown_credentials_verification_seconds', 'histogram',
+        "Time to verify credentials and load the identity.")
+    metrics.describe(
+        'devpi_lockdown_login_total', 'counter',
+        "Number of login attempts by result.")
+    tracer = Tracer(make_trace_exporter(config, pyramid_config.registry['xom']))
+    pyramid_config.registry['lockdown_tracer'] = tracer
+    pyramid_config.registry['lockdown_profiler'] = make_profiler(config)
+    metrics_plugin = MetricsPlugin(metrics, tracer)
+    config.pluginmanager.register(metrics_plugin)
+    pyramid_config.registry['lockdown_metrics'] = metrics
+    pyramid_config.registry['lockdown_metrics_plugin'] = metrics_plugin
     # by using include, the package name doesn't need to be set explicitly
     # for registrations of static views etc
     pyramid_config.include('devpi_lockdown.main')
 
 
+def make_identity_signer(config):
+    """Returns the signer of identity headers or None if not configured."""
+    if config.args.lockdown_identity_header_expiry <= 0:
+        return None
+    return IdentitySigner(
+        config.get_derived_key(b'devpi-lockdown-identity'),
+        config.args.lockdown_identity_header_expiry)
+
+
+def make_throttle(config):
+    """Returns the throttle of failed logins, or None if not configured."""
+    if config.args.lockdown_throttle_failures <= 0:
+        return None
+    return FailureThrottle(
+        config.args.lockdown_throttle_failures,
+        config.args.lockdown_throttle_interval)
+
+
+def make_verification_limiter(config):
+    """Returns the limiter of password hash checks, or None if not
+    configured."""
+    if config.args.lockdown_verification_limit <= 0:
+        return None
+    return VerificationLimiter(
+        config.args.lockdown_verification_limit,
+        config.args.lockdown_verification_queue)
+
+
+def make_rate_limiters(config):
+    """Returns the rate limiters for users and for anonymous client IPs,
+    each None if not configured."""
+    burst = config.args.lockdown_rate_limit_burst
+    limiters = []
+    for rate in (
+            config.args.lockdown_rate_limit,
+            config.args.lockdown_anonymous_rate_limit):
+        limiters.append(RateLimiter(rate, burst) if rate > 0 else None)
+    return tuple(limiters)
+
+
+def make_audit_log(config, xom, path=None):
+    """Returns the audit log with its writer registered in the thread pool
+    of the xom, or None if not configured."""
+    if path is None:
+        path = config.args.lockdown_audit_log
+    if not path:
+        return None
+    audit = AuditLog(
+        path,
+        config.args.lockdown_audit_log_size,
+        config.args.lockdown_audit_log_backups,
+        size=config.args.lockdown_audit_queue)
+    xom.thread_pool.register(audit)
+    return audit
+
+
+def make_trace_exporter(config, xom):
+    """Returns the exporter for --lockdown-trace-file or None."""
+    if not config.args.lockdown_trace_file:
+        return None
+    return JsonLinesExporter(
+        make_audit_log(config, xom, path=config.args.lockdown_trace_file))
+
+
+def make_profiler(config):
+    """Returns the profiler for --lockdown-profile-dir."""
+    if not config.args.lockdown_profile_dir:
+        return null_profiler
+    if config.args.lockdown_profile_fraction <= 0:
+        return null_profiler
+    return SlowRequestProfiler(
+        config.args.lockdown_profile_dir,
+        config.args.lockdown_profile_fraction,
+        config.args.lockdown_profile_threshold,
+        config.args.lockdown_profile_keep)
+
+
 @devpiserver_hookimpl
 def devpiserver_get_credentials(request):
-    """Extracts username and password from cookie.
+    """Extracts username and password from cookie, an API key from the
+    Authorization header with the Bearer scheme or the identity signed
+    by /+authcheck.
 
     Returns a tuple with (username, password) if credentials could be
     extracted, or None if no credentials were found.
     """
+    with get_tracer(request.registry).span('credentials.lockdown'):
+        return get_lockdown_credentials(request)
+
+
+def get_lockdown_credentials(request):
+    identity = get_trusted_identity(request)
+    if identity is not None:
+        return identity.username, request.headers[identity_header]
+    authorization = request.authorization
+    if authorization and authorization.authtype.lower() == 'bearer':
+        key = authorization.params
+        username = get_api_key_username(key) if isinstance(key, str) else None
+        if username is not None:
+            return username, key
     cookie = request.cookies.get('auth_tkt')
     if cookie is None:
         return
+    signer = request.registry.get('lockdown_cookie_signer')
+    if signer is not None and cookie.startswith(signer.prefix + '.'):
+        claim = signer.verify(cookie)
+        if claim is None:
+            return None
+        return claim.username, cookie
+    if cookie.startswith(compact_prefix + '.'):
+        credentials = decode_compact(
+            cookie, get_security_policy(request.registry).auth.serializer)
+        if credentials is not None:
+            return credentials
     token = url_unquote(cookie)
     try:
         username, password = token.split(':', 1)
@@ -143,15 +1339,214 @@ def devpiserver_get_credentials(request):
 
 
 @devpiserver_hookimpl(optionalhook=True)
-def devpiserver_authcheck_always_ok(request):
-    route = request.matched_route
-    if route and route.name.endswith('/+api'):
+def devpiserver_get_identity(request, credentials):
+    """Returns the identity for a signed cookie, an API key or remembered
+    credentials.
+
+    For other credentials None is returned, so the regular devpi
+    verification is used.
+    """
+    if credentials is None:
+        return None
+    (username, password) = credentials
+    identity = get_trusted_identity(request)
+    if identity is not None and password == request.headers[identity_header]:
+        # /+authcheck already verified the credentials of this request
+        return identity
+    if is_revoked(request, username, password):
+        raise HTTPUnauthorized()
+    signer = request.registry.get('lockdown_cookie_signer')
+    if signer is not None and password.startswith(signer.prefix + '.'):
+        claim = signer.verify(password)
+        if claim is None or claim.username != username:
+            return None
+        return CredentialsIdentity(claim.username, claim.groups)
+    api_keys = request.registry.get('lockdown_api_keys')
+    if api_keys is not None and is_api_key(password):
+        api_key = api_keys.get(
+            request.registry['xom'].keyfs, username, password)
+        if api_key is not None:
+            return ApiKeyIdentity(
+                username, api_key.groups, api_key.keyid, api_key.indexes)
+    credential_cache = request.registry.get('lockdown_credential_cache')
+    if credential_cache is not None:
+        key = credential_cache.get_key(username, password)
+        groups = credential_cache.get(key, username)
+        if groups is not None:
+            return CredentialsIdentity(username, groups)
+    throttle = request.registry.get('lockdown_throttle')
+    if throttle is not None:
+        ip = get_remote_ip(request)
+        if throttle.is_throttled(username, ip):
+            # reject before the expensive regular verification
+            raise HTTPTooManyRequests()
+        request.environ['devpi_lockdown.throttle'] = (username, ip)
+    limiter = request.registry.get('lockdown_verification_limiter')
+    hashing = False
+    if limiter is not None or credential_cache is not None:
+        hashing = needs_hashing(request, password)
+    if limiter is not None and hashing:
+        try:
+            limiter.acquire()
+        except Saturated:
+            raise HTTPServiceUnavailable()
+        # released after the regular verification
+        request.environ['devpi_lockdown.verification_limiter'] = limiter
+        request.add_finished_callback(release_verification_slot)
+    if credential_cache is not None and hashing:
+        # remember the key, so devpiserver_identity_loaded can store
+        # the result of the regular verification, login tokens are cheap
+        # to verify and expire on their own
+        request.environ['devpi_lockdown.credential_key'] = (
+            key, username, credential_cache.get_generation(username))
+    return None
+
+
+def get_trusted_identity(request):
+    """Returns the identity from a valid header signed by /+authcheck."""
+    signer = request.registry.get('lockdown_identity_signer')
+    if signer is None:
+        return None
+    value = request.headers.get(identity_header)
+    if not value:
+        return None
+    if 'devpi_lockdown.trusted_identity' not in request.environ:
+        request.environ['devpi_lockdown.trusted_identity'] = signer.verify(
+            value, get_uri_path(request.path))
+    return request.environ['devpi_lockdown.trusted_identity']
+
+
+def get_security_policy(registry):
+    policy = registry.queryUtility(IAuthenticationPolicy)
+    if policy is None:
+        policy = registry.getUtility(ISecurityPolicy)
+    return policy
+
+
+def is_revoked(request, username, token):
+    revocations = request.registry.get('lockdown_revocations')
+    if revocations is None:
+        return False
+    return revocations.is_revoked(
+        request.registry['xom'].keyfs, username, token,
+        lambda: get_token_times(request, token)[0])
+
+
+def get_token_times(request, token):
+    """Returns the time a signed cookie or login token was issued and
+    when it expires, or a tuple of None for other credentials."""
+    return get_token_claim(request, token)[1:]
+
+
+def get_token_claim(request, token):
+    """Returns the username a signed cookie or login token was issued for,
+    the time it was issued and when it expires, or a tuple of None for
+    other credentials."""
+    auth = get_security_policy(request.registry).auth
+    signer = request.registry.get('lockdown_cookie_signer')
+    if signer is not None and token.startswith(signer.prefix + '.'):
+        claim = signer.verify(token)
+        if claim is None:
+            return (None, None, None)
+        return (
+            claim.username, claim.expires - auth.LOGIN_EXPIRATION,
+            claim.expires)
+    try:
+        (payload, timestamp) = auth.serializer.loads(
+            token, max_age=auth.LOGIN_EXPIRATION, return_timestamp=True)
+    except itsdangerous.BadData:
+        return (None, None, None)
+    if not isinstance(payload, list) or not payload:
+        return (None, None, None)
+    issued = timestamp.timestamp()
+    return (payload[0], issued, issued + auth.LOGIN_EXPIRATION)
+
+
+def needs_hashing(request, password):
+    """Returns whether the regular verification of the password checks
+    the password hash, which isn't needed for login tokens."""
+    if is_api_key(password):
+        # rejected by devpiserver_auth_request
+        return False
+    auth = get_security_policy(request.registry).auth
+    try:
+        auth.serializer.loads(password, max_age=auth.LOGIN_EXPIRATION)
+    except itsdangerous.SignatureExpired:
+        return False
+    except itsdangerous.BadData:
         return True
-    if route and route.name in ('/+login', 'login', 'logout'):
+    return False
+
+
+def release_verification_slot(request):
+    limiter = request.environ.pop('devpi_lockdown.verification_limiter', None)
+    if limiter is not None:
+        limiter.release()
+
+
+@devpiserver_hookimpl(optionalhook=True)
+def devpiserver_identity_loaded(request, credential_plugin_name, identity_plugin_name, identity):
+    loaded_identity.value = identity
+    release_verification_slot(request)
+    throttled = request.environ.pop('devpi_lockdown.throttle', None)
+    if throttled is not None and identity is None:
+        request.registry['lockdown_throttle'].failure(*throttled)
+    pending = request.environ.pop('devpi_lockdown.credential_key', None)
+    if pending is None or identity is None:
+        return
+    (key, username, generation) = pending
+    if identity.username != username:
+        return
+    credential_cache = request.registry['lockdown_credential_cache']
+    credential_cache.put(key, username, identity.groups, generation)
+
+
+@devpiserver_hookimpl(optionalhook=True)
+def devpiserver_auth_request(request, userdict, username, password):
+    """Rejects API keys which weren't found by devpiserver_get_identity,
+    so they are never checked against the password hash."""
+    if is_api_key(password):
+        return dict(status="reject")
+
+
+@devpiserver_hookimpl(optionalhook=True)
+def devpiserver_auth_denials(request, acl, user, stage):
+    """Denies everything outside of the indexes an API key is restricted
+    to."""
+    indexes = getattr(request.identity, 'indexes', None)
+    if indexes is None:
+        return
+    if stage is not None and stage.name in indexes:
+        return
+    username = request.identity.username
+    return [(username, permission) for (action, principal, permission) in acl]
+
+
+@devpiserver_hookimpl(optionalhook=True)
+def devpiserver_authcheck_always_ok(request):
+    classifier = request.registry['lockdown_always_ok']
+    if classifier.is_always_ok(request):
         return True
-    if route and '+static' in route.name and '/+static' in request.url:
+
+
+@devpiserver_hookimpl(optionalhook=True)
+def devpiserver_authcheck_forbidden(request):
+    """Forbids indexes whose ``lockdown_acl_read`` option, or that of
+    one of their bases, doesn't allow the user."""
+    matchdict = request.matchdict or {}
+    (user, index) = (matchdict.get('user'), matchdict.get('index'))
+    if not user or not index:
+        return
+    identity = request.identity
+    if identity is None:
+        # devpiserver_authcheck_unauthorized takes care of this
+        return
+    index = index.rstrip('/')
+    if not in_scope(identity, "%s/%s" % (user, index)):
         return True
-    if route and '+theme-static' in route.name and '/+theme-static' in request.url:
+    read_acls = request.registry['lockdown_read_acls']
+    if not read_acls.permits(
+            request.registry['xom'].keyfs, identity, user, index):
         return True
 
 
@@ -161,6 +1556,50 @@ def devpiserver_authcheck_unauthorized(request):
         return True
 
 
+@devpiserver_hookimpl
+def devpiserver_indexconfig_defaults(index_type):
+    return {"lockdown_acl_read": ACLList([':AUTHENTICATED:'])}
+
+
+@devpiserver_hookimpl(optionalhook=True)
+def devpiserver_metrics(request):
+    result = []
+    cache = request.registry.get('lockdown_authcheck_cache')
+    if cache is not None:
+        result.extend([
+            ('devpi_lockdown_authcheck_cache_evictions', 'counter', cache.evictions),
+            ('devpi_lockdown_authcheck_cache_hits', 'counter', cache.hits),
+            ('devpi_lockdown_authcheck_cache_lookups', 'counter', cache.lookups),
+            ('devpi_lockdown_authcheck_cache_misses', 'counter', cache.misses),
+            ('devpi_lockdown_authcheck_cache_size', 'gauge', cache.size)])
+    audit = request.registry.get('lockdown_audit')
+    if audit is not None:
+        result.extend([
+            ('devpi_lockdown_audit_dropped', 'counter', audit.dropped),
+            ('devpi_lockdown_audit_queued', 'gauge', audit.queue.qsize()),
+            ('devpi_lockdown_audit_written', 'counter', audit.written)])
+    limiter = request.registry.get('lockdown_verification_limiter')
+    if limiter is not None:
+        result.extend([
+            ('devpi_lockdown_verification_pending', 'gauge', limiter.pending),
+            ('devpi_lockdown_verification_rejected', 'counter', limiter.rejected)])
+    credential_cache = request.registry.get('lockdown_credential_cache')
+    if credential_cache is not None:
+        cache = credential_cache.cache
+        result.extend([
+            ('devpi_lockdown_credential_cache_evictions', 'counter', cache.evictions),
+            ('devpi_lockdown_credential_cache_hits', 'counter', cache.hits),
+            ('devpi_lockdown_credential_cache_lookups', 'counter', cache.lookups),
+            ('devpi_lockdown_credential_cache_misses', 'counter', cache.misses),
+            ('devpi_lockdown_credential_cache_size', 'gauge', cache.size)])
+    profiler = request.registry.get('lockdown_profiler')
+    if isinstance(profiler, SlowRequestProfiler):
+        result.extend([
+            ('devpi_lockdown_profiles_sampled', 'counter', profiler.sampled),
+            ('devpi_lockdown_profiles_saved', 'counter', profiler.saved)])
+    return result
+
+
 def get_cookie_profile(request, max_age=0):
     return CookieProfile(
         'auth_tkt',
@@ -170,41 +1609,103 @@ def get_cookie_profile(request, max_age=0):
         serializer=SimpleSerializer()).bind(request)
 
 
+def record_login(request, user, result):
+    request.registry['lockdown_metrics'].inc(
+        'devpi_lockdown_login_total', (('result', result),))
+    get_tracer(request.registry).set_attribute('result', result)
+    audit = request.registry.get('lockdown_audit')
+    if audit is not None:
+        audit.record(
+            'login', user=user, ip=get_remote_ip(request), result=result)
+
+
 @view_config(
     route_name="login",
     renderer="templates/login.pt")
 def login_view(context, request):
-    policy = request.registry.queryUtility(IAuthenticationPolicy)
-    if policy is None:
-        policy = request.registry.getUtility(ISecurityPolicy)
+    with request.registry['lockdown_profiler'].profile('login'), \
+            get_tracer(request.registry).span('login'):
+        return login(request)
+
+
+def login(request):
+    policy = get_security_policy(request.registry)
+    throttle = request.registry.get('lockdown_throttle')
+    tracer = get_tracer(request.registry)
     error = None
     if 'submit' in request.POST:
         user = request.POST['username']
         password = request.POST['password']
-        if is_atleast_server6:
-            token = policy.auth.new_proxy_auth(user, password, request=request)
-        else:
-            token = policy.auth.new_proxy_auth(user, password)
+        ip = get_remote_ip(request)
+        if throttle is not None and throttle.is_throttled(user, ip):
+            request.response.status_code = 429
+            record_login(request, user, 'throttled')
+            return dict(error="Too many failed logins, try again later")
+        limiter = request.registry.get('lockdown_verification_limiter')
+        try:
+            if limiter is not None:
+                with tracer.span('login.limiter'):
+                    limiter.acquire()
+        except Saturated:
+            request.response.status_code = 503
+            record_login(request, user, 'unavailable')
+            return dict(error="Too many logins at once, try again later")
+        try:
+            with tracer.span('login.verify'):
+                if is_atleast_server6:
+                    token = policy.auth.new_proxy_auth(
+                        user, password, request=request)
+                else:
+                    token = policy.auth.new_proxy_auth(user, password)
+        finally:
+            if limiter is not None:
+                limiter.release()
+        signer = request.registry.get('lockdown_cookie_signer')
+        if signer is None and token and is_revoked(
+                request, user, token['password']):
+            # login tokens only have a resolution of seconds, so the same
+            # token was issued and revoked within this second, signed
+            # cookies are unique
+            request.response.status_code = 429
+            request.response.headers['Retry-After'] = '1'
+            record_login(request, user, 'throttled')
+            return dict(error="Logged out just now, try again in a second")
         if token:
             profile = get_cookie_profile(
                 request,
                 token['expiration'])
-            cookie_value = url_quote("%s:%s" % (user, token['password']))
+            cookie_value = encode_compact(
+                user, token['password'], policy.auth.serializer)
+            if cookie_value is None:
+                cookie_value = url_quote("%s:%s" % (user, token['password']))
             # set the credentials on the current request
             request.cookies[profile.cookie_name] = cookie_value
             # coherence check of the generated credentials
-            if user != request.authenticated_userid:
+            with tracer.span('login.authenticate'):
+                authenticated_userid = request.authenticated_userid
+            if user != authenticated_userid:
                 request.response.status_code = 401
                 error = "user %r could not be authenticated" % user
+                record_login(request, user, 'failure')
                 return dict(error=error)
             # it is possible that a plugin removes the permission to login
             # the permission was added in 6.0.0
-            if is_atleast_server6 and not request.has_permission('user_login'):
+            if is_atleast_server6:
+                with tracer.span('login.has_permission'):
+                    permitted = request.has_permission('user_login')
+            else:
+                permitted = True
+            if not permitted:
                 request.response.status_code = 401
                 error = (
                     "user %r has no permission to login with the "
                     "provided credentials" % user)
+                record_login(request, user, 'failure')
                 return dict(error=error)
+            if signer is not None:
+                cookie_value = signer.sign(
+                    user, request.identity.groups,
+                    time.time() + token['expiration'])
             headers = profile.get_headers(cookie_value)
             app_url = URL(request.application_url)
             url = app_url.joinpath(request.GET.get('goto_url'))
@@ -215,10 +1716,14 @@ def login_view(context, request):
                 url = request.route_url('/')
             else:
                 url = url.url
+            record_login(request, user, 'success')
             return HTTPFound(location=url, headers=headers)
         else:
+            if throttle is not None:
+                throttle.failure(user, ip)
             request.response.status_code = 401
             error = "Invalid credentials"
+            record_login(request, user, 'failure')
     return dict(error=error)
 
 
@@ -232,9 +1737,179 @@ def logout_get_view(context, request):
 
 @view_config(
     route_name="logout",
-    request_method="POST",
-    is_mutating=False)
+    request_method="POST")
 def logout_post_view(context, request):
+    try:
+        identity = request.identity
+    except HTTPUnauthorized:
+        # the cookie was already revoked, but still has to be dropped
+        identity = None
+    audit = request.registry.get('lockdown_audit')
+    if audit is not None:
+        audit.record(
+            'logout', user=None if identity is None else identity.username,
+            ip=get_remote_ip(request))
+    credentials = devpiserver_get_credentials(request)
+    if credentials is not None and identity is not None:
+        (username, token) = credentials
+        (owner, issued, expires) = get_token_claim(request, token)
+        # only the verified owner of the token can revoke it, as the
+        # logout is always allowed
+        if owner == username == identity.username and expires is not None:
+            # a copy of the cookie can't be used anymore
+            revoke_token(
+                request.registry['xom'].keyfs, username, token, expires)
     profile = get_cookie_profile(request)
     headers = profile.get_headers(None)
     return HTTPFound(location=request.route_url('/'), headers=headers)
+
+
+@view_config(
+    route_name="lockdown-revoke",
+    request_method="POST")
+def revoke_view(context, request):
+    """Revokes all login cookies and tokens of a user issued until now."""
+    username = request.matchdict['user']
+    keyfs = request.registry['xom'].keyfs
+    if not keyfs.USER(user=username).get():
+        request.apifatal(404, "The user %s doesn't exist." % username)
+    if not request.has_permission('user_modify'):
+        request.apifatal(403, "Not allowed to revoke tokens of %s." % username)
+    revoke_all(keyfs, username)
+    threadlog.info("revoked all tokens of user %r", username)
+    request.apireturn(200, "All tokens of %s revoked" % username)
+
+
+# upper limit of URIs for one batch authcheck request
+max_batch_uris = 1000
+
+
+@view_config(
+    route_name="lockdown-authcheck-batch",
+    request_method="POST",
+    is_mutating=False)
+def authcheck_batch_view(context, request):
+    """Returns the /+authcheck status code for each URI of a list.
+
+    The credentials are verified once and the verdict is determined once
+    per route class.
+    """
+    try:
+        uris = request.json_body['uris']
+    except (KeyError, TypeError, ValueError):
+        request.apifatal(400, "Expected a JSON object with a 'uris' list.")
+    if not isinstance(uris, list) or not all(isinstance(x, str) for x in uris):
+        request.apifatal(400, "The 'uris' must be a list of strings.")
+    if len(uris) > max_batch_uris:
+        request.apifatal(
+            400, "At most %s URIs are allowed per request." % max_batch_uris)
+    routes_mapper = request.registry.queryUtility(IRoutesMapper)
+    policy = request.registry.queryUtility(ISecurityPolicy)
+    identity_cache = getattr(policy, 'identity_cache', None)
+    # verify the credentials once for all URIs
+    identity = request.identity
+    verdicts = {}
+    result = []
+    for uri in uris:
+        orig_request = make_orig_request(request, uri, routes_mapper)
+        route_class = get_route_class(
+            orig_request.matched_route, orig_request.matchdict)
+        status = verdicts.get(route_class)
+        if status is None:
+            if identity_cache is not None:
+                identity_cache.set(orig_request, identity)
+            status = verdicts[route_class] = get_authcheck_status(orig_request)
+        result.append(dict(uri=uri, status=status))
+    request.apireturn(200, type="authcheck-batch", result=result)
+
+
+def get_api_keys_owner(request):
+    """Returns the name of the user whose API keys are managed."""
+    identity = request.identity
+    if identity is None:
+        request.apifatal(401, "Authentication required.")
+    if isinstance(identity, ApiKeyIdentity):
+        request.apifatal(403, "API keys can't be managed with an API key.")
+    return identity.username
+
+
+@view_config(
+    route_name="lockdown-api-keys",
+    request_method="GET")
+def api_keys_view(context, request):
+    """Lists the API keys of the user without the keys themselves."""
+    username = get_api_keys_owner(request)
+    userconfig = request.registry['xom'].keyfs.USER(user=username).get()
+    result = {}
+    for (keyid, info) in userconfig.get(api_keys_userconfig_key, {}).items():
+        indexes = info.get('indexes')
+        result[keyid] = dict(
+            created=info['created'],
+            indexes=None if indexes is None else list(indexes))
+    request.apireturn(200, type="api-keys", result=result)
+
+
+@view_config(
+    route_name="lockdown-api-keys",
+    request_method="POST")
+def api_key_create_view(context, request):
+    """Creates an API key, optionally restricted to a list of indexes.
+
+    The key is only returned in this response, only a digest is stored.
+    """
+    username = get_api_keys_owner(request)
+    try:
+        data = request.json_body if request.body else {}
+    except ValueError:
+        request.apifatal(400, "Expected a JSON object.")
+    if not isinstance(data, dict):
+        request.apifatal(400, "Expected a JSON object.")
+    indexes = data.get('indexes')
+    if indexes is not None:
+        if not isinstance(indexes, list) or not all(
+                isinstance(x, str) and x.count('/') == 1 for x in indexes):
+            request.apifatal(
+                400, "The 'indexes' must be a list of 'user/index' names.")
+        indexes = sorted(set(indexes))
+    (keyid, key) = new_api_key(username)
+    info = dict(
+        created=time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        digest=get_api_key_digest(key),
+        groups=list(request.identity.groups))
+    if indexes is not None:
+        info['indexes'] = indexes
+    userkey = request.registry['xom'].keyfs.USER(user=username)
+    with userkey.update() as userconfig:
+        userconfig.setdefault(api_keys_userconfig_key, {})[keyid] = info
+    threadlog.info("created API key %s for user %r", keyid, username)
+    request.apireturn(
+        201, type="api-key",
+        result=dict(id=keyid, key=key, indexes=indexes))
+
+
+@view_config(
+    route_name="lockdown-api-key",
+    request_method="DELETE")
+def api_key_delete_view(context, request):
+    """Revokes an API key."""
+    username = get_api_keys_owner(request)
+    keyid = request.matchdict['keyid']
+    userkey = request.registry['xom'].keyfs.USER(user=username)
+    if keyid not in userkey.get().get(api_keys_userconfig_key, {}):
+        request.apifatal(404, "The API key %s doesn't exist." % keyid)
+    with userkey.update() as userconfig:
+        keys = userconfig[api_keys_userconfig_key]
+        del keys[keyid]
+        if not keys:
+            userconfig.pop(api_keys_userconfig_key, None)
+    threadlog.info("revoked API key %s of user %r", keyid, username)
+    request.apireturn(200, "API key %s revoked" % keyid)
+
+
+@view_config(route_name="lockdown-metrics")
+def metrics_view(context, request):
+    metrics = request.registry['lockdown_metrics']
+    return Response(
+        metrics.render(devpiserver_metrics(request)),
+        content_type='text/plain; version=0.0.4',
+        charset='utf-8')
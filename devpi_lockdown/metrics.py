@@ -0,0 +1,180 @@
+from bisect import bisect_left
+from devpi_lockdown.tracing import Tracer
+from pluggy import HookimplMarker
+import threading
+import time
+
+
+devpiserver_hookimpl = HookimplMarker("devpiserver")
+
+
+# upper bounds in seconds
+default_buckets = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+class Metrics:
+    """Counters and histograms which are collected per thread.
+
+    Updates only touch data of the current thread, so no lock is needed on
+    the hot path. The data of all threads is aggregated on scrape.
+    """
+
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(buckets)
+        self.help = {}
+        self.types = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+
+    def describe(self, name, kind, help):
+        self.types[name] = kind
+        self.help[name] = help
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = ({}, {})
+            with self._lock:
+                self._shards.append(shard)
+            return shard
+
+    def inc(self, name, labels=(), amount=1):
+        counters = self._shard()[0]
+        key = (name, labels)
+        counters[key] = counters.get(key, 0) + amount
+
+    def observe(self, name, value):
+        histograms = self._shard()[1]
+        histogram = histograms.get(name)
+        if histogram is None:
+            # bucket counts, with one more for +Inf, the sum and the count
+            histogram = histograms[name] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-2] += value
+        histogram[-1] += 1
+
+    def collect(self):
+        """Returns the aggregated counters and histograms of all threads."""
+        counters = {}
+        histograms = {}
+        with self._lock:
+            shards = list(self._shards)
+        for (shard_counters, shard_histograms) in shards:
+            for (key, value) in shard_counters.copy().items():
+                counters[key] = counters.get(key, 0) + value
+            for (name, values) in shard_histograms.copy().items():
+                values = list(values)
+                if name in histograms:
+                    values = [a + b for (a, b) in zip(histograms[name], values)]
+                histograms[name] = values
+        return (counters, histograms)
+
+    def render(self, extra=()):
+        """Returns the metrics in the Prometheus text exposition format.
+
+        The ``extra`` metrics are tuples of name, type and value like
+        returned by the ``devpiserver_metrics`` hook.
+        """
+        (counters, histograms) = self.collect()
+        lines = []
+        seen = set()
+
+        def add_header(name, kind):
+            if name in seen:
+                return
+            seen.add(name)
+            if name in self.help:
+                lines.append("# HELP %s %s" % (name, self.help[name]))
+            lines.append("# TYPE %s %s" % (name, self.types.get(name, kind)))
+
+        for ((name, labels), value) in sorted(counters.items()):
+            add_header(name, 'counter')
+            if labels:
+                labels = "{%s}" % ",".join(
+                    '%s="%s"' % label for label in labels)
+            else:
+                labels = ""
+            lines.append("%s%s %s" % (name, labels, value))
+        for (name, values) in sorted(histograms.items()):
+            add_header(name, 'histogram')
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), values):
+                cumulative += count
+                lines.append('%s_bucket{le="%s"} %s' % (name, bound, cumulative))
+            lines.append("%s_sum %s" % (name, values[-2]))
+            lines.append("%s_count %s" % (name, values[-1]))
+        for (name, kind, value) in extra:
+            add_header(name, kind)
+            lines.append("%s %s" % (name, value))
+        lines.append("")
+        return "\n".join(lines)
+
+
+class MetricsPlugin:
+    """Hook implementations measuring the authentication stages.
+
+    devpi-server calls the credential and identity hooks directly instead
+    of through pluggy, so hook wrappers can't be used for them. Instead
+    the stages are timed by the first called implementations and the
+    ``devpiserver_identity_loaded`` hook. The timings are also recorded
+    as spans with the ``tracer``.
+    """
+
+    def __init__(self, metrics, tracer=None):
+        self.metrics = metrics
+        self.tracer = Tracer() if tracer is None else tracer
+        self.state = threading.local()
+
+    @devpiserver_hookimpl(tryfirst=True)
+    def devpiserver_get_credentials(self, request):
+        request.environ['devpi_lockdown.credentials_start'] = time.perf_counter()
+
+    @devpiserver_hookimpl(tryfirst=True)
+    def devpiserver_get_identity(self, request, credentials):
+        now = time.perf_counter()
+        start = request.environ.pop('devpi_lockdown.credentials_start', None)
+        if start is not None:
+            self.metrics.observe(
+                'devpi_lockdown_credentials_extraction_seconds', now - start)
+            self.tracer.record('credentials', start)
+        request.environ['devpi_lockdown.identity_start'] = now
+
+    @devpiserver_hookimpl(optionalhook=True)
+    def devpiserver_identity_loaded(self, request, credential_plugin_name, identity_plugin_name, identity):
+        start = request.environ.pop('devpi_lockdown.identity_start', None)
+        if start is not None:
+            self.metrics.observe(
+                'devpi_lockdown_credentials_verification_seconds',
+                time.perf_counter() - start)
+            self.tracer.record(
+                'identity', start,
+                plugin=identity_plugin_name,
+                user=None if identity is None else identity.username)
+
+    @devpiserver_hookimpl(hookwrapper=True, optionalhook=True)
+    def devpiserver_authcheck_always_ok(self, request):
+        with self.tracer.span('authcheck.always_ok') as span:
+            outcome = yield
+            result = outcome.get_result()
+            self.state.always_ok = bool(result and all(result))
+            span.set_attribute('result', self.state.always_ok)
+
+    @devpiserver_hookimpl(hookwrapper=True, optionalhook=True)
+    def devpiserver_authcheck_forbidden(self, request):
+        with self.tracer.span('authcheck.forbidden'):
+            yield
+
+    @devpiserver_hookimpl(hookwrapper=True, optionalhook=True)
+    def devpiserver_authcheck_unauthorized(self, request):
+        with self.tracer.span('authcheck.unauthorized'):
+            yield
+
+    def reset_always_ok(self):
+        self.state.always_ok = False
+
+    def is_always_ok(self):
+        return getattr(self.state, 'always_ok', False)
@@ -0,0 +1,105 @@
+from devpi_server.log import threadlog
+import contextlib
+import cProfile
+import itertools
+import os
+import random
+import threading
+import time
+
+
+class ProfiledRequest:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profile = cProfile.Profile()
+        self._start = time.perf_counter()
+        try:
+            self.profile.enable()
+        except ValueError:
+            # another profiling tool is active
+            self.profile = None
+        return self
+
+    def __exit__(self, cls, value, tb):
+        if self.profile is not None:
+            self.profile.disable()
+        duration = time.perf_counter() - self._start
+        self.profiler._lock.release()
+        if self.profile is not None and duration >= self.profiler.threshold:
+            self.profiler.save(self.name, duration, self.profile)
+
+
+class SlowRequestProfiler:
+    """Profiles a fraction of the requests and keeps the slow ones.
+
+    A randomly chosen ``fraction`` of the requests runs under ``cProfile``,
+    only one request at a time, as only one profiler can be active. The
+    statistics of requests which took at least ``threshold`` seconds are
+    written to ``.prof`` files in ``path``, of which the newest ``keep``
+    are kept.
+    """
+
+    def __init__(self, path, fraction, threshold, keep):
+        self.path = path
+        self.fraction = fraction
+        self.threshold = threshold
+        self.keep = keep
+        self.sampled = 0
+        self.saved = 0
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def profile(self, name):
+        """Returns a context manager which profiles the request if it is
+        sampled."""
+        if random.random() >= self.fraction:
+            return null_profile
+        if not self._lock.acquire(blocking=False):
+            # another request is profiled right now
+            return null_profile
+        self.sampled += 1
+        return ProfiledRequest(self, name)
+
+    def save(self, name, duration, profile):
+        filename = '%s-%s-%s-%dms.prof' % (
+            time.strftime('%Y%m%dT%H%M%S'), next(self._counter), name,
+            duration * 1000)
+        try:
+            profile.dump_stats(os.path.join(self.path, filename))
+            self.rotate()
+        except OSError:
+            # profiling must never break a request
+            threadlog.exception("Error saving profile %s", filename)
+            return
+        self.saved += 1
+        threadlog.info(
+            "Saved profile of %s request taking %.3fs to %s",
+            name, duration, filename)
+
+    def rotate(self):
+        profiles = []
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.prof'):
+                continue
+            path = os.path.join(self.path, filename)
+            with contextlib.suppress(OSError):
+                profiles.append((os.path.getmtime(path), path))
+        profiles.sort()
+        for (mtime, path) in profiles[:max(len(profiles) - self.keep, 0)]:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
+
+class NullProfiler:
+    """Used without a profile directory, so profiling costs nothing."""
+
+    def profile(self, name):
+        return null_profile
+
+
+null_profile = contextlib.nullcontext()
+null_profiler = NullProfiler()
@@ -0,0 +1,174 @@
+import hashlib
+import threading
+import time
+
+
+# the keys of the revocations in the user configuration
+revoked_key = 'lockdown_revoked'
+revoked_before_key = 'lockdown_revoked_before'
+
+
+def get_digest(token):
+    return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+class BloomFilter:
+    """Set of digests which can have false positives, but no false
+    negatives. Each digest sets ``hashes`` bits taken from its bytes."""
+
+    def __init__(self, bits, hashes):
+        self.bits = bits
+        self.hashes = hashes
+        self.array = bytearray((bits + 7) // 8)
+
+    def _positions(self, digest):
+        for index in range(0, self.hashes * 4, 4):
+            yield int.from_bytes(digest[index:index + 4], 'little') % self.bits
+
+    def add(self, digest):
+        for position in self._positions(digest):
+            self.array[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, digest):
+        array = self.array
+        return all(
+            array[position >> 3] & (1 << (position & 7))
+            for position in self._positions(digest))
+
+
+def get_revocations(userconfig, now):
+    """Returns the unexpired revoked digests of a user with their
+    expiration time and the time before which all tokens are revoked."""
+    userconfig = userconfig or {}
+    revoked = {
+        bytes.fromhex(digest): expires
+        for (digest, expires) in userconfig.get(revoked_key, {}).items()
+        if expires > now}
+    return (revoked, userconfig.get(revoked_before_key))
+
+
+def revoke_token(keyfs, username, token, expires):
+    """Stores the revocation of a token until its expiration time and
+    drops expired revocations of the user.
+
+    Must be called inside a keyfs write transaction.
+    """
+    now = time.time()
+    with keyfs.USER(user=username).update() as userconfig:
+        revoked = {
+            digest: other_expires
+            for (digest, other_expires)
+            in userconfig.get(revoked_key, {}).items()
+            if other_expires > now}
+        revoked[get_digest(token).hex()] = int(expires) + 1
+        userconfig[revoked_key] = revoked
+
+
+def revoke_all(keyfs, username):
+    """Revokes all tokens of a user issued before the current second. The
+    times of tokens only have a resolution of seconds, so new tokens of the
+    user in the current second stay valid.
+
+    Must be called inside a keyfs write transaction.
+    """
+    with keyfs.USER(user=username).update() as userconfig:
+        userconfig[revoked_before_key] = int(time.time())
+
+
+class RevocationTable:
+    """The revoked tokens of all users.
+
+    The revocations are stored in the user configuration and kept in memory,
+    updated from the change events of the user configuration. A Bloom
+    filter of the digests of all revoked tokens is checked first, so for
+    tokens which aren't revoked no dictionary lookup is needed.
+
+    Without change events, like with ``--requests-only``, ``cached`` has
+    to be false and the configuration of the user is read on each lookup.
+    """
+
+    def __init__(self, cached=True, bits=1 << 20, hashes=4):
+        self.cached = cached
+        self.bits = bits
+        self.hashes = hashes
+        self.bloom = BloomFilter(bits, hashes)
+        # maps a username to the serial of the loaded configuration and
+        # the result of get_revocations
+        self.users = None
+        # changes received before the first use
+        self._changes = {}
+        self._lock = threading.Lock()
+
+    def _rebuild(self):
+        bloom = BloomFilter(self.bits, self.hashes)
+        for (serial, (revoked, revoked_before)) in self.users.values():
+            for digest in revoked:
+                bloom.add(digest)
+        self.bloom = bloom
+
+    def update_user(self, username, userconfig, serial):
+        revocations = get_revocations(userconfig, time.time())
+        with self._lock:
+            users = self._changes if self.users is None else self.users
+            current = users.get(username)
+            if current is not None and current[0] > serial:
+                # a newer configuration was already loaded
+                return
+            users[username] = (serial, revocations)
+            if users is self.users and (revocations[0] or (
+                    current is not None and current[1][0])):
+                self._rebuild()
+
+    def on_userchange(self, ev):
+        self.update_user(ev.typedkey.params['user'], ev.value, ev.at_serial)
+
+    def _load(self, keyfs):
+        now = time.time()
+        serial = keyfs.tx.at_serial
+        users = {}
+        for username in keyfs.USERLIST.get():
+            revocations = get_revocations(
+                keyfs.USER(user=username).get(), now)
+            if revocations[0] or revocations[1]:
+                users[username] = (serial, revocations)
+        with self._lock:
+            if self.users is not None:
+                return
+            for (username, entry) in self._changes.items():
+                if entry[0] > serial:
+                    users[username] = entry
+            self._changes = {}
+            self.users = users
+            self._rebuild()
+
+    def is_loaded(self):
+        """Returns whether ``is_revoked`` needs no transaction."""
+        return self.cached and self.users is not None
+
+    def is_revoked(self, keyfs, username, token, get_issued):
+        """Returns whether the token was revoked, either by itself or with
+        all tokens of the user. The ``get_issued`` function is only called
+        in the latter case to get the time the token was issued.
+
+        Must be called inside a keyfs transaction.
+        """
+        digest = get_digest(token)
+        if self.cached:
+            if self.users is None:
+                self._load(keyfs)
+            entry = self.users.get(username)
+            if entry is None:
+                return False
+            (revoked, revoked_before) = entry[1]
+            if digest not in self.bloom:
+                # the common case, the token itself isn't revoked
+                revoked = {}
+        else:
+            (revoked, revoked_before) = get_revocations(
+                keyfs.USER(user=username).get(), time.time())
+        if revoked_before is not None:
+            issued = get_issued()
+            if issued is not None and issued < revoked_before:
+                return True
+        expires = revoked.get(digest)
+        return expires is not None and expires > time.time()
@@ -0,0 +1,361 @@
+"""A standalone server which only answers /+authcheck requests.
+
+It uses the same options and storage as devpi-server, so credentials are
+verified by the regular devpi-server and plugin hooks, but without the
+Pyramid application of devpi-server. The storage is only read.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from devpi_lockdown import main as lockdown_plugin
+from devpi_lockdown.acl import ReadACLTable
+from devpi_lockdown.apikeys import ApiKeyTable
+from devpi_lockdown.apikeys import in_scope
+from devpi_lockdown.cookie import CookieSigner
+from devpi_lockdown.cookie import InvalidKeys
+from devpi_lockdown.identity import get_uri_path
+from devpi_lockdown.identity import identity_header
+from devpi_lockdown.main import get_claimed_username
+from devpi_lockdown.main import get_rate_limit_delay
+from devpi_lockdown.main import get_renewed_cookie_headers
+from devpi_lockdown.main import make_audit_log
+from devpi_lockdown.main import make_identity_signer
+from devpi_lockdown.main import make_rate_limiters
+from devpi_lockdown.main import make_throttle
+from devpi_lockdown.main import make_verification_limiter
+from devpi_lockdown.main import release_verification_slot
+from devpi_lockdown.revocation import RevocationTable
+from devpi_lockdown.throttle import get_remote_ip
+from devpi_server.config import get_pluginmanager
+from devpi_server.config import parseoptions
+from devpi_server.log import configure_logging
+from devpi_server.log import threadlog
+from devpi_server.main import Fatal
+from devpi_server.main import xom_from_config
+from devpi_server.view_auth import DevpiSecurityPolicy
+from devpi_server.view_auth import RootFactory
+from http.server import BaseHTTPRequestHandler
+from http.server import HTTPServer
+from pyramid.httpexceptions import HTTPServiceUnavailable
+from pyramid.httpexceptions import HTTPTooManyRequests
+from pyramid.httpexceptions import HTTPUnauthorized
+from pyramid.interfaces import ISecurityPolicy
+from pyramid.registry import Registry
+from pyramid.request import Request
+import math
+import queue
+import re
+import selectors
+import socket
+import sys
+import threading
+import time
+
+
+class Authcheck:
+    """Determines the status code of /+authcheck for the original URI.
+
+    Unlike devpi-server the URI isn't matched against the routes, so the
+    ``devpiserver_authcheck_*`` hooks of other plugins aren't used. The
+    ``pkg_read`` permission of the index, which devpi-server checks in its
+    own hook for files, is checked like there.
+    """
+
+    def __init__(self, xom, signer=None, throttle=None, limiter=None,
+                 cookie_renewal=0, audit=None, rate_limiters=(None, None),
+                 identity_signer=None):
+        self.xom = xom
+        self.cookie_renewal = cookie_renewal
+        self.identity_signer = identity_signer
+        self.audit = audit
+        self.always_ok = re.compile('|'.join(
+            '(?:%s)' % location for (pattern, url_marker, location)
+            in lockdown_plugin.default_always_ok_patterns))
+        # there are no change events without the devpi-server process
+        self.read_acls = ReadACLTable(cached=False)
+        self.registry = Registry('devpi-lockdown-authcheck')
+        self.registry['xom'] = xom
+        self.registry['lockdown_cookie_signer'] = signer
+        self.registry['lockdown_credential_cache'] = None
+        self.registry['lockdown_throttle'] = throttle
+        self.registry['lockdown_verification_limiter'] = limiter
+        self.registry['lockdown_api_keys'] = ApiKeyTable(cached=False)
+        self.registry['lockdown_revocations'] = RevocationTable(cached=False)
+        self.registry['lockdown_identity_signer'] = identity_signer
+        (self.registry['lockdown_user_rate_limiter'],
+         self.registry['lockdown_anonymous_rate_limiter']) = rate_limiters
+        self.policy = DevpiSecurityPolicy(xom)
+        self.registry.registerUtility(self.policy, ISecurityPolicy)
+
+    def get_response(self, url, headers):
+        """Returns the status code and the headers of the response."""
+        request = Request.blank(url, headers=headers)
+        request.registry = self.registry
+        identity = None
+        if self.always_ok.match(request.path_info):
+            (status, outcome) = (200, 'always_ok')
+        else:
+            (status, identity) = self.get_status(request)
+            outcome = str(status)
+        response_headers = []
+        delay = get_rate_limit_delay(request, outcome)
+        if delay:
+            (status, outcome) = (429, '429')
+            response_headers.append(('Retry-After', str(math.ceil(delay))))
+        if self.audit is not None:
+            self.audit.record(
+                'authcheck',
+                user=get_claimed_username(request),
+                ip=get_remote_ip(request),
+                uri=url,
+                outcome=outcome)
+        if outcome == '200' and self.identity_signer is not None:
+            response_headers.append((
+                identity_header,
+                self.identity_signer.sign(identity, get_uri_path(url))))
+        if outcome == '200' and self.cookie_renewal and 'auth_tkt' in request.cookies:
+            response_headers.extend(
+                get_renewed_cookie_headers(request, self.cookie_renewal))
+        return (status, response_headers)
+
+    def get_status(self, request):
+        """Returns the status code and the verified identity."""
+        path = request.path_info
+        keyfs = self.xom.keyfs
+        with keyfs.read_transaction():
+            try:
+                identity = self.policy.identity(request)
+            except HTTPUnauthorized:
+                return (401, None)
+            except HTTPTooManyRequests:
+                return (429, None)
+            except HTTPServiceUnavailable:
+                return (503, None)
+            finally:
+                # finished callbacks aren't used outside of Pyramid
+                release_verification_slot(request)
+            if identity is None:
+                if 'devpi-client' in (request.user_agent or ''):
+                    # devpi-client needs to know for proper error messages
+                    return (403, None)
+                return (401, None)
+            parts = path.split('/')[1:4]
+            if len(parts) >= 2 and not any(x.startswith('+') for x in parts[:2]):
+                (user, index) = parts[:2]
+                if not in_scope(identity, "%s/%s" % (user, index)):
+                    return (403, identity)
+                if not self.read_acls.permits(keyfs, identity, user, index):
+                    return (403, identity)
+                if parts[2:] in (['+e'], ['+f']):
+                    # the files of the index need the pkg_read permission
+                    request.matchdict = dict(user=user, index=index)
+                    if not self.policy.permits(
+                            request, RootFactory(request), 'pkg_read'):
+                        return (403, identity)
+        return (200, identity)
+
+
+class AuthcheckRequestHandler(BaseHTTPRequestHandler):
+    """Handles the requests of one connection.
+
+    Unlike with ``socketserver`` the handler lives as long as the
+    connection and the server calls ``handle_one_request`` whenever a
+    request can be read, so no thread waits for the next request of an
+    idle keepalive connection.
+    """
+
+    protocol_version = "HTTP/1.1"
+    # timeout for reading a request and for idle keepalive connections
+    timeout = 60
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.close_connection = False
+        self.setup()
+
+    def has_pending_request(self):
+        """Returns whether data of another request was already received."""
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            # let handle_one_request find out
+            return True
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/+authcheck':
+            self.send_status(404)
+            return
+        url = self.headers.get('X-Original-URI', self.path)
+        try:
+            (status, headers) = self.server.authcheck.get_response(
+                url, dict(self.headers))
+        except Exception:
+            threadlog.exception("Error during authcheck of %s", url)
+            (status, headers) = (500, [])
+        self.send_status(status, headers)
+
+    do_HEAD = do_GET
+
+    def send_status(self, status, headers=()):
+        self.send_response(status)
+        for (name, value) in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        threadlog.debug("%s %s" % (self.address_string(), format % args))
+
+
+class AuthcheckServer(HTTPServer):
+    """HTTP server handling requests with a fixed number of threads.
+
+    Connections without a request to read wait in a selector of a
+    dispatcher thread, which hands them to the threads once they are
+    readable and closes them after being idle for the timeout of the
+    handler. So idle keepalive connections of nginx don't occupy threads.
+    """
+
+    def __init__(self, address, authcheck, threads):
+        # before HTTPServer.__init__, which calls server_close on errors
+        self.authcheck = authcheck
+        self.executor = ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='authcheck')
+        self.selector = selectors.DefaultSelector()
+        # connections handed back to the dispatcher by the threads
+        self.idle = queue.SimpleQueue()
+        (self.wakeup_recv, self.wakeup_send) = socket.socketpair()
+        self.selector.register(self.wakeup_recv, selectors.EVENT_READ)
+        self.closed = False
+        self.dispatcher = threading.Thread(
+            target=self.dispatch, name='authcheck-dispatcher', daemon=True)
+        HTTPServer.__init__(self, address, AuthcheckRequestHandler)
+        self.dispatcher.start()
+
+    def process_request(self, request, client_address):
+        self.make_idle(
+            self.RequestHandlerClass(request, client_address, self))
+
+    def make_idle(self, handler):
+        self.idle.put(handler)
+        self.wakeup_send.send(b'\0')
+
+    def dispatch(self):
+        idle_since = {}
+        while not self.closed:
+            for (key, events) in self.selector.select(timeout=1):
+                if key.fileobj is self.wakeup_recv:
+                    self.wakeup_recv.recv(4096)
+                    continue
+                handler = key.data
+                self.selector.unregister(key.fileobj)
+                del idle_since[handler]
+                self.executor.submit(self.handle_connection, handler)
+            now = time.monotonic()
+            while not self.idle.empty():
+                handler = self.idle.get()
+                self.selector.register(
+                    handler.connection, selectors.EVENT_READ, handler)
+                idle_since[handler] = now
+            for (handler, since) in list(idle_since.items()):
+                if now - since > handler.timeout:
+                    self.selector.unregister(handler.connection)
+                    del idle_since[handler]
+                    self.close_connection(handler)
+        for handler in idle_since:
+            self.close_connection(handler)
+        while not self.idle.empty():
+            self.close_connection(self.idle.get())
+
+    def handle_connection(self, handler):
+        try:
+            while True:
+                handler.handle_one_request()
+                if handler.close_connection:
+                    break
+                if not handler.has_pending_request():
+                    self.make_idle(handler)
+                    return
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+        self.close_connection(handler)
+
+    def close_connection(self, handler):
+        try:
+            handler.finish()
+        finally:
+            self.shutdown_request(handler.request)
+
+    def server_close(self):
+        HTTPServer.server_close(self)
+        self.closed = True
+        self.wakeup_send.send(b'\0')
+        if self.dispatcher.is_alive():
+            self.dispatcher.join()
+        self.executor.shutdown(wait=False)
+        self.selector.close()
+        self.wakeup_recv.close()
+        self.wakeup_send.close()
+
+
+def main(argv=None):
+    """ devpi-lockdown-authcheck command line entry point. """
+    if argv is None:
+        argv = sys.argv
+    pluginmanager = get_pluginmanager()
+    if not pluginmanager.is_registered(lockdown_plugin):
+        pluginmanager.register(lockdown_plugin)
+    # the storage is only read, like by additional devpi-server processes
+    config = parseoptions(
+        pluginmanager, [str(x) for x in argv] + ['--requests-only'])
+    configure_logging(config.args)
+    signer = None
+    if config.args.lockdown_cookie_keys:
+        try:
+            signer = CookieSigner.from_file(config.args.lockdown_cookie_keys)
+        except (InvalidKeys, OSError) as e:
+            threadlog.error(
+                "The cookie keys in '%s' can't be used: %s" % (
+                    config.args.lockdown_cookie_keys, e))
+            return 1
+    if not config.nodeinfo_path.exists():
+        threadlog.error(
+            "The path '%s' contains no devpi-server data." % config.server_path)
+        return 1
+    try:
+        xom = xom_from_config(config)
+    except Fatal as e:
+        threadlog.error(str(e))
+        return 1
+    audit = make_audit_log(config, xom)
+    if audit is not None:
+        xom.thread_pool.start_one(audit)
+    address = (config.args.host, config.args.port)
+    authcheck = Authcheck(
+        xom, signer=signer, throttle=make_throttle(config),
+        limiter=make_verification_limiter(config),
+        cookie_renewal=config.args.lockdown_cookie_renewal, audit=audit,
+        rate_limiters=make_rate_limiters(config),
+        identity_signer=make_identity_signer(config))
+    try:
+        server = AuthcheckServer(address, authcheck, config.args.threads)
+    except OSError as e:
+        threadlog.error(
+            "Can't serve at http://%s:%s: %s" % (address[0], address[1], e))
+        xom.thread_pool.shutdown()
+        return 1
+    threadlog.info(
+        "serving /+authcheck at http://%s:%s/+authcheck with %s threads" % (
+            address[0], address[1], config.args.threads))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        # lets the audit log writer finish
+        xom.thread_pool.shutdown()
+    return 0
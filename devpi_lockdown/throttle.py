@@ -0,0 +1,81 @@
+from repoze.lru import LRUCache
+import threading
+import time
+
+
+def get_remote_ip(request):
+    # like the request method of devpi-server, which isn't available for
+    # requests of the standalone authcheck server
+    return request.headers.get('X-Real-IP', request.client_addr)
+
+
+class FailureThrottle:
+    """Token buckets for failed credential verifications.
+
+    There is a bucket per username and one per client IP. Each holds up
+    to ``burst`` tokens and regains one token per ``interval`` seconds.
+    A failure takes a token, when either bucket is empty further attempts
+    are throttled. Only the most recently used buckets are kept, so the
+    memory is bounded by ``size``.
+    """
+
+    def __init__(self, burst, interval, size=10000):
+        self.burst = burst
+        self.interval = interval
+        # each bucket is a tuple of the tokens and the time they were counted
+        self.users = LRUCache(size)
+        self.ips = LRUCache(size)
+        self._lock = threading.Lock()
+
+    def _tokens(self, buckets, key, now):
+        bucket = buckets.get(key)
+        if bucket is None:
+            return self.burst
+        (tokens, then) = bucket
+        return min(self.burst, tokens + (now - then) / self.interval)
+
+    def is_throttled(self, username, ip):
+        now = time.monotonic()
+        if self._tokens(self.users, username, now) < 1:
+            return True
+        return self._tokens(self.ips, ip, now) < 1
+
+    def failure(self, username, ip):
+        now = time.monotonic()
+        with self._lock:
+            for (buckets, key) in ((self.users, username), (self.ips, ip)):
+                tokens = self._tokens(buckets, key, now)
+                buckets.put(key, (max(tokens - 1, 0), now))
+
+
+class RateLimiter:
+    """Token buckets for the requests of users or client IPs.
+
+    Each bucket holds up to ``burst`` tokens and regains ``rate`` tokens
+    per second. A request takes a token, when the bucket is empty it is
+    rejected. Only the most recently used buckets are kept, so the memory
+    is bounded by ``size``.
+    """
+
+    def __init__(self, rate, burst, size=10000):
+        self.rate = rate
+        self.burst = burst
+        # each bucket is a tuple of the tokens and the time they were counted
+        self.buckets = LRUCache(size)
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        """Takes a token from the bucket of the key and returns 0, or the
+        number of seconds until a token is available."""
+        now = time.monotonic()
+        with self._lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                tokens = self.burst
+            else:
+                (tokens, then) = bucket
+                tokens = min(self.burst, tokens + (now - then) * self.rate)
+            if tokens < 1:
+                return (1 - tokens) / self.rate
+            self.buckets.put(key, (tokens - 1, now))
+            return 0
@@ -0,0 +1,135 @@
+from collections import namedtuple
+from devpi_server.log import threadlog
+import random
+import threading
+import time
+
+
+Span = namedtuple(
+    'Span', 'trace_id span_id parent_id name start duration attributes')
+
+
+class NullSpan:
+    """Returned by a tracer without exporter, so tracing costs nothing."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, cls, value, tb):
+        pass
+
+    def set_attribute(self, name, value):
+        pass
+
+
+null_span = NullSpan()
+
+
+def new_id():
+    return '%016x' % random.getrandbits(64)
+
+
+class ActiveSpan:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+
+    def __enter__(self):
+        stack = self.tracer._get_stack()
+        if stack:
+            parent = stack[-1]
+            (self.trace_id, self.parent_id) = (parent.trace_id, parent.span_id)
+        else:
+            (self.trace_id, self.parent_id) = (new_id(), None)
+        self.span_id = new_id()
+        stack.append(self)
+        self.start = time.time()
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, cls, value, tb):
+        duration = time.perf_counter() - self._start
+        self.tracer._get_stack().pop()
+        if cls is not None:
+            self.attributes['error'] = cls.__name__
+        self.tracer.export(Span(
+            self.trace_id, self.span_id, self.parent_id, self.name,
+            self.start, duration, self.attributes))
+
+    def set_attribute(self, name, value):
+        self.attributes[name] = value
+
+
+class Tracer:
+    """Records span-like timings of the authentication stages.
+
+    Spans started while another span of the same thread is active belong
+    to the same trace. Finished spans are passed to the ``export`` method
+    of the exporter. Without an exporter nothing is recorded.
+    """
+
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self._local = threading.local()
+
+    def _get_stack(self):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def span(self, name, **attributes):
+        """Returns a context manager measuring a span."""
+        if self.exporter is None:
+            return null_span
+        return ActiveSpan(self, name, attributes)
+
+    def record(self, name, start, **attributes):
+        """Records a span which started at ``start`` as returned by
+        ``time.perf_counter`` and ends now, for stages which begin and end
+        in different hooks."""
+        if self.exporter is None:
+            return
+        duration = time.perf_counter() - start
+        stack = self._get_stack()
+        (trace_id, parent_id) = (
+            (stack[-1].trace_id, stack[-1].span_id) if stack
+            else (new_id(), None))
+        self.export(Span(
+            trace_id, new_id(), parent_id, name,
+            time.time() - duration, duration, attributes))
+
+    def set_attribute(self, name, value):
+        """Sets an attribute of the innermost active span of the thread."""
+        if self.exporter is None:
+            return
+        stack = self._get_stack()
+        if stack:
+            stack[-1].set_attribute(name, value)
+
+    def export(self, span):
+        try:
+            self.exporter.export(span)
+        except Exception:
+            # tracing must never break a request
+            threadlog.exception("Error exporting span %s", span.name)
+
+
+class JsonLinesExporter:
+    """Writes spans as JSON lines with the background writer of an
+    ``AuditLog``, so exporting only queues the record."""
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def export(self, span):
+        fields = dict(span.attributes)
+        fields.update(
+            trace=span.trace_id,
+            span=span.span_id,
+            parent=span.parent_id,
+            name=span.name,
+            start=round(span.start, 6),
+            duration=round(span.duration, 6))
+        self.writer.record('span', **fields)
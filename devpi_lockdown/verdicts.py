@@ -0,0 +1,123 @@
+from zlib import crc32
+import hashlib
+import mmap
+import os
+import struct
+import time
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+# the outcomes which can be stored and their codes in a slot
+outcome_codes = {
+    'always_ok': 1,
+    '200': 2,
+    '401': 3,
+    '403': 4}
+code_outcomes = {v: k for (k, v) in outcome_codes.items()}
+
+
+class SharedVerdictCache:
+    """Cache for /+authcheck verdicts in a memory mapped file.
+
+    All devpi-server processes using the same file share the verdicts.
+    The file consists of a header and a fixed number of slots. The slot
+    of a key is determined by its hash, a newer verdict replaces any older
+    one in the same slot.
+
+    Each slot holds the hash of the key, the expiration time, the outcome
+    and a checksum of these. Reads and writes don't lock, a slot which is
+    written concurrently fails the checksum test and is treated as a miss.
+
+    The interface is the same as ``repoze.lru.ExpiringLRUCache`` as far as
+    it's used for verdicts, the statistics are per process except the size.
+    """
+
+    header = struct.Struct('<8sII')
+    magic = b'DLVERDCT'
+    version = 1
+    # key hash, expiration time, outcome code and checksum
+    slot = struct.Struct('<32sdB3xI')
+
+    def __init__(self, path, size, default_timeout):
+        self.path = path
+        self.slots = size
+        self.default_timeout = default_timeout
+        self.hits = 0
+        self.misses = 0
+        self.lookups = 0
+        self.evictions = 0
+        length = self.header.size + self.slot.size * size
+        header = self.header.pack(self.magic, self.version, size)
+        lock_fd = os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            if os.read(fd, self.header.size) != header or os.fstat(fd).st_size != length:
+                # a new file or one with a different layout is replaced,
+                # so processes which still use the old one aren't affected
+                os.close(fd)
+                tmp_path = "%s-%s.tmp" % (path, os.getpid())
+                fd = os.open(
+                    tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o600)
+                os.write(fd, header)
+                os.ftruncate(fd, length)
+                os.replace(tmp_path, path)
+            try:
+                self.mmap = mmap.mmap(fd, length)
+            finally:
+                os.close(fd)
+        finally:
+            os.close(lock_fd)
+
+    def _locate(self, key):
+        digest = hashlib.sha256(repr(key).encode('utf-8')).digest()
+        index = int.from_bytes(digest[:8], 'little') % self.slots
+        return (digest, self.header.size + index * self.slot.size)
+
+    def _read(self, offset):
+        data = self.mmap[offset:offset + self.slot.size]
+        (digest, expires, code, checksum) = self.slot.unpack(data)
+        if crc32(data[:-4]) != checksum:
+            # empty, or concurrently written
+            return (None, 0, 0)
+        return (digest, expires, code)
+
+    def get(self, key, default=None):
+        self.lookups += 1
+        (digest, offset) = self._locate(key)
+        (slot_digest, expires, code) = self._read(offset)
+        if slot_digest != digest or expires <= time.time():
+            self.misses += 1
+            return default
+        self.hits += 1
+        return code_outcomes.get(code, default)
+
+    def put(self, key, value, timeout=None):
+        code = outcome_codes.get(value)
+        if code is None:
+            return
+        if timeout is None:
+            timeout = self.default_timeout
+        now = time.time()
+        (digest, offset) = self._locate(key)
+        (slot_digest, expires, slot_code) = self._read(offset)
+        if slot_digest not in (None, digest) and expires > now:
+            self.evictions += 1
+        data = self.slot.pack(digest, now + timeout, code, 0)[:-4]
+        self.mmap[offset:offset + self.slot.size] = data + struct.pack(
+            '<I', crc32(data))
+
+    @property
+    def size(self):
+        """The number of unexpired verdicts of all processes."""
+        now = time.time()
+        return sum(
+            1 for index in range(self.slots)
+            if self._read(self.header.size + index * self.slot.size)[1] > now)
+
+    def close(self):
+        self.mmap.close()
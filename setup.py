@@ -36,11 +36,14 @@ setup(
             "Programming Language :: Python :: %s" % x
             for x in "3 3.9 3.10 3.11 3.12 3.13".split()],
     entry_points={
+        'console_scripts': [
+            "devpi-lockdown-authcheck = devpi_lockdown.server:main"],
         'devpi_server': [
             "devpi-lockdown = devpi_lockdown.main"]},
     install_requires=[
         'devpi-server>=6.10.0',
-        'devpi-web'],
+        'devpi-web',
+        'repoze.lru'],
     extras_require={
         'tests': [
             'webtest',
@@ -1,5 +1,6 @@
 from devpi_common.metadata import parse_version
 from devpi_server import __version__ as devpi_server_version
+from unittest import mock
 from webob.headers import ResponseHeaders
 import pytest
 import subprocess
@@ -92,6 +93,29 @@ def test_always_ok(testapp):
                 'X-Original-URI': uri}))
 
 
+def test_always_ok_plugin_pattern(maketestapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_lockdown.main import devpiserver_hookimpl
+
+    class Plugin:
+        @devpiserver_hookimpl(trylast=True)
+        def devpiserver_pyramid_configure(self, config, pyramid_config):
+            pyramid_config.add_lockdown_always_ok(r'/\{user\}/\{index\}/\+simple/')
+
+    xom = makexom(plugins=[lockdown_plugin, Plugin()])
+    testapp = maketestapp(xom)
+    classifier = testapp.app.app.registry['lockdown_always_ok']
+    assert classifier.route_markers is not None
+    testapp.xget(
+        200, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({
+            'X-Original-URI': 'http://localhost/root/pypi/+simple/'}))
+    testapp.xget(
+        401, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({
+            'X-Original-URI': 'http://localhost/root/pypi/+simple/pkg/'}))
+
+
 def test_get_current_request(maketestapp, makexom):
     from devpi_lockdown import main as lockdown_plugin
     from devpi_lockdown.main import devpiserver_hookimpl
@@ -147,6 +171,210 @@ def test_gen_config(tmpdir):
     assert server_index < auth_index < proxy_index
 
 
+@pytest.mark.skipif(
+    devpi_server_version < parse_version("6dev"),
+    reason="Needs devpiserver_genconfig hook")
+def test_gen_config_always_ok_locations(tmpdir):
+    from devpi_lockdown.main import default_always_ok_patterns
+
+    tmpdir.chdir()
+    proc = subprocess.Popen(["devpi-gen-config"])
+    res = proc.wait()
+    assert res == 0
+    path = tmpdir.join("gen-config").join("nginx-devpi-lockdown.conf")
+    locations = path.read().split("location")
+    for (pattern, url_marker, location) in default_always_ok_patterns:
+        (part,) = [x for x in locations if x.startswith(' ~ "%s" {' % location)]
+        assert "auth_request off;" in part
+        assert "proxy_pass http://devpi_lockdown_app;" in part
+        assert "X-outside-url" in part
+
+
+def test_always_ok_locations(testapp):
+    from devpi_lockdown.main import default_always_ok_patterns
+    from devpi_lockdown.main import make_orig_request
+    from devpi_web import __version__ as devpi_web_version
+    from pyramid.interfaces import IRoutesMapper
+    import re
+
+    registry = testapp.app.app.registry
+    routes_mapper = registry.queryUtility(IRoutesMapper)
+    classifier = registry['lockdown_always_ok']
+    regexp = re.compile('|'.join(
+        '(?:%s)' % location
+        for (pattern, url_marker, location) in default_always_ok_patterns))
+    request = testapp.app.app.request_factory.blank('/')
+    request.registry = registry
+    request.log = None
+    paths = [
+        "/+api", "/root/+api", "/root/pypi/+api", "/+login", "/+logout",
+        "/+static-%s/style.css" % devpi_web_version,
+        "/", "/+status", "/root", "/root/pypi", "/root/pypi/+simple/",
+        "/root/pypi/+simple/pkg/", "/root/pypi/pkg/1.0", "/root/+api/foo",
+        "/root/pypi/+f/abc/pkg-1.0.tar.gz", "/root/pypi/+e/x/+static-1/y"]
+    for path in paths:
+        orig_request = make_orig_request(
+            request, "http://localhost" + path, routes_mapper)
+        # the nginx locations allow the same paths as the route classifier
+        assert bool(regexp.match(path)) == classifier.is_always_ok(orig_request), path
+
+
+@pytest.mark.skipif(
+    devpi_server_version < parse_version("6dev"),
+    reason="Needs devpiserver_genconfig hook")
+def test_gen_config_nginx_cache(tmpdir):
+    tmpdir.chdir()
+    proc = subprocess.Popen([
+        "devpi-gen-config", "--lockdown-nginx-cache-expiry", "30"])
+    res = proc.wait()
+    assert res == 0
+    path = tmpdir.join("gen-config").join("nginx-devpi-lockdown.conf")
+    content = path.read()
+    (http_part, server_part) = content.split("\nserver {")
+    assert "proxy_cache_path " in http_part
+    assert "keys_zone=devpi_lockdown_authcheck:" in http_part
+    (authcheck_part,) = [
+        x for x in server_part.split("location")
+        if x.startswith(" = /+authcheck")]
+    assert "proxy_cache devpi_lockdown_authcheck;" in authcheck_part
+    assert "$cookie_auth_tkt" in authcheck_part
+    assert "$http_authorization" in authcheck_part
+    # replicas authenticate with the UUID in addition to the bearer token
+    assert "$http_x_devpi_replica_uuid" in authcheck_part
+    assert "proxy_cache_valid 200 401 403 30s;" in authcheck_part
+
+
+@pytest.mark.skipif(
+    devpi_server_version < parse_version("6dev"),
+    reason="Needs devpiserver_genconfig hook")
+def test_gen_config_authcheck_url(tmpdir):
+    tmpdir.chdir()
+    proc = subprocess.Popen([
+        "devpi-gen-config", "--lockdown-authcheck-url", "http://localhost:3142/",
+        "--lockdown-nginx-keepalive", "0"])
+    res = proc.wait()
+    assert res == 0
+    path = tmpdir.join("gen-config").join("nginx-devpi-lockdown.conf")
+    content = path.read()
+    assert "upstream" not in content
+    (authcheck_part,) = [
+        x for x in content.split("location")
+        if x.startswith(" = /+authcheck")]
+    assert "proxy_pass http://localhost:3142;" in authcheck_part
+
+
+@pytest.mark.skipif(
+    devpi_server_version < parse_version("6dev"),
+    reason="Needs devpiserver_genconfig hook")
+def test_gen_config_cookie_renewal(tmpdir):
+    tmpdir.chdir()
+    proc = subprocess.Popen(["devpi-gen-config"])
+    assert proc.wait() == 0
+    path = tmpdir.join("gen-config").join("nginx-devpi-lockdown.conf")
+    assert "auth_request_set" not in path.read()
+    proc = subprocess.Popen([
+        "devpi-gen-config", "--lockdown-cookie-renewal", "3600"])
+    assert proc.wait() == 0
+    server_part = path.read().split("location = /+authcheck")[0]
+    assert (
+        "auth_request_set $devpi_lockdown_cookie $upstream_http_set_cookie;"
+        in server_part)
+    assert "add_header Set-Cookie $devpi_lockdown_cookie;" in server_part
+
+
+@pytest.mark.skipif(
+    devpi_server_version < parse_version("6dev"),
+    reason="Needs devpiserver_genconfig hook")
+def test_gen_config_rate_limit(tmpdir):
+    tmpdir.chdir()
+    proc = subprocess.Popen(["devpi-gen-config"])
+    assert proc.wait() == 0
+    path = tmpdir.join("gen-config").join("nginx-devpi-lockdown.conf")
+    assert "@error500" not in path.read()
+    proc = subprocess.Popen([
+        "devpi-gen-config", "--lockdown-rate-limit", "10"])
+    assert proc.wait() == 0
+    server_part = path.read().split("location = /+authcheck")[0]
+    assert (
+        "auth_request_set $devpi_lockdown_status $upstream_status;"
+        in server_part)
+    assert "error_page 500 = @error500;" in server_part
+    assert "if ($devpi_lockdown_status = 429) {" in server_part
+    proc = subprocess.Popen([
+        "devpi-gen-config", "--lockdown-verification-limit", "2"])
+    assert proc.wait() == 0
+    server_part = path.read().split("location = /+authcheck")[0]
+    assert "error_page 500 = @error500;" in server_part
+    assert "if ($devpi_lockdown_status = 503) {" in server_part
+
+
+@pytest.mark.skipif(
+    devpi_server_version < parse_version("6dev"),
+    reason="Needs devpiserver_genconfig hook")
+def test_gen_config_identity_header(tmpdir):
+    tmpdir.chdir()
+    proc = subprocess.Popen([
+        "devpi-gen-config", "--lockdown-identity-header-expiry", "30"])
+    assert proc.wait() == 0
+    path = tmpdir.join("gen-config").join("nginx-devpi-lockdown.conf")
+    content = path.read()
+    server_part = content.split("location = /+authcheck")[0]
+    assert (
+        "auth_request_set $devpi_lockdown_identity "
+        "$upstream_http_x_devpi_lockdown_identity;" in server_part)
+    header_line = (
+        "proxy_set_header X-Devpi-Lockdown-Identity $devpi_lockdown_identity;")
+    (app_part,) = [
+        x for x in content.split("location") if x.startswith(" @proxy_to_app")]
+    assert header_line in app_part
+    # always allowed locations drop headers sent by clients
+    (api_part,) = [
+        x for x in content.split("location") if "/\\+api$" in x]
+    assert header_line in api_part
+
+
+@pytest.mark.skipif(
+    devpi_server_version < parse_version("6dev"),
+    reason="Needs devpiserver_genconfig hook")
+def test_gen_config_keepalive(tmpdir):
+    tmpdir.chdir()
+    proc = subprocess.Popen(["devpi-gen-config", "--port", "3143"])
+    res = proc.wait()
+    assert res == 0
+    path = tmpdir.join("gen-config").join("nginx-devpi-lockdown.conf")
+    content = path.read()
+    (http_part, server_part) = content.split("\nserver {")
+    assert "upstream devpi_lockdown_app {" in http_part
+    assert "server localhost:3143;" in http_part
+    assert "keepalive 16;" in http_part
+    assert "localhost:3143" not in server_part
+    locations = server_part.split("location")
+    (authcheck_part,) = [x for x in locations if x.startswith(" = /+authcheck")]
+    (app_part,) = [x for x in locations if x.startswith(" @proxy_to_app")]
+    for part in (authcheck_part, app_part):
+        assert "proxy_pass http://devpi_lockdown_app;" in part
+        assert "proxy_http_version 1.1;" in part
+        assert 'proxy_set_header Connection "";' in part
+
+
+def test_authcheck_cache_control(maketestapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+
+    xom = makexom(
+        opts=["--lockdown-nginx-cache-expiry", "30"],
+        plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    r = testapp.xget(401, 'http://localhost/+authcheck')
+    assert r.headers['Cache-Control'] == 'max-age=30'
+    r = testapp.xget(
+        200, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({
+            'X-Original-URI': 'http://localhost/+api'}))
+    assert r.headers['Cache-Control'] == 'max-age=30'
+    r = testapp.xget(200, 'http://localhost/+api')
+    assert 'max-age' not in r.headers.get('Cache-Control', '')
+
+
 @pytest.mark.skipif(
     devpi_server_version < parse_version("6dev"),
     reason="Needs devpiserver_authcheck_* hooks")
@@ -294,3 +522,1437 @@ def test_deny_login(makemapp, maketestapp, makexom):
         dict(username="user1", password="1", submit=""),
         code=401)
     assert "has no permission to login with the" in r.text
+
+
+@pytest.mark.parametrize("shared", [False, True])
+def test_authcheck_cache(maketestapp, makexom, shared, tmpdir):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_lockdown.main import devpiserver_hookimpl
+    from pyramid.authentication import b64encode
+    from webob.headers import ResponseHeaders
+
+    calls = []
+
+    class Plugin:
+        @devpiserver_hookimpl
+        def devpiserver_authcheck_unauthorized(self, request):
+            calls.append(request)
+
+    opts = ["--lockdown-authcheck-cache-expiry", "60"]
+    if shared:
+        opts.extend([
+            "--lockdown-authcheck-cache-path", tmpdir.join("verdicts").strpath])
+    xom = makexom(opts=opts, plugins=[lockdown_plugin, Plugin()])
+    testapp = maketestapp(xom)
+    headers = ResponseHeaders({
+        'X-Original-URI': 'http://localhost/root/pypi/+simple/pkg'})
+    testapp.xget(401, 'http://localhost/+authcheck', headers=headers)
+    assert len(calls) == 1
+    testapp.xget(401, 'http://localhost/+authcheck', headers=headers)
+    assert len(calls) == 1
+    # a different index is a different route class
+    headers = ResponseHeaders({
+        'X-Original-URI': 'http://localhost/root/dev/+simple/pkg'})
+    testapp.xget(401, 'http://localhost/+authcheck', headers=headers)
+    assert len(calls) == 2
+    # other credentials don't share the verdict
+    headers['Authorization'] = 'Basic %s' % b64encode('user1:1').decode('ascii')
+    testapp.xget(401, 'http://localhost/+authcheck', headers=headers)
+    assert len(calls) == 3
+    r = testapp.get_json('http://localhost/+status')
+    metrics = {x[0]: x[2] for x in r.json['result']['metrics']}
+    assert metrics['devpi_lockdown_authcheck_cache_hits'] == 1
+    assert metrics['devpi_lockdown_authcheck_cache_misses'] == 3
+
+
+def test_shared_verdict_cache(monkeypatch, tmpdir):
+    from devpi_lockdown import verdicts
+    from devpi_lockdown.verdicts import SharedVerdictCache
+
+    path = tmpdir.join("verdicts").strpath
+    cache1 = SharedVerdictCache(path, 100, default_timeout=60)
+    cache2 = SharedVerdictCache(path, 100, default_timeout=60)
+    key = (b'digest', False, ('/{user}/{index}', 'root', 'pypi'))
+    assert cache2.get(key) is None
+    cache1.put(key, '401')
+    assert cache2.get(key) == '401'
+    assert cache2.get((b'other', False, None)) is None
+    assert (cache2.hits, cache2.misses, cache2.lookups) == (1, 2, 3)
+    assert cache1.size == 1
+    # a slot which fails the checksum is a miss
+    (digest, offset) = cache1._locate(key)
+    cache1.mmap[offset + 40] = 0xff
+    assert cache2.get(key) is None
+    cache1.put(key, '200')
+    assert cache2.get(key) == '200'
+    # expired verdicts are misses
+    now = verdicts.time.time()
+    monkeypatch.setattr(verdicts.time, "time", lambda: now + 61)
+    assert cache2.get(key) is None
+    assert cache1.size == 0
+    monkeypatch.undo()
+    # a different number of slots replaces the file
+    cache3 = SharedVerdictCache(path, 50, default_timeout=60)
+    assert cache3.get(key) is None
+    assert cache1.get(key) == '200'
+
+
+def test_cookie_signer():
+    from devpi_lockdown.cookie import CookieSigner
+
+    signer = CookieSigner([("new", "secret2"), ("old", "secret1")])
+    old_signer = CookieSigner([("old", "secret1")])
+    value = signer.sign("user1", ["group1", "group2"], 1000)
+    assert value.startswith("s1.new.")
+    claim = signer.verify(value, now=999)
+    assert claim.username == "user1"
+    assert claim.groups == ["group1", "group2"]
+    assert claim.keyid == "new"
+    # expired
+    assert signer.verify(value, now=1000) is None
+    # unknown key id
+    assert old_signer.verify(value, now=999) is None
+    # key rotation, the old key is still accepted
+    value = old_signer.sign("user1", [], 1000)
+    claim = signer.verify(value, now=999)
+    assert claim.username == "user1"
+    assert claim.groups == []
+    assert claim.keyid == "old"
+    # each value is unique
+    assert old_signer.sign("user1", [], 1000) != value
+    # tampering
+    (prefix, keyid, username, groups, expires, nonce, signature) = (
+        value.split('.'))
+    assert signer.verify('.'.join(
+        (prefix, keyid, username, groups, "2000", nonce, signature)),
+        now=999) is None
+    assert signer.verify('.'.join(
+        (prefix, keyid, username, groups, expires, "AAAAAAAA", signature)),
+        now=999) is None
+    assert signer.verify("foo", now=999) is None
+    assert signer.verify("s1.old.foo", now=999) is None
+
+
+def test_signed_cookie(maketestapp, makemapp, makexom, monkeypatch, tmpdir):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_server.model import RootModel
+
+    keys = tmpdir.join("keys")
+    keys.write("# current key\nkey2 secret2\nkey1 secret1\n")
+    xom = makexom(
+        opts=["--lockdown-cookie-keys", keys.strpath],
+        plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    r = testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="1", submit=""))
+    assert r.status_code == 302
+    cookie = testapp.cookies['auth_tkt']
+    assert cookie.startswith('s1.key2.')
+
+    def get_user(self, name):
+        raise AssertionError("no user lookup expected")
+
+    monkeypatch.setattr(RootModel, "get_user", get_user)
+    testapp.xget(200, 'http://localhost/+authcheck')
+    monkeypatch.undo()
+    testapp.set_cookie('auth_tkt', cookie[:-1])
+    testapp.xget(401, 'http://localhost/+authcheck')
+
+
+def test_compact_cookie():
+    from devpi_lockdown.cookie import decode_compact
+    from devpi_lockdown.cookie import encode_compact
+    import itsdangerous
+
+    serializer = itsdangerous.TimedSerializer("secret")
+    token = serializer.dumps(["user1", ["group1", "group2"], True])
+    value = encode_compact("user1", token, serializer)
+    assert value.startswith("c1.")
+    assert len(value) < len(token)
+    assert decode_compact(value, serializer) == ("user1", token)
+    token = serializer.dumps(["\xfcser", [], False])
+    value = encode_compact("\xfcser", token, serializer)
+    assert decode_compact(value, serializer) == ("\xfcser", token)
+    # tokens which can't be restored exactly aren't encoded
+    assert encode_compact("user2", token, serializer) is None
+    assert encode_compact("user1", "foo", serializer) is None
+    token = serializer.dumps(["user1", "group1", True])
+    assert encode_compact("user1", token, serializer) is None
+    assert decode_compact("c1.", serializer) is None
+    assert decode_compact("c1.AQV1c2Vy", serializer) is None
+
+
+def test_login_compact_cookie(mapp, testapp):
+    from urllib.parse import quote
+
+    mapp.create_user("user1", "1")
+    r = testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="1", submit=""))
+    assert r.status_code == 302
+    cookie = testapp.cookies['auth_tkt']
+    assert cookie.startswith('c1.')
+    testapp.xget(200, 'http://localhost/+authcheck')
+    testapp.set_cookie('auth_tkt', cookie[:-2])
+    testapp.xget(401, 'http://localhost/+authcheck')
+    # the previous format is still accepted
+    mapp.login("user1", "1")
+    (username, token) = testapp.auth
+    testapp.auth = None
+    testapp.set_cookie('auth_tkt', quote("user1:%s" % token))
+    testapp.xget(200, 'http://localhost/+authcheck')
+
+
+def test_cookie_renewal(maketestapp, makemapp, makexom, monkeypatch):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_lockdown.cookie import CookieSigner
+    from devpi_server.auth import Auth
+    import devpi_web.main
+    import itsdangerous
+    import time
+
+    xom = makexom(
+        opts=["--lockdown-cookie-renewal", "60"],
+        plugins=[(devpi_web.main, None), (lockdown_plugin, None)])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+
+    def login():
+        testapp.cookiejar.clear()
+        r = testapp.post(
+            'http://localhost/+login',
+            dict(username="user1", password="1", submit=""))
+        assert r.status_code == 302
+        return testapp.cookies['auth_tkt']
+
+    def authcheck(cookie):
+        testapp.set_cookie('auth_tkt', cookie)
+        r = testapp.xget(200, 'http://localhost/+authcheck')
+        return r.headers.get('Set-Cookie')
+
+    # a fresh cookie isn't renewed
+    cookie = login()
+    assert authcheck(cookie) is None
+    # one which expires within the window is
+    get_timestamp = itsdangerous.TimestampSigner.get_timestamp
+    monkeypatch.setattr(
+        itsdangerous.TimestampSigner, "get_timestamp",
+        lambda self: get_timestamp(self) - Auth.LOGIN_EXPIRATION + 30)
+    cookie = login()
+    monkeypatch.undo()
+    header = authcheck(cookie)
+    assert header.startswith('auth_tkt=c1.')
+    assert 'Max-Age=%s' % Auth.LOGIN_EXPIRATION in header
+    renewed = header.split(';')[0].split('=', 1)[1]
+    assert renewed != cookie
+    assert authcheck(renewed) is None
+    # always allowed routes don't renew
+    testapp.set_cookie('auth_tkt', cookie)
+    r = testapp.xget(
+        200, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({'X-Original-URI': 'http://localhost/+api'}))
+    assert 'Set-Cookie' not in r.headers
+    # signed cookies are renewed as well, but not for removed users
+    signer = CookieSigner([("key1", "secret1")])
+    monkeypatch.setitem(
+        testapp.app.app.registry, 'lockdown_cookie_signer', signer)
+    header = authcheck(signer.sign("user1", [], time.time() + 30))
+    assert header.startswith('auth_tkt=s1.key1.')
+    claim = signer.verify(header.split(';')[0].split('=', 1)[1])
+    assert claim.expires > time.time() + Auth.LOGIN_EXPIRATION - 10
+    assert authcheck(signer.sign("user2", [], time.time() + 30)) is None
+
+
+def test_bloom_filter():
+    from devpi_lockdown.revocation import BloomFilter
+    from devpi_lockdown.revocation import get_digest
+
+    bloom = BloomFilter(1 << 16, 4)
+    digests = [get_digest(str(i)) for i in range(1000)]
+    for digest in digests[:500]:
+        bloom.add(digest)
+    assert all(x in bloom for x in digests[:500])
+    false_positives = sum(x in bloom for x in digests[500:])
+    assert false_positives < 5
+
+
+def test_revocation(maketestapp, makemapp, makexom, monkeypatch):
+    from devpi_lockdown import main as lockdown_plugin
+    from pyramid.authentication import b64encode
+    from urllib.parse import quote as url_quote
+    import devpi_web.main
+    import itsdangerous
+    import time
+
+    xom = makexom(plugins=[(devpi_web.main, None), (lockdown_plugin, None)])
+    testapp = maketestapp(xom)
+    xom.thread_pool.start_one(xom.keyfs.notifier)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    mapp.create_user("user2", "2")
+
+    def wait():
+        xom.keyfs.notifier.wait_event_serial(xom.keyfs.get_current_serial())
+
+    def login():
+        testapp.cookiejar.clear()
+        r = testapp.post(
+            'http://localhost/+login',
+            dict(username="user1", password="1", submit=""))
+        assert r.status_code == 302
+        return testapp.cookies['auth_tkt']
+
+    def authcheck(code, cookie):
+        testapp.set_cookie('auth_tkt', cookie)
+        testapp.xget(code, 'http://localhost/+authcheck')
+
+    # logging out revokes the cookie
+    now = int(time.time())
+    monkeypatch.setattr(
+        itsdangerous.TimestampSigner, "get_timestamp", lambda self: now)
+    cookie = login()
+    authcheck(200, cookie)
+    testapp.post('http://localhost/+logout')
+    wait()
+    authcheck(401, cookie)
+    # a revoked cookie is still dropped by a logout
+    testapp.set_cookie('auth_tkt', cookie)
+    r = testapp.post('http://localhost/+logout')
+    assert r.status_code == 302
+    assert 'Max-Age=0' in r.headers['Set-Cookie']
+    # a login in the same second would get the revoked token again
+    testapp.cookiejar.clear()
+    r = testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="1", submit=""),
+        expect_errors=True)
+    assert r.status_code == 429
+    assert r.headers['Retry-After'] == '1'
+    assert 'auth_tkt' not in testapp.cookies
+    monkeypatch.setattr(
+        itsdangerous.TimestampSigner, "get_timestamp", lambda self: now + 1)
+    other = login()
+    authcheck(200, other)
+    monkeypatch.undo()
+    # the token of another user can't be revoked with a logout
+    mapp.login("user1", "1")
+    (username, token) = testapp.auth
+    testapp.auth = None
+    for username in ("nosuchuser", "root"):
+        testapp.cookiejar.clear()
+        testapp.set_cookie('auth_tkt', url_quote("%s:%s" % (username, token)))
+        testapp.post('http://localhost/+logout')
+    wait()
+    with xom.keyfs.read_transaction():
+        assert not xom.keyfs.USER(user="nosuchuser").get()
+        assert 'lockdown_revoked' not in xom.keyfs.USER(user="root").get()
+    testapp.xget(
+        200, '/+authcheck', headers=ResponseHeaders({
+            'Authorization': 'Basic %s' % b64encode(
+                'user1:%s' % token).decode('ascii')}))
+    # all tokens issued before can be revoked by the user or root
+    get_timestamp = itsdangerous.TimestampSigner.get_timestamp
+    monkeypatch.setattr(
+        itsdangerous.TimestampSigner, "get_timestamp",
+        lambda self: get_timestamp(self) - 10)
+    cookie = login()
+    mapp.login("user1", "1")
+    (username, token) = testapp.auth
+    testapp.auth = None
+    monkeypatch.undo()
+    testapp.cookiejar.clear()
+
+    def basic(username, password):
+        return ResponseHeaders({'Authorization': 'Basic %s' % b64encode(
+            '%s:%s' % (username, password)).decode('ascii')})
+
+    testapp.xget(200, '/+authcheck', headers=basic("user1", token))
+    r = testapp.post(
+        '/+lockdown/revoke/user1', headers=basic("user2", "2"),
+        expect_errors=True)
+    assert r.status_code == 403
+    r = testapp.post(
+        '/+lockdown/revoke/user3', headers=basic("user1", "1"),
+        expect_errors=True)
+    assert r.status_code == 404
+    r = testapp.post('/+lockdown/revoke/user1', headers=basic("user1", "1"))
+    assert r.status_code == 200
+    wait()
+    authcheck(401, cookie)
+    testapp.cookiejar.clear()
+    testapp.xget(401, '/+authcheck', headers=basic("user1", token))
+    # passwords and new logins still work
+    testapp.xget(200, '/+authcheck', headers=basic("user1", "1"))
+    authcheck(200, login())
+
+
+@pytest.mark.parametrize("shared, cached", [
+    (False, True), (True, True), (True, False)])
+def test_revocation_authcheck_cache(maketestapp, makemapp, makexom, shared, cached, tmpdir):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_lockdown.revocation import RevocationTable
+    import devpi_web.main
+
+    opts = ["--lockdown-authcheck-cache-expiry", "60"]
+    if shared:
+        opts.extend([
+            "--lockdown-authcheck-cache-path",
+            tmpdir.join("verdicts").strpath])
+    xom = makexom(
+        opts=opts, plugins=[(devpi_web.main, None), (lockdown_plugin, None)])
+    testapp = maketestapp(xom)
+    xom.thread_pool.start_one(xom.keyfs.notifier)
+    if not cached:
+        # like with --requests-only
+        testapp.app.app.registry['lockdown_revocations'] = RevocationTable(
+            cached=False)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="1", submit=""))
+    cookie = testapp.cookies['auth_tkt']
+    cache = testapp.app.app.registry['lockdown_authcheck_cache']
+    testapp.xget(200, 'http://localhost/+authcheck')
+    testapp.xget(200, 'http://localhost/+authcheck')
+    assert cache.hits == 1
+    testapp.post('http://localhost/+logout')
+    xom.keyfs.notifier.wait_event_serial(xom.keyfs.get_current_serial())
+    # the cached verdict isn't reused for the revoked cookie
+    testapp.set_cookie('auth_tkt', cookie)
+    testapp.xget(401, 'http://localhost/+authcheck')
+
+
+def test_credential_cache(maketestapp, makemapp, makexom, monkeypatch):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_server.auth import Auth
+    from devpi_server.model import User
+    from pyramid.authentication import b64encode
+    import itsdangerous
+
+    validate = User.validate
+    calls = []
+
+    def counting_validate(self, password):
+        calls.append(password)
+        return validate(self, password)
+
+    monkeypatch.setattr(User, "validate", counting_validate)
+    xom = makexom(
+        opts=["--lockdown-credential-cache-expiry", "60"],
+        plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    # like in devpi-server the notifier starts after the app is created
+    xom.thread_pool.start_one(xom.keyfs.notifier)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    xom.keyfs.notifier.wait_event_serial(xom.keyfs.get_current_serial())
+
+    def authcheck(code, password):
+        basic_auth = b64encode('user1:%s' % password).decode('ascii')
+        testapp.xget(
+            code, 'http://localhost/+authcheck',
+            headers=ResponseHeaders({
+                'Authorization': 'Basic %s' % basic_auth}))
+
+    authcheck(200, "1")
+    assert calls == ["1"]
+    authcheck(200, "1")
+    assert calls == ["1"]
+    # failures are not remembered
+    authcheck(401, "2")
+    authcheck(401, "2")
+    assert calls == ["1", "2", "2"]
+    # changing the password invalidates the verification
+    mapp.login("user1", "1")
+    r = testapp.patch_json("/user1", dict(password="3"))
+    mapp._wait_for_serial_in_result(r)
+    testapp.auth = None
+    del calls[:]
+    authcheck(401, "1")
+    assert calls == ["1"]
+    authcheck(200, "3")
+    authcheck(200, "3")
+    assert calls == ["1", "3"]
+    # login tokens aren't remembered beyond their expiration
+    mapp.login("user1", "3")
+    (username, token) = testapp.auth
+    testapp.auth = None
+    authcheck(200, token)
+    authcheck(200, token)
+    get_timestamp = itsdangerous.TimestampSigner.get_timestamp
+    monkeypatch.setattr(
+        itsdangerous.TimestampSigner, "get_timestamp",
+        lambda self: get_timestamp(self) + Auth.LOGIN_EXPIRATION + 10)
+    authcheck(401, token)
+
+
+def test_authcheck_fast_path(maketestapp, makemapp, makexom, monkeypatch):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_server.replica import get_auth_serializer
+    from pyramid.authentication import b64encode
+
+    xom = makexom(
+        opts=["--lockdown-credential-cache-expiry", "60"],
+        plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    xom.thread_pool.start_one(xom.keyfs.notifier)
+    mapp = makemapp(testapp)
+    mapp.create_and_use("user1/dev", password="1")
+    mapp.upload_file_pypi("pkg1-2.6.tgz", b"123", "pkg1", "2.6")
+    (path,) = mapp.get_release_paths("pkg1")
+    testapp.auth = None
+    xom.keyfs.notifier.wait_event_serial(xom.keyfs.get_current_serial())
+    read_transaction = xom.keyfs.read_transaction
+    transactions = []
+
+    def counting_read_transaction(*args, **kwargs):
+        transactions.append(args)
+        return read_transaction(*args, **kwargs)
+
+    monkeypatch.setattr(
+        xom.keyfs, "read_transaction", counting_read_transaction)
+    basic_auth = 'Basic %s' % b64encode('user1:1').decode('ascii')
+
+    def authcheck(code, url, **headers):
+        headers['X-Original-URI'] = 'http://localhost%s' % url
+        del transactions[:]
+        testapp.xget(
+            code, 'http://localhost/+authcheck',
+            headers=ResponseHeaders(headers))
+        return len(transactions)
+
+    # always allowed routes and missing credentials
+    assert authcheck(200, '/+api') == 0
+    assert authcheck(401, '/user1/dev') == 0
+    assert authcheck(403, '/user1/dev', **{'User-Agent': 'devpi-client'}) == 0
+    # the credentials are verified and the index configuration read once
+    assert authcheck(200, '/user1/dev', Authorization=basic_auth) == 1
+    assert authcheck(200, '/user1/dev', Authorization=basic_auth) == 0
+    assert authcheck(200, '/+login', Authorization=basic_auth) == 0
+    # unknown credentials need the full path
+    bad_auth = 'Basic %s' % b64encode('user1:2').decode('ascii')
+    assert authcheck(401, '/user1/dev', Authorization=bad_auth) == 1
+    # so does the pkg_read permission of files
+    assert authcheck(200, path, Authorization=basic_auth) == 1
+    assert authcheck(401, path) == 1
+    # identities without credentials, like the one of replicas
+    monkeypatch.setitem(xom.config.nodeinfo, "role", "primary")
+    uuid = "replica1"
+    token = get_auth_serializer(xom.config).dumps(uuid)
+    assert authcheck(
+        200, '/user1/dev', Authorization='Bearer %s' % token,
+        **{'X-Devpi-Replica-UUID': uuid}) == 1
+    assert authcheck(
+        401, '/user1/dev', Authorization='Bearer %s' % token) == 1
+    assert lockdown_plugin.can_use_fast_path(xom.config.hook)
+
+
+def test_read_acl(maketestapp, makemapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+
+    xom = makexom(plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    xom.thread_pool.start_one(xom.keyfs.notifier)
+    mapp = makemapp(testapp)
+    mapp.create_user("user2", "2")
+    mapp.create_user("user3", "3")
+    api1 = mapp.create_and_use("user1/dev", indexconfig=dict(
+        lockdown_acl_read="user2"))
+    api2 = mapp.create_index("user1/open")
+    xom.keyfs.notifier.wait_event_serial(xom.keyfs.get_current_serial())
+
+    def authcheck(code, url):
+        testapp.xget(
+            code, '/+authcheck',
+            headers=ResponseHeaders({'X-Original-URI': url}))
+
+    # the owner can always read
+    authcheck(200, api1.index)
+    authcheck(200, api1.simpleindex + "hello/")
+    mapp.login("user2", "2")
+    authcheck(200, api1.index)
+    authcheck(200, api2.index)
+    mapp.login("user3", "3")
+    authcheck(403, api1.index)
+    authcheck(403, api1.simpleindex + "hello/")
+    authcheck(200, api2.index)
+    # restrictions of bases apply as well
+    api3 = mapp.create_index("user3/dev", indexconfig=dict(
+        bases="user1/dev"))
+    authcheck(403, api3.index)
+    # changing the index configuration updates the restrictions
+    mapp.login("user1", "123")
+    r = testapp.patch_json(api1.index, [
+        "lockdown_acl_read+=user3"])
+    mapp._wait_for_serial_in_result(r)
+    mapp.login("user3", "3")
+    authcheck(200, api1.index)
+    authcheck(200, api3.index)
+    mapp.login("user2", "2")
+    authcheck(200, api1.index)
+    # like with acl_upload everyone may read with :ANONYMOUS:
+    api4 = mapp.create_index("user2/anon", indexconfig=dict(
+        lockdown_acl_read=":ANONYMOUS:"))
+    mapp.login("user3", "3")
+    authcheck(200, api4.index)
+    # only changes of the restrictions or bases of an index drop the
+    # restrictions computed from it
+    read_acls = testapp.app.app.registry['lockdown_read_acls']
+    assert read_acls.get_cached_restrictions("user1", "dev")
+    assert read_acls.get_cached_restrictions("user3", "dev")
+    r = testapp.patch_json(api3.index, ["title=changed"])
+    mapp._wait_for_serial_in_result(r)
+    assert read_acls.get_cached_restrictions("user1", "dev")
+    assert read_acls.get_cached_restrictions("user3", "dev")
+    mapp.login("user1", "123")
+    r = testapp.patch_json(api1.index, ["lockdown_acl_read-=user2"])
+    mapp._wait_for_serial_in_result(r)
+    assert read_acls.get_cached_restrictions("user1", "dev") is None
+    assert read_acls.get_cached_restrictions("user3", "dev") is None
+    assert read_acls.get_cached_restrictions("user2", "anon") == ()
+    mapp.login("user2", "2")
+    authcheck(403, api1.index)
+
+
+def test_api_keys(maketestapp, makemapp, makexom, monkeypatch):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_server.model import User
+    from pyramid.authentication import b64encode
+
+    xom = makexom(plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    xom.thread_pool.start_one(xom.keyfs.notifier)
+    mapp = makemapp(testapp)
+    api1 = mapp.create_and_use("user1/dev")
+    api2 = mapp.create_index("user1/other")
+    (username, token) = testapp.auth
+    testapp.auth = None
+
+    def basic(username, password):
+        return 'Basic %s' % b64encode(
+            '%s:%s' % (username, password)).decode('ascii')
+
+    def authcheck(code, url, authorization):
+        testapp.xget(
+            code, '/+authcheck',
+            headers=ResponseHeaders({
+                'Authorization': authorization,
+                'X-Original-URI': url}))
+
+    headers = ResponseHeaders({'Authorization': basic("user1", token)})
+    r = testapp.post_json('/+api-keys', {}, headers=headers)
+    assert r.status_code == 201
+    (keyid, key) = (r.json['result']['id'], r.json['result']['key'])
+    assert key.startswith('k1.')
+    r = testapp.post_json(
+        '/+api-keys', {'indexes': ['user1/dev']}, headers=headers)
+    (scoped_keyid, scoped_key) = (
+        r.json['result']['id'], r.json['result']['key'])
+    r = testapp.post_json(
+        '/+api-keys', {'indexes': 'user1/dev'}, headers=headers,
+        expect_errors=True)
+    assert r.status_code == 400
+    r = testapp.xget(200, '/+api-keys', headers=headers)
+    assert r.json['result'] == {
+        keyid: {'created': mock.ANY, 'indexes': None},
+        scoped_keyid: {'created': mock.ANY, 'indexes': ['user1/dev']}}
+    assert key not in r.text
+    xom.keyfs.notifier.wait_event_serial(xom.keyfs.get_current_serial())
+
+    def validate(self, password):
+        raise AssertionError("no password hash check expected")
+
+    monkeypatch.setattr(User, "validate", validate)
+    for authorization in (basic("user1", key), "Bearer %s" % key):
+        authcheck(200, api1.index, authorization)
+        authcheck(200, api2.index, authorization)
+    # API keys are restricted to their indexes
+    authcheck(200, api1.index, "Bearer %s" % scoped_key)
+    authcheck(403, api2.index, "Bearer %s" % scoped_key)
+    for (code, api) in ((200, api1), (403, api2)):
+        r = testapp.patch_json(
+            api.index, ["title=CI"], expect_errors=True,
+            headers=ResponseHeaders({
+                'Authorization': "Bearer %s" % scoped_key}))
+        assert r.status_code == code
+    # a key only works for its user
+    authcheck(401, api1.index, basic("user2", key))
+    authcheck(401, api1.index, "Bearer %s" % key[:-1])
+    authcheck(401, api1.index, basic("user1", key[:-1]))
+    # API keys can't manage API keys
+    testapp.xget(
+        403, '/+api-keys',
+        headers=ResponseHeaders({'Authorization': "Bearer %s" % key}))
+    monkeypatch.undo()
+    r = testapp.delete('/+api-keys/%s' % keyid, headers=headers)
+    assert r.status_code == 200
+    testapp.xdel(404, '/+api-keys/%s' % keyid, headers=headers)
+    xom.keyfs.notifier.wait_event_serial(xom.keyfs.get_current_serial())
+    authcheck(401, api1.index, "Bearer %s" % key)
+    authcheck(200, api1.index, "Bearer %s" % scoped_key)
+
+
+def test_identity_signer():
+    from devpi_lockdown.apikeys import ApiKeyIdentity
+    from devpi_lockdown.identity import IdentitySigner
+    from devpi_server.view_auth import CredentialsIdentity
+
+    signer = IdentitySigner(b'secret', 30)
+    value = signer.sign(CredentialsIdentity('user1', ['g1']), '/user1/dev', now=100)
+    assert value.startswith('i1.')
+    identity = signer.verify(value, '/user1/dev', now=129)
+    assert (identity.username, identity.groups) == ('user1', ['g1'])
+    assert not isinstance(identity, ApiKeyIdentity)
+    # only valid for the same path, until it expires and unmodified
+    assert signer.verify(value, '/user1/other', now=129) is None
+    assert signer.verify(value, '/user1/dev', now=130) is None
+    assert signer.verify(value[:-1], '/user1/dev', now=129) is None
+    assert IdentitySigner(b'other', 30).verify(
+        value, '/user1/dev', now=129) is None
+    assert signer.verify('s1.foo', '/user1/dev') is None
+    # the scope of API keys is kept
+    value = signer.sign(
+        ApiKeyIdentity('user1', [], 'abcd', frozenset(['user1/dev'])),
+        '/user1/dev', now=100)
+    identity = signer.verify(value, '/user1/dev', now=100)
+    assert isinstance(identity, ApiKeyIdentity)
+    assert (identity.keyid, identity.indexes) == ('abcd', {'user1/dev'})
+
+
+def test_identity_header(maketestapp, makemapp, makexom, monkeypatch):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_server.model import User
+    from pyramid.authentication import b64encode
+
+    xom = makexom(
+        opts=["--lockdown-identity-header-expiry", "30"],
+        plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    api = mapp.create_and_use("user1/dev", password="1")
+    testapp.auth = None
+    basic_auth = 'Basic %s' % b64encode('user1:1').decode('ascii')
+
+    def authcheck(code, url, **headers):
+        headers['X-Original-URI'] = url
+        r = testapp.xget(
+            code, 'http://localhost/+authcheck',
+            headers=ResponseHeaders(headers))
+        return r.headers.get('X-Devpi-Lockdown-Identity')
+
+    assert authcheck(401, api.index) is None
+    assert authcheck(200, '/+api') is None
+    value = authcheck(200, api.index, Authorization=basic_auth)
+    assert value.startswith('i1.')
+
+    def validate(self, password):
+        raise AssertionError("no password hash check expected")
+
+    monkeypatch.setattr(User, "validate", validate)
+    r = testapp.patch_json(
+        api.index, ["title=CI"], expect_errors=True,
+        headers=ResponseHeaders({'X-Devpi-Lockdown-Identity': value}))
+    assert r.status_code == 200
+    # the header is only valid for the same path
+    r = testapp.patch_json(
+        api.index + '/', ["title=CI"], expect_errors=True,
+        headers=ResponseHeaders({'X-Devpi-Lockdown-Identity': value}))
+    assert r.status_code == 403
+    r = testapp.patch_json(
+        api.index, ["title=CI"], expect_errors=True,
+        headers=ResponseHeaders({'X-Devpi-Lockdown-Identity': value[:-1]}))
+    assert r.status_code == 403
+
+
+def test_authcheck_server(maketestapp, makemapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_lockdown.cookie import CookieSigner
+    from devpi_lockdown.identity import IdentitySigner
+    from devpi_lockdown.main import devpiserver_hookimpl
+    from devpi_lockdown.server import Authcheck
+    from devpi_lockdown.server import AuthcheckServer
+    from pyramid.authentication import b64encode
+    from urllib.request import Request
+    from urllib.request import urlopen
+    import threading
+    import time
+    import urllib.error
+
+    signer = CookieSigner([("key1", "secret1")])
+    identity_signer = IdentitySigner(b"secret2", 30)
+
+    class Plugin:
+        @devpiserver_hookimpl
+        def devpiserver_stage_get_principals_for_pkg_read(self, ixconfig):
+            return ['user2']
+
+    xom = makexom(plugins=[lockdown_plugin, Plugin()])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_user("user2", "2")
+    api = mapp.create_and_use("user1/dev", indexconfig=dict(
+        lockdown_acl_read="user1"))
+    mapp.create_index("user1/open")
+    server = AuthcheckServer(
+        ('localhost', 0),
+        Authcheck(xom, signer=signer, identity_signer=identity_signer), 2)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def authcheck(uri, **headers):
+        url = "http://localhost:%s/+authcheck" % server.server_address[1]
+        headers['X-Original-URI'] = uri
+        try:
+            with urlopen(Request(url, headers=headers)) as r:
+                return r.status
+        except urllib.error.HTTPError as e:
+            return e.code
+
+    def basic(username, password):
+        return 'Basic %s' % b64encode(
+            '%s:%s' % (username, password)).decode('ascii')
+
+    try:
+        assert authcheck("/+api") == 200
+        assert authcheck(api.index) == 401
+        assert authcheck(api.index, **{'User-Agent': 'devpi-client/7'}) == 403
+        assert authcheck(api.index, Authorization=basic("user1", "1")) == 401
+        assert authcheck(api.index, Authorization=basic("user1", "123")) == 200
+        assert authcheck("/user1", Authorization=basic("user2", "2")) == 200
+        assert authcheck(api.index, Authorization=basic("user2", "2")) == 403
+        # files need the pkg_read permission
+        for path in ("/+f/123/pkg-1.0.tgz", "/+e/foo/pkg-1.0.tgz"):
+            assert authcheck(
+                api.index + path, Authorization=basic("user1", "123")) == 403
+        assert authcheck(
+            "/user1/open/+f/123/pkg-1.0.tgz",
+            Authorization=basic("user2", "2")) == 200
+        assert authcheck(
+            "/user1/open/+f/123/pkg-1.0.tgz",
+            Authorization=basic("user1", "123")) == 403
+        cookie = signer.sign("user1", [], time.time() + 60)
+        assert authcheck(api.index, Cookie="auth_tkt=%s" % cookie) == 200
+        (status, headers) = server.authcheck.get_response(
+            api.index, {'Cookie': "auth_tkt=%s" % cookie})
+        assert status == 200
+        (value,) = [v for (k, v) in headers if k == 'X-Devpi-Lockdown-Identity']
+        assert identity_signer.verify(value, '/user1/dev').username == 'user1'
+        r = testapp.post_json(
+            '/+api-keys', {'indexes': ['user1/other']},
+            headers=ResponseHeaders({'Authorization': basic("user1", "123")}))
+        key = r.json['result']['key']
+        assert authcheck("/user1/other", Authorization="Bearer %s" % key) == 200
+        assert authcheck(api.index, Authorization="Bearer %s" % key) == 403
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_authcheck_server_keepalive():
+    from devpi_lockdown.server import AuthcheckServer
+    import http.client
+    import threading
+
+    authcheck = mock.Mock(get_response=mock.Mock(return_value=(200, [])))
+    server = AuthcheckServer(('localhost', 0), authcheck, 1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def connect():
+        return http.client.HTTPConnection(
+            'localhost', server.server_address[1], timeout=5)
+
+    try:
+        # idle keepalive connections don't occupy the only thread
+        idle = [connect(), connect()]
+        for connection in idle:
+            connection.request('GET', '/+authcheck')
+            assert connection.getresponse().read() == b''
+        connection = connect()
+        connection.request('GET', '/+authcheck')
+        assert connection.getresponse().status == 200
+        # the idle connections still work
+        for connection in idle:
+            connection.request('GET', '/+authcheck')
+            assert connection.getresponse().status == 200
+        # as do pipelined requests
+        connection = connect()
+        connection.connect()
+        connection.sock.sendall(b"GET /+authcheck HTTP/1.1\r\n\r\n" * 2)
+        data = b''
+        while data.count(b'HTTP/1.1 200') < 2:
+            data += connection.sock.recv(4096)
+        assert authcheck.get_response.call_count == 7
+        # an address in use is reported
+        with pytest.raises(OSError) as e:
+            AuthcheckServer(server.server_address, authcheck, 1)
+        assert e.value.errno is not None
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_throttle(maketestapp, makemapp, makexom, monkeypatch):
+    from devpi_lockdown import main as lockdown_plugin
+    import devpi_web.main
+    from devpi_server.model import User
+    from pyramid.authentication import b64encode
+
+    validate = User.validate
+    calls = []
+
+    def counting_validate(self, password):
+        calls.append(password)
+        return validate(self, password)
+
+    monkeypatch.setattr(User, "validate", counting_validate)
+    xom = makexom(
+        opts=["--lockdown-throttle-failures", "2"],
+        plugins=[(devpi_web.main, None), (lockdown_plugin, None)])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    mapp.create_user("user2", "2")
+    del calls[:]
+
+    def login(code, username, password, ip):
+        return testapp.post(
+            'http://localhost/+login',
+            dict(username=username, password=password, submit=""),
+            headers=ResponseHeaders({'X-Real-IP': ip}),
+            expect_errors=True).status_code == code
+
+    def authcheck(code, username, password, ip):
+        basic_auth = b64encode('%s:%s' % (username, password)).decode('ascii')
+        testapp.xget(
+            code, 'http://localhost/+authcheck',
+            headers=ResponseHeaders({
+                'Authorization': 'Basic %s' % basic_auth,
+                'X-Real-IP': ip}))
+
+    assert login(401, "user1", "wrong", "10.0.0.1")
+    authcheck(401, "user1", "wrong", "10.0.0.2")
+    assert len(calls) == 2
+    # the username is throttled, without checking the password
+    assert login(429, "user1", "1", "10.0.0.3")
+    authcheck(429, "user1", "1", "10.0.0.3")
+    assert len(calls) == 2
+    # other users are fine
+    assert login(302, "user2", "2", "10.0.0.3")
+    # the client IP is throttled for all users
+    authcheck(401, "user2", "wrong", "10.0.0.4")
+    authcheck(401, "user2", "wrong", "10.0.0.4")
+    assert len(calls) == 5
+    assert login(429, "user2", "2", "10.0.0.4")
+    authcheck(429, "user2", "2", "10.0.0.4")
+    assert len(calls) == 5
+
+
+def test_verification_limit(maketestapp, makemapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+    from pyramid.authentication import b64encode
+    import devpi_web.main
+
+    xom = makexom(
+        opts=[
+            "--lockdown-verification-limit", "1",
+            "--lockdown-verification-queue", "0"],
+        plugins=[(devpi_web.main, None), (lockdown_plugin, None)])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_and_use("user1/dev")
+    testapp.auth = None
+    limiter = testapp.app.app.registry['lockdown_verification_limiter']
+    basic_auth = 'Basic %s' % b64encode('user1:123').decode('ascii')
+
+    def authcheck(code, **headers):
+        testapp.xget(
+            code, 'http://localhost/+authcheck',
+            headers=ResponseHeaders(headers))
+
+    authcheck(200, Authorization=basic_auth)
+    assert limiter.pending == 0
+    # a verification is running
+    limiter.acquire()
+    authcheck(503, Authorization=basic_auth)
+    r = testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="123", submit=""),
+        expect_errors=True)
+    assert r.status_code == 503
+    # login tokens need no password hash check
+    mapp.login("user1", "123")
+    authcheck(200)
+    testapp.auth = None
+    limiter.release()
+    assert limiter.pending == 0
+    assert limiter.rejected == 2
+    authcheck(200, Authorization=basic_auth)
+
+
+def test_failure_throttle(monkeypatch):
+    from devpi_lockdown import throttle
+    from devpi_lockdown.throttle import FailureThrottle
+
+    now = [0.0]
+    monkeypatch.setattr(throttle.time, "monotonic", lambda: now[0])
+    t = FailureThrottle(2, 10)
+    t.failure("user1", "ip1")
+    assert not t.is_throttled("user1", "ip2")
+    t.failure("user1", "ip1")
+    assert t.is_throttled("user1", "ip2")
+    assert t.is_throttled("user2", "ip1")
+    assert not t.is_throttled("user2", "ip2")
+    now[0] = 9.0
+    assert t.is_throttled("user1", "ip2")
+    now[0] = 10.0
+    assert not t.is_throttled("user1", "ip2")
+    t.failure("user1", "ip1")
+    assert t.is_throttled("user1", "ip2")
+
+
+def test_rate_limiter(monkeypatch):
+    from devpi_lockdown import throttle
+    from devpi_lockdown.throttle import RateLimiter
+
+    now = [0.0]
+    monkeypatch.setattr(throttle.time, "monotonic", lambda: now[0])
+    limiter = RateLimiter(2, 3)
+    assert [limiter.acquire("user1") for i in range(3)] == [0, 0, 0]
+    assert limiter.acquire("user1") == 0.5
+    assert limiter.acquire("user2") == 0
+    now[0] = 0.25
+    assert limiter.acquire("user1") == 0.25
+    now[0] = 0.5
+    assert limiter.acquire("user1") == 0
+    assert limiter.acquire("user1") == 0.5
+    # the bucket refills up to the burst
+    now[0] = 100.0
+    assert [limiter.acquire("user1") for i in range(3)] == [0, 0, 0]
+    assert limiter.acquire("user1") == 0.5
+
+
+def test_rate_limit(maketestapp, makemapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+    from pyramid.authentication import b64encode
+
+    xom = makexom(
+        opts=[
+            "--lockdown-rate-limit", "0.01",
+            "--lockdown-anonymous-rate-limit", "0.01",
+            "--lockdown-rate-limit-burst", "2"],
+        plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    mapp.create_user("user2", "2")
+    testapp.auth = None
+
+    def authcheck(code, ip, username=None):
+        headers = {'X-Real-IP': ip}
+        if username is not None:
+            basic_auth = b64encode('%s:%s' % (username, username[-1]))
+            headers['Authorization'] = 'Basic %s' % basic_auth.decode('ascii')
+        return testapp.xget(
+            code, 'http://localhost/+authcheck',
+            headers=ResponseHeaders(headers))
+
+    authcheck(200, "10.0.0.1", "user1")
+    authcheck(200, "10.0.0.2", "user1")
+    r = authcheck(429, "10.0.0.3", "user1")
+    assert int(r.headers['Retry-After']) > 0
+    authcheck(200, "10.0.0.1", "user2")
+    # requests without valid credentials are limited per client IP
+    authcheck(401, "10.0.0.1")
+    authcheck(401, "10.0.0.1", "unknown")
+    authcheck(429, "10.0.0.1")
+    authcheck(429, "10.0.0.1", "unknown")
+    authcheck(401, "10.0.0.2")
+    # the limit of the user is separate
+    authcheck(200, "10.0.0.1", "user2")
+
+
+def test_anonymous_rate_limit(maketestapp, makemapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+    from pyramid.authentication import b64encode
+
+    xom = makexom(
+        opts=[
+            "--lockdown-anonymous-rate-limit", "0.001",
+            "--lockdown-rate-limit-burst", "2"],
+        plugins=[lockdown_plugin])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    testapp.auth = None
+    basic_auth = 'Basic %s' % b64encode('user1:1').decode('ascii')
+    # without a limit per user, authenticated requests aren't limited
+    codes = [
+        testapp.get(
+            'http://localhost/+authcheck', expect_errors=True,
+            headers=ResponseHeaders({
+                'X-Real-IP': '10.0.0.1',
+                'Authorization': basic_auth})).status_code
+        for i in range(4)]
+    assert codes == [200, 200, 200, 200]
+    codes = [
+        testapp.get(
+            'http://localhost/+authcheck', expect_errors=True,
+            headers=ResponseHeaders({'X-Real-IP': '10.0.0.1'})).status_code
+        for i in range(3)]
+    assert codes == [401, 401, 429]
+
+
+def test_audit_log(tmpdir):
+    from devpi_lockdown.audit import AuditLog
+    import json
+
+    path = tmpdir.join("audit.log")
+    audit = AuditLog(path.strpath, max_bytes=200, backups=2, size=3)
+    for i in range(5):
+        audit.record('login', user="user%s" % i)
+    assert audit.dropped == 2
+    assert audit.flush() == 3
+    assert audit.flush() == 0
+    records = [json.loads(x) for x in path.readlines()]
+    assert [x['user'] for x in records] == ["user0", "user1", "user2"]
+    assert records[0]['event'] == 'login'
+    assert isinstance(records[0]['ts'], float)
+    # the file is rotated once it is too big
+    for i in range(10):
+        audit.record('login', user="user%s" % i)
+        audit.flush()
+    assert audit.written == 13
+    assert tmpdir.join("audit.log.1").check()
+    assert tmpdir.join("audit.log.2").check()
+    assert not tmpdir.join("audit.log.3").check()
+    audit.thread_shutdown()
+
+
+def test_tracer(tmpdir):
+    from devpi_lockdown.audit import AuditLog
+    from devpi_lockdown.tracing import JsonLinesExporter
+    from devpi_lockdown.tracing import Tracer
+    import json
+    import time
+
+    tracer = Tracer()
+    with tracer.span('outer') as span:
+        span.set_attribute('foo', 1)
+    tracer.record('stage', time.perf_counter())
+    spans = []
+    tracer.exporter = mock.Mock(export=spans.append)
+    with tracer.span('outer', uri='/foo') as span:
+        with tracer.span('inner'):
+            tracer.set_attribute('result', 'ok')
+        tracer.record('stage', time.perf_counter() - 0.5)
+        span.set_attribute('outcome', '200')
+    with pytest.raises(ValueError):
+        with tracer.span('failing'):
+            raise ValueError()
+    assert [x.name for x in spans] == ['inner', 'stage', 'outer', 'failing']
+    (inner, stage, outer, failing) = spans
+    assert outer.parent_id is None
+    assert inner.trace_id == stage.trace_id == outer.trace_id
+    assert inner.parent_id == stage.parent_id == outer.span_id
+    assert failing.trace_id != outer.trace_id
+    assert inner.attributes == {'result': 'ok'}
+    assert outer.attributes == {'uri': '/foo', 'outcome': '200'}
+    assert failing.attributes == {'error': 'ValueError'}
+    assert stage.duration >= 0.5
+    # the JSON lines exporter
+    path = tmpdir.join("trace.log")
+    writer = AuditLog(path.strpath, max_bytes=10000, backups=1)
+    tracer.exporter = JsonLinesExporter(writer)
+    with tracer.span('outer', uri='/foo'):
+        with tracer.span('inner'):
+            pass
+    assert writer.flush() == 2
+    records = [json.loads(x) for x in path.readlines()]
+    assert [x['name'] for x in records] == ['inner', 'outer']
+    assert records[0]['parent'] == records[1]['span']
+    assert records[1] == dict(
+        ts=mock.ANY, event='span', trace=records[0]['trace'],
+        span=mock.ANY, parent=None, name='outer', start=mock.ANY,
+        duration=mock.ANY, uri='/foo')
+    writer.thread_shutdown()
+
+
+def test_tracing(maketestapp, makemapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_lockdown.main import devpiserver_hookimpl
+
+    spans = []
+    exporter = mock.Mock(export=spans.append)
+
+    class Plugin:
+        @devpiserver_hookimpl(trylast=True)
+        def devpiserver_pyramid_configure(self, config, pyramid_config):
+            pyramid_config.set_lockdown_trace_exporter(exporter)
+
+    xom = makexom(plugins=[lockdown_plugin, Plugin()])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    mapp.create_user("user1", "1")
+    testapp.auth = None
+    del spans[:]
+    r = testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="1", submit=""))
+    assert r.status_code == 302
+    names = set(x.name for x in spans)
+    assert {
+        'login', 'login.verify', 'login.authenticate',
+        'login.has_permission'}.issubset(names)
+    (root,) = [x for x in spans if x.parent_id is None]
+    assert root.name == 'login'
+    assert root.attributes == dict(result='success')
+    # with the login cookie
+    del spans[:]
+    testapp.xget(
+        200, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({'X-Original-URI': 'http://localhost/user1'}))
+    names = set(x.name for x in spans)
+    assert {
+        'authcheck', 'authcheck.view', 'authcheck.always_ok',
+        'authcheck.forbidden', 'authcheck.unauthorized', 'credentials',
+        'credentials.lockdown', 'identity'}.issubset(names)
+    (root,) = [x for x in spans if x.parent_id is None]
+    assert root.name == 'authcheck'
+    assert root.attributes == dict(uri='http://localhost/user1', outcome='200')
+    assert all(x.trace_id == root.trace_id for x in spans)
+
+
+def test_slow_request_profiler(tmpdir):
+    from devpi_lockdown.profiler import SlowRequestProfiler
+    from devpi_lockdown.profiler import null_profile
+    import pstats
+    import time
+
+    path = tmpdir.join("profiles")
+    profiler = SlowRequestProfiler(path.strpath, 0, 0, 3)
+    assert path.check(dir=True)
+    assert profiler.profile('authcheck') is null_profile
+    profiler.fraction = 1
+    profiler.threshold = 0.05
+    with profiler.profile('authcheck'):
+        # only one request is profiled at a time
+        assert profiler.profile('login') is null_profile
+    assert profiler.sampled == 1
+    assert profiler.saved == 0
+    assert path.listdir() == []
+    with profiler.profile('login'):
+        time.sleep(0.06)
+    assert profiler.saved == 1
+    (profile,) = path.listdir()
+    assert profile.basename.endswith('ms.prof')
+    assert '-login-' in profile.basename
+    stats = pstats.Stats(profile.strpath)
+    assert any(x[2] == "<built-in method time.sleep>" for x in stats.stats)
+    profiler.threshold = 0
+    for i in range(4):
+        with profiler.profile('authcheck'):
+            pass
+    assert profiler.saved == 5
+    names = sorted(x.basename for x in path.listdir())
+    assert len(names) == 3
+    assert all('-authcheck-' in x for x in names)
+
+
+def test_profiling(maketestapp, makexom, tmpdir):
+    from devpi_lockdown import main as lockdown_plugin
+    import devpi_web.main
+
+    path = tmpdir.join("profiles")
+    xom = makexom(
+        opts=[
+            "--lockdown-profile-dir", path.strpath,
+            "--lockdown-profile-fraction", "1",
+            "--lockdown-profile-threshold", "0"],
+        plugins=[(devpi_web.main, None), (lockdown_plugin, None)])
+    testapp = maketestapp(xom)
+    testapp.xget(
+        401, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({'X-Original-URI': '/root/pypi/'}))
+    testapp.post(
+        'http://localhost/+login',
+        dict(username="root", password="", submit=""))
+    names = sorted(x.basename for x in path.listdir())
+    assert len(names) == 2
+    assert [x.split('-')[2] for x in names] == ['authcheck', 'login']
+    profiler = testapp.app.app.registry['lockdown_profiler']
+    assert (profiler.sampled, profiler.saved) == (2, 2)
+
+
+def test_audit(maketestapp, makexom, tmpdir):
+    from devpi_lockdown import main as lockdown_plugin
+    import devpi_web.main
+    import json
+
+    path = tmpdir.join("audit.log")
+    xom = makexom(
+        opts=["--lockdown-audit-log", path.strpath],
+        plugins=[(devpi_web.main, None), (lockdown_plugin, None)])
+    testapp = maketestapp(xom)
+    audit = testapp.app.app.registry['lockdown_audit']
+    testapp.xget(
+        401, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({
+            'X-Original-URI': '/root/pypi/', 'X-Real-IP': '10.0.0.1'}))
+    testapp.post(
+        'http://localhost/+login',
+        dict(username="root", password="", submit=""),
+        headers={'X-Real-IP': '10.0.0.1'})
+    testapp.post(
+        'http://localhost/+logout', headers={'X-Real-IP': '10.0.0.1'})
+    audit.flush()
+    records = [json.loads(x) for x in path.readlines()]
+    for record in records:
+        del record['ts']
+    assert records == [
+        dict(event='authcheck', user=None, ip='10.0.0.1',
+             uri='/root/pypi/', outcome='401'),
+        dict(event='login', user='root', ip='10.0.0.1', result='success'),
+        dict(event='logout', user='root', ip='10.0.0.1')]
+
+
+def test_metrics(mapp, testapp):
+    mapp.create_user("user1", "1")
+    testapp.xget(401, 'http://localhost/+authcheck')
+    testapp.xget(
+        200, 'http://localhost/+authcheck',
+        headers=ResponseHeaders({
+            'X-Original-URI': 'http://localhost/+api'}))
+    testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="wrong", submit=""),
+        code=401)
+    testapp.post(
+        'http://localhost/+login',
+        dict(username="user1", password="1", submit=""),
+        code=302)
+    testapp.xget(200, 'http://localhost/+authcheck')
+    r = testapp.xget(200, 'http://localhost/+lockdown/metrics')
+    assert r.content_type == 'text/plain'
+    lines = r.text.splitlines()
+    assert '# TYPE devpi_lockdown_authcheck_requests_total counter' in lines
+    assert 'devpi_lockdown_authcheck_requests_total{outcome="200"} 1' in lines
+    assert 'devpi_lockdown_authcheck_requests_total{outcome="401"} 1' in lines
+    assert 'devpi_lockdown_authcheck_requests_total{outcome="always_ok"} 1' in lines
+    assert 'devpi_lockdown_login_total{result="failure"} 1' in lines
+    assert 'devpi_lockdown_login_total{result="success"} 1' in lines
+    assert '# TYPE devpi_lockdown_credentials_verification_seconds histogram' in lines
+    (count,) = [
+        x for x in lines
+        if x.startswith('devpi_lockdown_credentials_verification_seconds_count ')]
+    assert int(count.split()[1]) >= 3
+    assert 'devpi_lockdown_credentials_extraction_seconds_bucket{le="+Inf"}' in r.text
+
+
+def test_metrics_threads():
+    from devpi_lockdown.metrics import Metrics
+    import threading
+
+    metrics = Metrics(buckets=(1.0, 2.0))
+
+    def work():
+        for i in range(100):
+            metrics.inc('requests_total', (('outcome', '200'),))
+            metrics.observe('latency_seconds', 1.5)
+
+    threads = [threading.Thread(target=work) for i in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    metrics.observe('latency_seconds', 0.5)
+    lines = metrics.render([('cache_size', 'gauge', 10)]).splitlines()
+    assert 'requests_total{outcome="200"} 400' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 1' in lines
+    assert 'latency_seconds_bucket{le="2.0"} 401' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 401' in lines
+    assert 'latency_seconds_count 401' in lines
+    assert '# TYPE cache_size gauge' in lines
+    assert 'cache_size 10' in lines
+
+
+def test_authcheck_batch(mapp, testapp):
+    api = mapp.create_and_use("user1/dev")
+    mapp.upload_file_pypi("hello-1.0.tar.gz", b'content', "hello", "1.0")
+    (path,) = mapp.get_release_paths("hello")
+    uris = [
+        'http://localhost' + path,
+        api.simpleindex + 'hello/',
+        'http://localhost/+api',
+        'http://localhost/+nonexisting/foo',
+        api.simpleindex + 'other/']
+    r = testapp.post_json('http://localhost/+authcheck/batch', dict(uris=uris))
+    assert r.json['type'] == 'authcheck-batch'
+    assert [x['status'] for x in r.json['result']] == [200, 200, 200, 403, 200]
+    assert [x['uri'] for x in r.json['result']] == uris
+    mapp.logout()
+    r = testapp.post_json('http://localhost/+authcheck/batch', dict(uris=uris))
+    assert [x['status'] for x in r.json['result']] == [401, 401, 200, 403, 401]
+    r = testapp.post_json(
+        'http://localhost/+authcheck/batch', dict(uris=uris),
+        headers={'User-Agent': 'devpi-client/7'})
+    assert [x['status'] for x in r.json['result']] == [403, 403, 200, 403, 403]
+    r = testapp.post_json(
+        'http://localhost/+authcheck/batch', dict(foo=[]), expect_errors=True)
+    assert r.status_code == 400
+    r = testapp.post_json(
+        'http://localhost/+authcheck/batch', dict(uris="foo"), expect_errors=True)
+    assert r.status_code == 400
+
+
+def test_authcheck_batch_matches_authcheck(maketestapp, makemapp, makexom):
+    from devpi_lockdown import main as lockdown_plugin
+    from devpi_lockdown.main import devpiserver_hookimpl
+    from pyramid.authentication import b64encode
+    from pyramid.threadlocal import get_current_request
+
+    calls = []
+
+    class Plugin:
+        @devpiserver_hookimpl
+        def devpiserver_authcheck_forbidden(self, request):
+            calls.append(request)
+            assert request is get_current_request()
+
+    xom = makexom(plugins=[lockdown_plugin, Plugin()])
+    testapp = maketestapp(xom)
+    mapp = makemapp(testapp)
+    api = mapp.create_and_use("user1/dev", password="1")
+    mapp.create_user("user2", "2")
+    mapp.upload_file_pypi("hello-1.0.tar.gz", b'content', "hello", "1.0")
+    (path,) = mapp.get_release_paths("hello")
+    testapp.auth = None
+    uris = [
+        'http://localhost' + path,
+        api.index,
+        api.simpleindex + 'hello/',
+        'http://localhost/+api',
+        'http://localhost/+nonexisting/foo']
+    for username in (None, "user1", "user2"):
+        for user_agent in ("pip/24", "devpi-client/7"):
+            headers = {'User-Agent': user_agent}
+            if username is not None:
+                headers['Authorization'] = 'Basic %s' % b64encode(
+                    '%s:%s' % (username, username[-1])).decode('ascii')
+            r = testapp.post_json(
+                'http://localhost/+authcheck/batch', dict(uris=uris),
+                headers=headers)
+            batch = [x['status'] for x in r.json['result']]
+            single = [
+                testapp.get(
+                    'http://localhost/+authcheck', expect_errors=True,
+                    headers=ResponseHeaders(dict(
+                        headers, **{'X-Original-URI': uri}))).status_code
+                for uri in uris]
+            assert batch == single
+    assert calls